@@ -0,0 +1,535 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Run YOLOv5 micro-benchmarks on performance-critical helpers (metrics, NMS, pre/post-processing)
+
+Usage:
+    $ python benchmarks.py --task confusion --n 10000
+    $ python benchmarks.py --task letterbox --imgsz 640 --batch-size 8
+    $ python benchmarks.py --task nms --batch-sizes 1 8 64
+    $ python benchmarks.py --task pipeline --weights yolov5s.onnx --batch-size 1
+    $ python benchmarks.py --task pool --weights yolov5s.onnx --images 64
+    $ python benchmarks.py --task val --weights yolov5s-seg.pt --data coco128-seg.yaml --processes 1 2 4 8
+    $ python benchmarks.py --task masks --n 50 --imgsz 640
+    $ python benchmarks.py --task rle --n 300 --sizes 640 1280 2560
+    $ python benchmarks.py --task rasterize --data coco128-seg.yaml --images 256
+    $ python benchmarks.py --task video --source recordings/ --workers 1 2 4 8 --vid-stride 5
+    $ python benchmarks.py --task classify --weights yolov5s-cls.pt --source crops/ --batch-size 64 --workers 8
+    $ python benchmarks.py --task imports --modules utils.ops utils.general --budget 1500
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from utils.general import LOGGER, colorstr, print_args
+
+
+def synthetic_boxes(n, nc=80, size=640, conf=True):
+    # Return n random xyxy boxes as (n,6) x1, y1, x2, y2, conf, class if conf else (n,5) class, x1, y1, x2, y2
+    xy = torch.rand(n, 2) * size
+    xyxy = torch.cat((xy, xy + torch.rand(n, 2) * size / 8 + 1), 1)
+    cls = torch.randint(0, nc, (n, 1)).float()
+    return torch.cat((xyxy, torch.rand(n, 1), cls), 1) if conf else torch.cat((cls, xyxy), 1)
+
+
+def synthetic_predictions(bs, nc=80, anchors=25200, objects=20, size=640):
+    # Return (bs, anchors, 5+nc) model outputs with clusters of overlapping candidates around `objects` per image
+    p = torch.rand(bs, anchors, 5 + nc) * torch.tensor([size, size, size / 10, size / 10, 0.1] + [1.0] * nc)
+    k = anchors // 50  # 2% of anchors fire on objects
+    obj = torch.rand(bs, objects, 4) * torch.tensor([size, size, size / 4, size / 4]) + 8
+    i = torch.randint(0, objects, (bs, k))  # object per firing anchor
+    p[:, :k, :4] = obj.gather(1, i[..., None].expand(-1, -1, 4)) * (1 + 0.1 * torch.randn(bs, k, 4).clamp(-2, 2))
+    p[:, :k, 4] = 0.3 + 0.7 * torch.rand(bs, k)  # objectness
+    p[:, :k, 5:] *= 0.2  # background classes
+    p[:, :k, 5:].scatter_(2, (i % nc)[..., None], 1.0)  # object class
+    return p
+
+
+def synthetic_masks(n=50, shape=(2160, 3840), imgsz=640):
+    # Return protos (32, imgsz/4, imgsz/4), mask coefficients (n,32) and (n,4) xyxy shape pixel boxes up to 1/8 image
+    gain = min(imgsz / shape[0], imgsz / shape[1])
+    size = torch.tensor(shape[::-1]) * gain  # letterboxed image wh
+    pad = (imgsz - size) / 2
+    xy = torch.rand(n, 2) * size * 7 / 8 + pad
+    xyxy = torch.cat((xy, xy + torch.rand(n, 2) * size / 8 + 8), 1)
+    boxes = ((xyxy - pad.repeat(2)) / gain).round()
+    return torch.randn(32, imgsz // 4, imgsz // 4), torch.randn(n, 32) * 0.3, boxes
+
+
+def timeit(fn, n=3):
+    # Return best-of-n wall time of fn() in seconds
+    t = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        t.append(time.perf_counter() - t0)
+    return min(t)
+
+
+def confusion(n=10000, nc=80, images=100, iters=3, **kwargs):
+    # ConfusionMatrix.process_batch() per image vs process_batches() per batch on n synthetic boxes
+    from utils.metrics import ConfusionMatrix
+
+    k = max(n // images, 1)  # boxes per image
+    preds = [synthetic_boxes(k, nc) for _ in range(images)]
+    labels = [synthetic_boxes(k, nc, conf=False) for _ in range(images)]
+
+    def per_image():
+        cm = ConfusionMatrix(nc=nc)
+        for p, l in zip(preds, labels):
+            cm.process_batch(p, l)
+
+    def per_batch():
+        ConfusionMatrix(nc=nc).process_batches(preds, labels)
+
+    results = {'process_batch': timeit(per_image, iters), 'process_batches': timeit(per_batch, iters)}
+    LOGGER.info(f"\n{colorstr('ConfusionMatrix:')} {images} images x {k} boxes")
+    for name, t in results.items():
+        LOGGER.info(f'{name:>24s}{t * 1E3:12.1f} ms{k * images / t:14.0f} boxes/s')
+    return results
+
+
+def val(weights='yolov5s-seg.pt', data='data/coco128-seg.yaml', imgsz=640, batch_size=32, processes=(1, 2, 4, 8),
+        **kwargs):
+    # segment/val.py images/s scaling from 1 to N sharded CPU processes
+    from segment.val import run
+
+    results = {}
+    for p in processes:
+        t0 = time.perf_counter()
+        run(data=data, weights=weights, imgsz=imgsz, batch_size=batch_size, device='cpu', processes=p, plots=False)
+        results[p] = time.perf_counter() - t0
+    LOGGER.info(f"\n{colorstr('Sharded validation:')} {weights} {data}")
+    for p, t in results.items():
+        LOGGER.info(f'{p:>12d} processes{t:12.1f} s{results[processes[0]] / t:10.2f}x')
+    return results
+
+
+def _peak(setup, *args):
+    # Return seconds and peak RSS growth (MB) of running the callable returned by setup(*args), in this process
+    import resource
+
+    fn = setup(*args)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB on Linux
+    t0 = time.perf_counter()
+    fn()
+    t = time.perf_counter() - t0
+    return t, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1E3
+
+
+def isolated(setup, *args):
+    # Return _peak(setup, *args) from a fresh process for a clean peak RSS, None if it was killed, i.e. out of memory
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as p:
+        try:
+            return p.submit(_peak, setup, *args).result()
+        except (BrokenProcessPool, MemoryError):
+            return None
+        except RuntimeError as e:  # torch allocator
+            if 'allocate' in str(e):
+                return None
+            raise
+
+
+def _masks(method, n, shape, imgsz):
+    # Return a callable decoding n synthetic masks with process_mask_native() or process_mask_roi()
+    from utils.segment.general import process_mask_native, process_mask_roi
+
+    protos, masks_in, boxes = synthetic_masks(n, shape, imgsz)
+    if method == 'native':
+        return partial(process_mask_native, protos, masks_in, boxes, shape)
+    return partial(process_mask_roi, protos, masks_in, boxes, (imgsz, imgsz), shape)
+
+
+def masks(n=50, imgsz=640, **kwargs):
+    # Full-image process_mask_native() vs per-box process_mask_roi() time and peak memory for n instances at 1080p, 4K
+    results = {}
+    LOGGER.info(f"\n{colorstr('Masks:')} {n} instances, {imgsz} model input")
+    for name, shape in ('1080p', (1080, 1920)), ('4K', (2160, 3840)):
+        for method in 'native', 'roi':
+            r = results[(name, method)] = isolated(_masks, method, n, shape, imgsz)
+            s = '%12.1f ms%12.1f MB peak' % (r[0] * 1E3, r[1]) if r else '  out of memory, process killed'
+            LOGGER.info(f'{name:>8s}{method:>10s}{s}')
+    return results
+
+
+def _mask_metrics(method, imgsz, n=300, nl=30):
+    # Return a callable computing segment/val.py mask IoUs of n predictions vs nl overlapping labels at imgsz
+    import torch.nn.functional as F
+
+    from utils.segment.general import mask_iou, process_mask
+    from utils.segment.rle import gt_masks_rle, process_mask_rle, rle_iou
+
+    protos, masks_in, boxes = synthetic_masks(n, (imgsz, imgsz), imgsz)
+    gt = torch.zeros(1, imgsz, imgsz)  # overlap label image, later instances on top
+    for i, (x1, y1, x2, y2) in enumerate(synthetic_masks(nl, (imgsz, imgsz), imgsz)[2].int().tolist()):
+        gt[0, y1:y2, x1:x2] = i + 1
+    shape = protos.shape[1:]
+
+    def dense():
+        pred = process_mask(protos, masks_in, boxes, (imgsz, imgsz))
+        g = torch.where(gt.repeat(nl, 1, 1) == torch.arange(1, nl + 1).view(nl, 1, 1), 1.0, 0.0)
+        g = F.interpolate(g[None], shape, mode='bilinear', align_corners=False)[0].gt_(0.5)
+        return mask_iou(g.view(nl, -1), pred.view(n, -1))
+
+    def rle():
+        pred = process_mask_rle(protos, masks_in, boxes, (imgsz, imgsz))
+        return rle_iou(gt_masks_rle(gt, nl, shape, overlap=True), pred)
+
+    return dense if method == 'dense' else rle
+
+
+def rle(n=300, sizes=(640, 1280, 2560), **kwargs):
+    # segment/val.py dense vs RLE mask IoU time and peak memory per image, for n predictions vs 30 labels per size
+    results = {}
+    LOGGER.info(f"\n{colorstr('RLE masks:')} {n} predictions vs 30 overlapping labels per image")
+    for imgsz in sizes:
+        for method in 'dense', 'rle':
+            r = results[(imgsz, method)] = isolated(_mask_metrics, method, imgsz, n)
+            s = '%12.1f ms%12.1f MB peak' % (r[0] * 1E3, r[1]) if r else '  out of memory, process killed'
+            LOGGER.info(f'{imgsz:>8d}{method:>10s}{s}')
+    return results
+
+
+def _overlap_loop(img_size, segments, downsample_ratio=1):
+    # Reference polygons2masks_overlap(): full-image polygon2mask() per instance, composited in a Python loop
+    from utils.segment.dataloaders import polygon2mask
+
+    ms = np.array([polygon2mask(img_size, [x.reshape(-1)], 1, downsample_ratio) for x in segments])
+    index = np.argsort(-ms.sum((1, 2), dtype=np.uint64)) if len(ms) else np.zeros(0, dtype=int)
+    masks = np.zeros((img_size[0] // downsample_ratio, img_size[1] // downsample_ratio),
+                     dtype=np.int32 if len(segments) > 255 else np.uint8)
+    for i, m in enumerate(ms[index]):
+        masks = np.clip(masks + m.astype(masks.dtype) * (i + 1), 0, i + 1)
+    return masks, index
+
+
+def rasterize(data='data/coco128-seg.yaml', imgsz=640, images=100, iters=3, **kwargs):
+    # Per-instance loop vs single-pass polygons2masks_overlap() on crowded synthetic images, then segmentation
+    # dataloader throughput on the data train set with mosaic augmentation, overlap masks and 4x mask downsampling
+    import utils.segment.dataloaders as sd
+    from utils.general import check_dataset
+
+    rng = np.random.default_rng(0)
+    results = {}
+    LOGGER.info(f"\n{colorstr('Rasterize:')} polygons2masks_overlap() at {imgsz}, mask ratio 4")
+    for n in 10, 50, 200:
+        segments = []
+        for _ in range(n):  # random star-shaped polygons
+            a = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(3, 40)))
+            r = rng.uniform(4, imgsz / 4) * rng.uniform(0.5, 1, len(a))
+            segments.append(rng.uniform(0, imgsz, 2) + np.stack((r * np.cos(a), r * np.sin(a)), 1))
+        t = results[n] = [timeit(lambda: f((imgsz, imgsz), segments, 4), iters)
+                          for f in (_overlap_loop, sd.polygons2masks_overlap)]
+        LOGGER.info(f'{n:>8d} instances{t[0] * 1E3:10.2f} ms loop{t[1] * 1E3:10.2f} ms single-pass{t[0] / t[1]:8.2f}x')
+
+    with open(ROOT / 'data/hyps/hyp.scratch-low.yaml', errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    dataset = sd.LoadImagesAndLabelsAndMasks(check_dataset(data)['train'], imgsz, 1, augment=True, hyp=hyp,
+                                             downsample_ratio=4, overlap=True)
+    fast = sd.polygons2masks_overlap
+    for name, f in ('loop', _overlap_loop), ('single-pass', fast):
+        sd.polygons2masks_overlap = f
+        random.seed(0)
+        t0 = time.perf_counter()
+        for i in range(images):
+            dataset[i % len(dataset)]
+        t = results[name] = images / (time.perf_counter() - t0)
+        LOGGER.info(f'{name:>20s}{t:10.1f} img/s dataloader')
+    sd.polygons2masks_overlap = fast
+    return results
+
+
+def letterbox(imgsz=640, batch_size=8, iters=3, **kwargs):
+    # letterbox() + transpose + from_numpy + float + /255 chain vs fused LetterBoxBatch at 1080p and 4K
+    from utils.augmentations import LetterBoxBatch
+    from utils.augmentations import letterbox as lb
+
+    def chain(ims):
+        x = np.stack([lb(im, imgsz, auto=False)[0] for im in ims])  # pad and stack
+        x = np.ascontiguousarray(x.transpose((0, 3, 1, 2))[:, ::-1])  # BHWC to BCHW, BGR to RGB
+        return torch.from_numpy(x).float() / 255
+
+    results = {}
+    LOGGER.info(f"\n{colorstr('Letterbox:')} batch {batch_size} to {imgsz}")
+    for name, shape in ('1080p', (1080, 1920, 3)), ('4K', (2160, 3840, 3)):
+        ims = [np.random.randint(0, 255, shape, dtype=np.uint8) for _ in range(batch_size)]
+        fns = {'chain': partial(chain, ims)}
+        for dtype in torch.float32, torch.float16, torch.uint8:
+            fns[f'fused {str(dtype)[6:]}'] = partial(LetterBoxBatch(imgsz, dtype=dtype), ims)
+        for k, fn in fns.items():
+            fn()  # warmup, allocate reusable buffers
+            t = results[(name, k)] = timeit(fn, iters)
+            LOGGER.info(f'{name:>8s}{k:>16s}{t * 1E3 / batch_size:12.2f} ms/img{batch_size / t:12.1f} img/s')
+    return results
+
+
+def nms(nc=80, batch_sizes=(1, 2, 4, 8, 16, 32, 64), iters=3, **kwargs):
+    # non_max_suppression() per-image loop vs batched_non_max_suppression() on synthetic 640x640 model outputs
+    from utils.general import batched_non_max_suppression, non_max_suppression
+
+    results = {}
+    LOGGER.info(f"\n{colorstr('NMS:')} 25200 anchors, {nc} classes")
+    LOGGER.info(f"{'batch':>8s}{'loop (ms)':>14s}{'batched (ms)':>14s}{'speedup':>10s}")
+    for bs in batch_sizes:
+        p = synthetic_predictions(bs, nc)
+        t = [timeit(lambda: f(p, 0.25, 0.45), iters) for f in (non_max_suppression, batched_non_max_suppression)]
+        results[bs] = t
+        LOGGER.info(f'{bs:>8d}{t[0] * 1E3:14.1f}{t[1] * 1E3:14.1f}{t[0] / t[1]:9.2f}x')
+    return results
+
+
+def pipeline(weights='yolov5s.pt', imgsz=640, batch_size=1, images=100, device='', **kwargs):
+    # Serial vs pipelined DetectPipeline steady-state throughput on synthetic 1080p frames, for any backend weights
+    from models.common import DetectMultiBackend, DetectPipeline
+    from utils.torch_utils import select_device
+
+    model = DetectMultiBackend(weights, device=select_device(device))
+    frames = [np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8) for _ in range(8)]
+    results = {}
+    LOGGER.info(f"\n{colorstr('Pipeline:')} {weights} batch {batch_size} to {imgsz}, {images} 1080p frames")
+    for threaded in False, True:
+        p = DetectPipeline(model, imgsz, batch_size, threaded=threaded)
+        stream = p(frames[i % len(frames)] for i in range(images + 2 * batch_size))
+        for _ in range(2 * batch_size):  # warmup, fill the pipeline
+            next(stream)
+        dt = [x.t for x in p.dt]
+        t0 = time.perf_counter()
+        for _ in stream:
+            pass
+        t = results['pipelined' if threaded else 'serial'] = images / (time.perf_counter() - t0)
+        pre, inf, nms = ((x.t - t) * 1E3 / images for x, t in zip(p.dt, dt))
+        LOGGER.info(f"{'pipelined' if threaded else 'serial':>12s}{t:10.1f} img/s   "
+                    f'{pre:.1f}ms pre-process, {inf:.1f}ms inference, {nms:.1f}ms NMS per image')
+    LOGGER.info(f"{'speedup':>12s}{results['pipelined'] / results['serial']:10.2f}x")
+    return results
+
+
+def pool(weights='yolov5s.pt', imgsz=640, images=100, **kwargs):
+    # ModelPool img/s for every instances x threads split of the CPU cores, as calibrated by autopool()
+    from utils.modelpool import autopool
+
+    return autopool(weights, imgsz, frames=images)
+
+
+def synthetic_videos(n=4, frames=300, shape=(720, 1280), fps=30, save_dir=ROOT / 'runs/benchmarks/videos'):
+    # Write n moving-noise mp4 videos and return their paths
+    import cv2
+
+    save_dir = Path(save_dir)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    im = rng.integers(0, 255, (shape[0], shape[1] * 2, 3), dtype=np.uint8)
+    files = []
+    for i in range(n):
+        f = save_dir / f'video{i}.mp4'
+        if not f.exists():
+            w = cv2.VideoWriter(str(f), cv2.VideoWriter_fourcc(*'mp4v'), fps, shape[::-1])
+            for j in range(frames):
+                x = (i * 97 + j * 8) % shape[1]
+                w.write(np.ascontiguousarray(im[:, x:x + shape[1]]))
+            w.release()
+        files.append(str(f))
+    return files
+
+
+def video(source='', imgsz=640, vid_stride=1, workers=(1, 2, 4, 8), infer=5, **kwargs):
+    # Frames/s of a cv2.VideoCapture.read() loop vs VideoReader (threaded prefetch, grab() stride), both with infer ms
+    # of simulated inference per frame, and decode-only LoadVideos over all source videos (synthetic 720p if none)
+    import cv2
+
+    from utils.augmentations import letterbox as lb
+    from utils.dataloaders import VID_FORMATS, LoadVideos, VideoReader
+
+    files = sorted(str(x) for x in Path(source).rglob('*.*') if x.suffix[1:].lower() in VID_FORMATS) if source else []
+    files = files or synthetic_videos()
+    LOGGER.info(f"\n{colorstr('Video:')} {len(files)} videos, stride {vid_stride}, {os.cpu_count()} CPUs")
+
+    def loop():
+        n = 0
+        for f in files:
+            cap = cv2.VideoCapture(f)
+            while True:
+                for _ in range(vid_stride):  # stride by decoding and dropping frames
+                    success, im0 = cap.read()
+                if not success:
+                    break
+                lb(im0, imgsz)
+                time.sleep(infer / 1E3)  # inference stand-in
+                n += 1
+            cap.release()
+        return n
+
+    def reader():
+        n = 0
+        for f in files:
+            for _ in VideoReader(f, vid_stride, transforms=lambda x: lb(x, imgsz)[0]):
+                time.sleep(infer / 1E3)  # inference stand-in, overlaps decode
+                n += 1
+        return n
+
+    def loader(k):
+        return sum(1 for _ in LoadVideos(files, imgsz, vid_stride=vid_stride, workers=k))
+
+    fns = {'read() loop': loop, 'VideoReader': reader, **{f'LoadVideos {k}': partial(loader, k) for k in workers}}
+    results = {}
+    for name, fn in fns.items():
+        t0 = time.perf_counter()
+        n = fn()
+        t = results[name] = n / (time.perf_counter() - t0)
+        LOGGER.info(f'{name:>20s}{n:8d} frames{t:10.1f} frames/s')
+    return results
+
+
+def synthetic_crops(n=100, classes=('fire', 'smoke', 'other'), save_dir=ROOT / 'runs/benchmarks/crops'):
+    # Write n random-size blurred noise jpgs per class folder and return the directory
+    import cv2
+
+    rng = np.random.default_rng(0)
+    for c in classes:
+        d = Path(save_dir) / c
+        d.mkdir(parents=True, exist_ok=True)
+        for i in range(n):
+            if not (d / f'{i}.jpg').exists():
+                im = rng.integers(0, 255, (*rng.integers(60, 400, 2), 3), dtype=np.uint8)
+                cv2.imwrite(str(d / f'{i}.jpg'), cv2.GaussianBlur(im, (5, 5), 0))
+    return str(save_dir)
+
+
+def classify(weights='yolov5s-cls.pt', source='', imgsz=224, batch_size=32, workers=(1, 2, 4, 8), **kwargs):
+    # Images/s of classify/predict.py one image per iteration vs its batched DataLoader mode on a class-folder
+    # directory (synthetic crops if none), each batched run with max(workers) workers
+    import logging
+
+    from classify.predict import run as predict
+
+    source = source or synthetic_crops()
+    n = sum(1 for x in Path(source).rglob('*.*') if x.suffix[1:].lower() in ('jpg', 'jpeg', 'png', 'bmp'))
+    LOGGER.info(f"\n{colorstr('Classify:')} {n} images in {source}, {os.cpu_count()} CPUs")
+    runs = {'loop': dict(source=f'{source}/**/*.*', nosave=True)}
+    for b in sorted({1, batch_size} - {1}) or [batch_size]:
+        runs[f'batch {b}'] = dict(source=source, batch_size=b, workers=max(workers))
+    results, level = {}, LOGGER.level
+    for name, kw in runs.items():
+        LOGGER.setLevel(logging.WARNING)  # no per-image lines
+        try:
+            t0 = time.perf_counter()
+            predict(weights=weights, imgsz=(imgsz, imgsz), project=ROOT / 'runs/benchmarks', name='classify',
+                    exist_ok=True, **kw)
+            t = results[name] = n / (time.perf_counter() - t0)
+        finally:
+            LOGGER.setLevel(level)
+        LOGGER.info(f'{name:>20s}{t:10.1f} images/s')
+    return results
+
+
+# Modules that must not be imported by a module at import time, loaded lazily where used
+LAZY = {
+    'utils.ops': ('torchvision', 'pandas', 'matplotlib', 'ultralytics', 'pkg_resources', 'yaml', 'cv2'),
+    'utils.general': ('pandas', 'matplotlib', 'ultralytics', 'pkg_resources', 'torchvision'),
+    'detect': ('matplotlib', 'ultralytics', 'pandas')}
+
+
+def import_time(module):
+    # Return {package: cumulative us} of 'python -X importtime -c "import module"' in a fresh interpreter
+    cmd = [sys.executable, '-X', 'importtime', '-c', f'import {module}']
+    r = subprocess.run(cmd, capture_output=True, text=True, cwd=ROOT, env={**os.environ, 'PYTHONPATH': str(ROOT)})
+    if r.returncode:
+        raise ImportError(f'import {module} failed:\n{r.stderr[-2000:]}')
+    times = {}
+    for line in r.stderr.splitlines():  # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cum, name = line[12:].split('|')
+            times[name.strip()] = int(cum)
+    return times
+
+
+def imports(modules=('utils.ops', 'utils.general', 'detect'), budget=0, top=10, **kwargs):
+    # Fresh-interpreter import time of each module, its slowest dependencies, and a check that it stays within budget
+    # milliseconds (0 for no limit) without importing the heavy modules listed in LAZY
+    results, failed = {}, []
+    for m in modules:
+        times = import_time(m)
+        t = results[m] = times.get(m, 0) / 1E3
+        LOGGER.info(f"\n{colorstr('Imports:')} import {m} {t:.0f} ms")
+        for name, us in sorted(((k, v) for k, v in times.items() if '.' not in k), key=lambda x: -x[1])[:top]:
+            LOGGER.info(f'{name:>30s}{us / 1E3:10.0f} ms')
+        eager = [x for x in LAZY.get(m, ()) if x in times]
+        if eager:
+            failed.append(f'{m} imports {", ".join(eager)}')
+        if budget and t > budget:
+            failed.append(f'{m} {t:.0f} ms > {budget} ms budget')
+    if failed:
+        raise RuntimeError(f'Import-time check failed: {"; ".join(failed)}')
+    LOGGER.info('Import-time check passed ✅')
+    return results
+
+
+TASKS = {
+    'confusion': confusion,
+    'val': val,
+    'letterbox': letterbox,
+    'nms': nms,
+    'pipeline': pipeline,
+    'pool': pool,
+    'masks': masks,
+    'rle': rle,
+    'rasterize': rasterize,
+    'video': video,
+    'classify': classify,
+    'imports': imports}
+
+
+def run(task=('confusion', ), **kwargs):
+    return {t: TASKS[t](**kwargs) for t in task}
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--task', nargs='+', default=['confusion'], help=f'benchmarks to run: {", ".join(TASKS)}')
+    parser.add_argument('--n', type=int, default=10000, help='number of synthetic boxes')
+    parser.add_argument('--nc', type=int, default=80, help='number of classes')
+    parser.add_argument('--images', type=int, default=100, help='number of synthetic images')
+    parser.add_argument('--iters', type=int, default=3, help='timing iterations (best-of)')
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s-seg.pt', help='model path')
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco128-seg.yaml', help='dataset.yaml path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=32, help='batch size')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--processes', nargs='+', type=int, default=[1, 2, 4, 8], help='validation process counts')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 2, 4, 8, 16, 32, 64], help='NMS batch sizes')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[640, 1280, 2560], help='RLE mask image sizes')
+    parser.add_argument('--source', type=str, default='', help='video or class-folder image dir, synthetic if empty')
+    parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4, 8], help='video files, dataloader workers')
+    parser.add_argument('--modules', nargs='+', default=['utils.ops', 'utils.general', 'detect'], help='import modules')
+    parser.add_argument('--budget', type=float, default=0, help='import time budget per module (ms), 0 for no limit')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
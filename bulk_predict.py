@@ -0,0 +1,244 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Run YOLOv5 detection, segmentation or classification inference in batches over large image folders, decoding images
+in a thread pool and writing results to JSONL or Parquet shards instead of one label file per image. Runs resume from
+a manifest of written shards, so an interrupted run continues where it stopped when rerun with --exist-ok
+
+Usage:
+    $ python bulk_predict.py --weights yolov5s.pt --source data/dataset_test --batch-size 32 --workers 8
+    $ python bulk_predict.py --weights yolov5s-seg.pt --task segment --source archive/ --format parquet
+    $ python bulk_predict.py --weights yolov5s-cls.pt --task classify --source archive/ --imgsz 224
+    $ python bulk_predict.py --weights yolov5s.pt --source archive/ --name archive --exist-ok  # resume
+
+Rows hold file, width and height, plus per task:
+    detect: cls, conf and box (xyxy pixels) lists
+    segment: detect columns and segment, one flat x1, y1, x2, y2, ... pixel polygon per instance
+    classify: top5 class indices and prob
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import torch
+import torch.nn.functional as F
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from models.common import DetectMultiBackend
+from utils.augmentations import LetterBoxBatch, classify_transforms
+from utils.dataloaders import image_files
+from utils.general import (LOGGER, Profile, check_img_size, check_requirements, colorstr, increment_path,
+                           non_max_suppression, print_args, scale_boxes)
+from utils.segment.general import process_mask_roi
+from utils.torch_utils import select_device, smart_inference_mode
+
+
+def decode(files, fn=cv2.imread, workers=8, depth=64):
+    # Yield (file, fn(file)) in order, running fn up to depth files ahead in a pool of worker threads
+    with ThreadPoolExecutor(workers) as pool:
+        futures = deque()
+        for f in files:
+            futures.append((f, pool.submit(fn, f)))
+            if len(futures) > depth:
+                f, x = futures.popleft()
+                yield f, x.result()
+        while futures:
+            f, x = futures.popleft()
+            yield f, x.result()
+
+
+def write_shard(rows, f, format='jsonl'):
+    # Write result rows to shard file f, atomically so a killed run never leaves a partial shard
+    tmp = f.with_suffix('.tmp')
+    if format == 'parquet':
+        check_requirements('pyarrow')
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pq.write_table(pa.Table.from_pylist(rows), tmp)
+    else:
+        with open(tmp, 'w') as fp:
+            fp.writelines(json.dumps(r, separators=(',', ':')) + '\n' for r in rows)
+    os.replace(tmp, f)
+
+
+class Predictor:
+    # Batch inference and result rows for one task, with images decoded and preprocessed in worker threads
+    def __init__(self, model, task='detect', imgsz=(640, 640), conf_thres=0.25, iou_thres=0.45, max_det=1000):
+        self.model, self.task, self.imgsz = model, task, imgsz
+        self.conf_thres, self.iou_thres, self.max_det = conf_thres, iou_thres, max_det
+        if task == 'classify':
+            self.transforms = classify_transforms(imgsz[0])
+        else:
+            dtype = torch.half if model.fp16 else torch.float
+            self.letterbox = LetterBoxBatch(imgsz, model.stride, dtype=dtype, pin_memory=model.device.type != 'cpu')
+
+    def read(self, f):
+        # Return (im0, classify input or None), None if unreadable, in a decode thread
+        im0 = cv2.imread(f)  # BGR
+        if im0 is None:
+            return None
+        return im0, self.transforms(im0) if self.task == 'classify' else None
+
+    def __call__(self, files, items):
+        # Return one result row per (im0, x) item of files
+        model, ims = self.model, [im for im, _ in items]
+        if self.task == 'classify':
+            x = torch.stack([x for _, x in items]).to(model.device)
+            prob = F.softmax(model(x.half() if model.fp16 else x.float()), dim=1)
+            p, i = prob.topk(min(5, prob.shape[1]), dim=1)  # batch top5
+            rows = [{'top5': a, 'prob': b.round(5).tolist()} for a, b in zip(i.tolist(), p.double().cpu().numpy())]
+        else:
+            x = self.letterbox(ims)[0].to(model.device, non_blocking=True)
+            y = model(x)
+            proto = y[1] if self.task == 'segment' else None
+            det = non_max_suppression(y[0] if self.task == 'segment' else y,
+                                      self.conf_thres,
+                                      self.iou_thres,
+                                      max_det=self.max_det,
+                                      nm=32 if self.task == 'segment' else 0)
+            rows = []
+            for i, (im, d) in enumerate(zip(ims, det)):
+                d[:, :4] = scale_boxes(x.shape[2:], d[:, :4], im.shape).round()
+                a = d[:, :6].double().cpu().numpy()
+                r = {'cls': a[:, 5].astype(int).tolist(), 'conf': a[:, 4].round(4).tolist(), 'box': a[:, :4].tolist()}
+                if proto is not None:
+                    masks = process_mask_roi(proto[i], d[:, 6:], d[:, :4], x.shape[2:], im.shape)
+                    r['segment'] = [s.reshape(-1).round(1).tolist() for s in masks.segments()]
+                rows.append(r)
+        return [{'file': f, 'width': im.shape[1], 'height': im.shape[0], **r} for f, im, r in zip(files, ims, rows)]
+
+
+@smart_inference_mode()
+def run(
+        weights=ROOT / 'yolov5s.pt',  # model path, any DetectMultiBackend format
+        source=ROOT / 'data/dataset_test',  # image directory, glob or *.txt list of images
+        task='detect',  # detect, segment or classify
+        imgsz=(640, 640),  # inference size (height, width)
+        conf_thres=0.25,  # confidence threshold
+        iou_thres=0.45,  # NMS IoU threshold
+        max_det=1000,  # maximum detections per image
+        batch_size=32,  # inference batch size
+        workers=8,  # image decode threads
+        shard_size=10000,  # images per output shard
+        format='jsonl',  # output shard format, jsonl or parquet
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        dnn=False,  # use OpenCV DNN for ONNX inference
+        project=ROOT / 'runs/predict-bulk',  # save results to project/name
+        name='exp',  # save results to project/name
+        exist_ok=False,  # existing project/name ok, do not increment, resumes from its manifest
+):
+    prefix = colorstr('Bulk predict:')
+    save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)
+    save_dir.mkdir(parents=True, exist_ok=True)
+    manifest = save_dir / 'manifest.jsonl'
+
+    # Resume: skip images in shards already listed in the manifest
+    done, shards = set(), 0
+    if manifest.exists():
+        for line in manifest.read_text().splitlines():
+            with contextlib.suppress(ValueError, KeyError):  # skip a line torn by an interrupted run
+                e = json.loads(line)
+                if (save_dir / e['shard']).exists():
+                    done.update(e['files'])
+                    shards = max(shards, e['index'] + 1)
+    files = image_files(source)
+    todo = [f for f in files if f not in done]
+    LOGGER.info(f'{prefix} {len(files)} images in {source}, {len(files) - len(todo)} done, {len(todo)} to predict')
+    if not todo:
+        return save_dir
+
+    # Model
+    device = select_device(device, batch_size=batch_size)
+    model = DetectMultiBackend(weights, device=device, dnn=dnn, fp16=half)
+    imgsz = check_img_size(imgsz, s=model.stride)  # check image size
+    model.warmup(imgsz=(1 if model.pt else batch_size, 3, *imgsz))  # warmup
+    predictor = Predictor(model, task, imgsz, conf_thres, iou_thres, max_det)
+
+    # Predict
+    dt, rows, files, n = (Profile(), Profile(), Profile()), [], [], 0  # files: images in the current shard
+    t0 = time.time()
+    with open(manifest, 'a') as mf:
+
+        def flush():
+            nonlocal rows, files, shards
+            f = save_dir / f'part-{shards:05d}.{format}'
+            with dt[2]:
+                write_shard(rows, f, format)
+            mf.write(json.dumps({'index': shards, 'shard': f.name, 'files': files}) + '\n')
+            mf.flush()  # checkpoint after every shard
+            rows, files, shards = [], [], shards + 1
+            LOGGER.info(f'{prefix} {n}/{len(todo)} images, {n / (time.time() - t0):.1f} img/s, {f.name}')
+
+        it = decode(todo, predictor.read, workers, depth=max(2 * batch_size, workers))
+        while True:
+            with dt[0]:  # wait for decode
+                batch = [x for _, x in zip(range(batch_size), it)]
+            if not batch:
+                break
+            for f, x in batch:
+                if x is None:
+                    LOGGER.warning(f'{prefix} WARNING ⚠️ unreadable image {f}')
+            ok = [(f, x) for f, x in batch if x is not None]
+            if ok:
+                with dt[1]:
+                    rows += predictor(*zip(*ok))
+            files += [f for f, _ in batch]  # unreadable images too, not retried on resume
+            n += len(batch)
+            if len(files) >= shard_size:
+                flush()
+        if files:
+            flush()
+
+    t = time.time() - t0
+    LOGGER.info(f'{prefix} {n} images in {t:.1f}s, {n / t:.1f} img/s, %.1fms decode wait, %.1fms inference, '
+                f'%.1fms write per image' % tuple(x.t / max(n, 1) * 1E3 for x in dt))
+    LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}")
+    return save_dir
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='model path')
+    parser.add_argument('--source', type=str, default=ROOT / 'data/dataset_test', help='image dir, glob or *.txt list')
+    parser.add_argument('--task', default='detect', choices=('detect', 'segment', 'classify'), help='model task')
+    parser.add_argument('--imgsz', '--img', '--img-size', nargs='+', type=int, default=[640], help='inference size h,w')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--batch-size', type=int, default=32, help='inference batch size')
+    parser.add_argument('--workers', type=int, default=8, help='image decode threads')
+    parser.add_argument('--shard-size', type=int, default=10000, help='images per output shard')
+    parser.add_argument('--format', default='jsonl', choices=('jsonl', 'parquet'), help='output shard format')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
+    parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--project', default=ROOT / 'runs/predict-bulk', help='save results to project/name')
+    parser.add_argument('--name', default='exp', help='save results to project/name')
+    parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, resume from its manifest')
+    opt = parser.parse_args()
+    opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
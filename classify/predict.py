@@ -14,6 +14,9 @@ Usage - sources:
                                                                    'https://youtu.be/Zgi9g1ksQHc'  # YouTube
                                                                    'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP stream
 
+Usage - batched:
+    $ python classify/predict.py --weights yolov5s-cls.pt --source crops/ --batch-size 64 --workers 8 --save-txt
+
 Usage - formats:
     $ python classify/predict.py --weights yolov5s-cls.pt                 # PyTorch
                                            yolov5s-cls.torchscript        # TorchScript
@@ -29,9 +32,11 @@ Usage - formats:
 """
 
 import argparse
+import csv
 import os
 import platform
 import sys
+import time
 from pathlib import Path
 
 import torch
@@ -47,12 +52,72 @@ from ultralytics.utils.plotting import Annotator
 
 from models.common import DetectMultiBackend
 from utils.augmentations import classify_transforms
-from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
+from utils.dataloaders import (IMG_FORMATS, PIN_MEMORY, VID_FORMATS, ClassificationDataset, LoadImages, LoadScreenshots,
+                               LoadStreams)
 from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
                            increment_path, print_args, strip_optimizer)
 from utils.torch_utils import select_device, smart_inference_mode
 
 
+@smart_inference_mode()
+def predict_batched(model, source, imgsz=224, batch_size=64, workers=8, topk=5, save_txt=False, save_dir=Path('')):
+    # Classify a class-folder image directory (ImageFolder layout, i.e. --save-crop output) in batches from a
+    # prefetching DataLoader, with top-k on each batch into preallocated tensors and all results written once at the end
+    dataset = ClassificationDataset(root=source, augment=False, imgsz=imgsz)
+    n, k = len(dataset), min(topk, len(model.names))
+    nw = min(os.cpu_count() or 1, batch_size, workers)
+    loader = torch.utils.data.DataLoader(dataset,
+                                         batch_size=batch_size,
+                                         shuffle=False,
+                                         num_workers=nw,
+                                         pin_memory=PIN_MEMORY and model.device.type != 'cpu',
+                                         prefetch_factor=4 if nw else None)
+    x = torch.empty((batch_size, 3, imgsz, imgsz), dtype=torch.half if model.fp16 else torch.float, device=model.device)
+    top_p = torch.empty((n, k), device=model.device)  # top-k probabilities
+    top_i = torch.empty((n, k), dtype=torch.long, device=model.device)  # top-k classes
+    dt = (Profile(), Profile(), Profile())
+    model.warmup(imgsz=(1 if model.pt else batch_size, 3, imgsz, imgsz))  # warmup
+    i, t0 = 0, time.time()
+    with dt[0]:
+        batches = iter(loader)
+    while True:
+        with dt[0]:
+            ims, _ = next(batches, (None, None))
+            if ims is None:
+                break
+            b = len(ims)
+            xb = x[:b].copy_(ims, non_blocking=True)  # into the preallocated fp16/32 batch
+        with dt[1]:
+            results = model(xb)
+        with dt[2]:
+            torch.topk(F.softmax(results.float(), dim=1), k, dim=1, out=(top_p[i:i + b], top_i[i:i + b]))
+        i += b
+    t = time.time() - t0
+
+    # Results, written in bulk
+    top_p, top_i = top_p.cpu(), top_i.cpu()
+    labels = torch.tensor([x[1] for x in dataset.samples])
+    folders = {j: c for c, j in dataset.class_to_idx.items()}
+    names = model.names
+    acc = ''
+    if set(dataset.classes) <= {str(v) for v in names.values()}:  # class folders named as model classes
+        idx = {v: j for j, v in names.items()}
+        y = torch.tensor([idx[folders[int(j)]] for j in labels])
+        acc = f', top1 {(top_i[:, 0] == y).float().mean():.3f} top{k} {(top_i == y[:, None]).any(1).float().mean():.3f}'
+    if save_txt:
+        f = save_dir / 'predictions.csv'
+        with open(f, 'w', newline='') as fp:
+            writer = csv.writer(fp)  # quotes paths with commas
+            writer.writerow(['file', 'folder'] + [f'{x}{j}' for j in range(1, k + 1) for x in ('class', 'prob')])
+            writer.writerows([s[0], folders[s[1]]] + [x for c, p in zip(ci, pi) for x in (names[c], f'{p:.4f}')]
+                             for s, ci, pi in zip(dataset.samples, top_i.tolist(), top_p.tolist()))
+    LOGGER.info(f'{n} images in {t:.1f}s, {n / t:.1f} images/s{acc}')
+    LOGGER.info('Speed: %.1fms load wait, %.1fms inference, %.1fms top-k per image at batch %i' %
+                (*(x.t / max(n, 1) * 1E3 for x in dt), batch_size))
+    LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}")
+    return top_i, top_p
+
+
 @smart_inference_mode()
 def run(
         weights=ROOT / 'yolov5s-cls.pt',  # model.pt path(s)
@@ -72,6 +137,8 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        batch_size=1,  # batch size, > 1 classifies a class-folder directory in batches
+        workers=8,  # max dataloader workers of batched mode
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -91,12 +158,19 @@ def run(
     model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    if batch_size > 1:
+        assert os.path.isdir(source), f'--batch-size {batch_size} requires a class-folder image directory source'
+        return predict_batched(model, source, imgsz[0], batch_size, workers, save_txt=save_txt, save_dir=save_dir)
 
     # Dataloader
     bs = 1  # batch_size
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, transforms=classify_transforms(imgsz[0]), vid_stride=vid_stride)
+        dataset = LoadStreams(source,
+                              img_size=imgsz,
+                              transforms=classify_transforms(imgsz[0]),
+                              vid_stride=vid_stride,
+                              skip_stale=pt)  # fixed-batch exports need every stream in each batch
         bs = len(dataset)
     elif screenshot:
         dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
@@ -125,11 +199,11 @@ def run(
         # Process predictions
         for i, prob in enumerate(pred):  # per image
             seen += 1
-            if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
+            if webcam:  # batch_size >= 1, streams with new frames only
+                p, im0, frame, k = path[i], im0s[i].copy(), dataset.count, dataset.index[i]  # k stream index
+                s += f'{k}: '
             else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+                p, im0, frame, k = path, im0s.copy(), getattr(dataset, 'frame', 0), i
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
@@ -165,10 +239,10 @@ def run(
                 if dataset.mode == 'image':
                     cv2.imwrite(save_path, im0)
                 else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
+                    if vid_path[k] != save_path:  # new video
+                        vid_path[k] = save_path
+                        if isinstance(vid_writer[k], cv2.VideoWriter):
+                            vid_writer[k].release()  # release previous video writer
                         if vid_cap:  # video
                             fps = vid_cap.get(cv2.CAP_PROP_FPS)
                             w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -176,8 +250,8 @@ def run(
                         else:  # stream
                             fps, w, h = 30, im0.shape[1], im0.shape[0]
                         save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+                        vid_writer[k] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    vid_writer[k].write(im0)
 
         # Print time (inference-only)
         LOGGER.info(f'{s}{dt[1].dt * 1E3:.1f}ms')
@@ -211,6 +285,8 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size, > 1 for batched class-folder directory')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers of batched mode')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -97,7 +97,10 @@ def run(
                                                       workers=workers)
 
     model.eval()
-    pred, targets, loss, dt = [], [], 0, (Profile(), Profile(), Profile())
+    nc = len(model.names)  # number of classes
+    correct = torch.zeros(nc, 2, device=device)  # running (top1, top5) correct counts per class
+    seen = torch.zeros(nc, device=device)  # running image counts per class
+    loss, dt = 0, (Profile(), Profile(), Profile())
     n = len(dataloader)  # number of batches
     action = 'validating' if dataloader.dataset.root.stem == 'val' else 'testing'
     desc = f'{pbar.desc[:-36]}{action:>36}' if pbar else f'{action}'
@@ -111,26 +114,24 @@ def run(
                 y = model(images)
 
             with dt[2]:
-                pred.append(y.argsort(1, descending=True)[:, :5])
-                targets.append(labels)
+                pred = y.topk(min(5, y.shape[1]), 1).indices
+                c = (labels[:, None] == pred).float()
+                correct.index_add_(0, labels, torch.stack((c[:, 0], c.max(1).values), dim=1))
+                seen.index_add_(0, labels, torch.ones_like(labels, dtype=seen.dtype))
                 if criterion:
                     loss += criterion(y, labels)
 
     loss /= n
-    pred, targets = torch.cat(pred), torch.cat(targets)
-    correct = (targets[:, None] == pred).float()
-    acc = torch.stack((correct[:, 0], correct.max(1).values), dim=1)  # (top1, top5) accuracy
-    top1, top5 = acc.mean(0).tolist()
+    top1, top5 = (correct.sum(0) / seen.sum()).tolist()  # (top1, top5) accuracy
 
     if pbar:
         pbar.desc = f'{pbar.desc[:-36]}{loss:>12.3g}{top1:>12.3g}{top5:>12.3g}'
     if verbose:  # all classes
         LOGGER.info(f"{'Class':>24}{'Images':>12}{'top1_acc':>12}{'top5_acc':>12}")
-        LOGGER.info(f"{'all':>24}{targets.shape[0]:>12}{top1:>12.3g}{top5:>12.3g}")
+        LOGGER.info(f"{'all':>24}{int(seen.sum()):>12}{top1:>12.3g}{top5:>12.3g}")
         for i, c in model.names.items():
-            acc_i = acc[targets == i]
-            top1i, top5i = acc_i.mean(0).tolist()
-            LOGGER.info(f'{c:>24}{acc_i.shape[0]:>12}{top1i:>12.3g}{top5i:>12.3g}')
+            top1i, top5i = (correct[i] / seen[i]).tolist()
+            LOGGER.info(f'{c:>24}{int(seen[i]):>12}{top1i:>12.3g}{top5i:>12.3g}')
 
         # Print results
         t = tuple(x.t / len(dataloader.dataset.samples) * 1E3 for x in dt)  # speeds per image
@@ -14,6 +14,21 @@ class Settings(BaseSettings):
     CONF_THRES: float = 0 # confidence threshold
     IOU_THRES: float = 0.65 # NMS IOU threshold
     FRAME_RATE: int = 1 # Frame per second
+    FAST_START: bool = True # load the model in background during the sim wait and camera probe
+    MODEL_CACHE: str = os.path.join(RESOURCES, 'weight_init', 'cache') # fused model snapshots keyed by weight hash
+    MODEL_CACHE_FORMAT: str = 'torchscript' # snapshot format, 'torchscript', 'onnx' or '' to disable
+    DETECT_CACHE: bool = False # reuse detections of near-identical frames, bypassed while fire or smoke is detected
+    DETECT_CACHE_SIZE: int = 32 # max cached frames
+    DETECT_CACHE_TTL: float = 5 # seconds a cached result stays valid
+    DETECT_CACHE_MAX_HITS: int = 4 # consecutive cached frames before a forced inference, 0 for no cap
+    # worst-case delay of a new fire or smoke detection: min(TTL, MAX_HITS / FRAME_RATE) seconds, 4 s by default
+    DETECT_CACHE_TOLERANCE: int = 4 # max differing bits of the 256-bit frame hash
+    VERIFIER_WEIGHTS: str = '' # classify/ model verifying low confidence detections, '' to disable
+    VERIFIER_CLASSES: list = ['Fire', 'Smoke'] # detection labels to verify
+    VERIFIER_CONF: float = 0.6 # verify detections below this confidence
+    VERIFIER_ACCEPT: float = 0.5 # min classifier probability of the detected label to keep a detection
+    VERIFIER_MAX_CROPS: int = 8 # max detections verified per frame, bounds the added latency
+    VERIFIER_IMGSZ: int = 224 # classifier input size
 
 settings = Settings()
 settings.IMAGE_FOLDER: str = os.path.join(settings.RESOURCES, 'images')
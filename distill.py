@@ -0,0 +1,286 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Train a small YOLOv5 detection student by knowledge distillation from a large frozen detection teacher, with soft-label,
+box and feature imitation losses on top of the regular YOLOv5 loss
+
+Usage:
+    $ python distill.py --teacher yolov5l.pt --cfg yolov5n.yaml --data data.yaml --epochs 100 --img 640
+    $ python distill.py --teacher yolov5l.pt --cfg yolov5n.yaml --data data.yaml --cache-teacher
+"""
+
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+from torch.optim import lr_scheduler
+from tqdm import tqdm
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from models.experimental import attempt_load
+from models.yolo import DetectionModel, SegmentationModel
+from utils.dataloaders import create_dataloader, get_hash
+from utils.general import (LOGGER, TQDM_BAR_FORMAT, check_dataset, check_img_size, check_yaml, colorstr,
+                           increment_path, intersect_dicts, print_args)
+from utils.loss import ComputeLoss
+from utils.metrics import evaluate
+from utils.torch_utils import ModelEMA, select_device, smart_optimizer
+
+
+class TeacherCache:
+    """ Frozen teacher outputs for un-augmented training images, one float16 .npy memmap per output filled on first use.
+    Images letterbox deterministically without augmentation, so the teacher forward pass runs once per image instead of
+    once per epoch, and the cache is reused by later runs with the same images, teacher and image size
+    """
+
+    def __init__(self, path, files):
+        self.dir = Path(path)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.index = {f: i for i, f in enumerate(files)}  # image file to cache row
+        self.n = len(files)
+        f = self.dir / 'done.npy'
+        self.done = np.lib.format.open_memmap(f, mode='r+' if f.exists() else 'w+', dtype=bool, shape=(self.n, ))
+        files = sorted(self.dir.glob('[0-9]*.npy'), key=lambda x: int(x.stem))
+        self.arrays = [np.lib.format.open_memmap(x, mode='r+') for x in files] or None
+
+    def get(self, paths):
+        # Return cached outputs for images paths as a list of float16 tensors, or None if any image is missing
+        i = [self.index[p] for p in paths]
+        if self.arrays is None or not self.done[i].all():
+            return None
+        return [torch.from_numpy(a[i]) for a in self.arrays]
+
+    def put(self, paths, outputs):
+        # Store outputs (list of tensors with images in dim 0) for images paths
+        if self.arrays is None:
+            shapes = [(self.n, *x.shape[1:]) for x in outputs]
+            self.arrays = [
+                np.lib.format.open_memmap(self.dir / f'{k}.npy', mode='w+', dtype=np.float16, shape=shape)
+                for k, shape in enumerate(shapes)]
+        i = [self.index[p] for p in paths]
+        for a, x in zip(self.arrays, outputs):
+            a[i] = x.cpu().half().numpy()
+        self.done[i] = True
+
+    def flush(self):
+        for a in [self.done] + (self.arrays or []):
+            a.flush()
+
+
+def detect_inputs(model):
+    # Record the feature maps entering the Detect() head of model on every forward pass, returns the record list
+    feats = []
+
+    def hook(m, x):
+        feats[:] = list(x[0])  # copy, Detect() replaces list items in place
+
+    model.model[-1].register_forward_pre_hook(hook)
+    return feats
+
+
+def run(
+        teacher=ROOT / 'yolov5l.pt',  # frozen teacher detection model path
+        cfg=ROOT / 'models/yolov5n.yaml',  # student model.yaml path
+        weights='',  # optional initial student weights path
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml',  # hyperparameters path
+        epochs=100,  # total training epochs
+        batch_size=16,  # batch size
+        imgsz=640,  # train, val image size (pixels)
+        temperature=2.0,  # soft-label temperature
+        kd_soft=1.0,  # soft-label loss gain
+        kd_box=1.0,  # box imitation loss gain
+        kd_feat=1.0,  # feature imitation loss gain
+        cache_teacher=False,  # cache teacher outputs on disk, trains without augmentation
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        workers=8,  # max dataloader workers
+        project=ROOT / 'runs/distill',  # save to project/name
+        name='exp',  # save to project/name
+        exist_ok=False,  # existing project/name ok, do not increment
+):
+    prefix = colorstr('Distill:')
+    device = select_device(device, batch_size=batch_size)
+    cuda = device.type != 'cpu'
+    save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)
+    w = save_dir / 'weights'
+    w.mkdir(parents=True, exist_ok=True)
+    last, best = w / 'last.pt', w / 'best.pt'
+
+    # Hyperparameters
+    with open(check_yaml(hyp), errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    hyp.update(kd_soft=kd_soft, kd_box=kd_box, kd_feat=kd_feat)
+    data_dict = check_dataset(data)
+    nc, names = int(data_dict['nc']), data_dict['names']
+
+    # Teacher
+    t_model = attempt_load(teacher, device=device)
+    assert isinstance(t_model, DetectionModel) and not isinstance(t_model, SegmentationModel), \
+        f'{prefix} teacher {teacher} is not a DetectionModel'
+    assert t_model.model[-1].nc == nc, f'{prefix} teacher {teacher} has {t_model.model[-1].nc} classes, data {nc}'
+    t_feats = detect_inputs(t_model)
+
+    # Student, sharing the teacher's anchors so predictions align anchor for anchor
+    model = DetectionModel(cfg, ch=3, nc=nc).to(device)
+    if weights:
+        csd = torch.load(weights, map_location='cpu')['model'].float().state_dict()
+        csd = intersect_dicts(csd, model.state_dict(), exclude=['anchor'])
+        model.load_state_dict(csd, strict=False)
+        LOGGER.info(f'{prefix} transferred {len(csd)}/{len(model.state_dict())} items from {weights}')
+    m, tm = model.model[-1], t_model.model[-1]
+    assert m.stride.tolist() == tm.stride.tolist() and m.anchors.shape == tm.anchors.shape, \
+        f'{prefix} student {cfg} and teacher {teacher} Detect() layers differ'
+    m.anchors.copy_(tm.anchors)
+    gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+    imgsz = check_img_size(imgsz, gs, floor=gs * 2)
+    nl = m.nl
+    hyp['box'] *= 3 / nl  # scale to layers
+    hyp['cls'] *= nc / 80 * 3 / nl  # scale to classes and layers
+    hyp['obj'] *= (imgsz / 640) ** 2 * 3 / nl  # scale to image size and layers
+    model.nc, model.hyp, model.names = nc, hyp, names
+
+    # Dataloaders
+    train_loader, dataset = create_dataloader(data_dict['train'],
+                                              imgsz,
+                                              batch_size,
+                                              gs,
+                                              hyp=hyp,
+                                              augment=not cache_teacher,  # deterministic inputs for cached outputs
+                                              workers=workers,
+                                              shuffle=True,
+                                              prefix=colorstr('train: '))
+    val_loader = create_dataloader(data_dict['val'], imgsz, batch_size * 2, gs, pad=0.5, rect=True, workers=workers,
+                                   prefix=colorstr('val: '))[0]
+    cache = None
+    if cache_teacher:
+        h = get_hash(dataset.im_files + [str(teacher), str(imgsz)])[:8]
+        cache = TeacherCache(Path(dataset.label_files[0]).parent.with_suffix(f'.teacher-{h}'), dataset.im_files)
+        LOGGER.info(f'{prefix} caching teacher outputs to {cache.dir}, {cache.done.sum()}/{cache.n} cached')
+
+    # Optimizer
+    optimizer = smart_optimizer(model, 'SGD', hyp['lr0'], hyp['momentum'], hyp['weight_decay'])
+    lf = lambda x: (1 - x / epochs) * (1.0 - hyp['lrf']) + hyp['lrf']  # linear
+    scheduler = lr_scheduler.LambdaLR(optimizer, lr_lambda=lf)
+    ema = ModelEMA(model)
+    s_feats = detect_inputs(model)  # after EMA copy, saved checkpoints carry no hooks
+    scaler = torch.cuda.amp.GradScaler(enabled=cuda)
+    compute_loss = ComputeLoss(model)
+
+    # Train
+    nb = len(train_loader)  # number of batches
+    nw = max(round(hyp['warmup_epochs'] * nb), 100)  # number of warmup iterations
+    best_fitness, t0 = 0.0, time.time()
+    LOGGER.info(f'{prefix} {teacher} teacher to {cfg} student for {epochs} epochs\n'
+                f"Logging results to {colorstr('bold', save_dir)}")
+    for epoch in range(epochs):
+        model.train()
+        mloss = torch.zeros(6, device=device)  # mean losses
+        LOGGER.info(('\n' + '%11s' * 8) %
+                    ('Epoch', 'box_loss', 'obj_loss', 'cls_loss', 'kd_soft', 'kd_box', 'kd_feat', 'Instances'))
+        pbar = tqdm(enumerate(train_loader), total=nb, bar_format=TQDM_BAR_FORMAT)
+        for i, (imgs, targets, paths, _) in pbar:
+            ni = i + nb * epoch  # number integrated batches (since train start)
+            imgs = imgs.to(device, non_blocking=True).float() / 255
+
+            # Warmup
+            if ni <= nw:
+                xi = [0, nw]  # x interp
+                for j, x in enumerate(optimizer.param_groups):
+                    x['lr'] = np.interp(ni, xi, [hyp['warmup_bias_lr'] if j == 0 else 0.0, x['initial_lr'] * lf(epoch)])
+                    if 'momentum' in x:
+                        x['momentum'] = np.interp(ni, xi, [hyp['warmup_momentum'], hyp['momentum']])
+
+            # Teacher
+            t_out = cache.get(paths) if cache else None
+            if t_out is None:
+                with torch.no_grad(), torch.cuda.amp.autocast(cuda):
+                    tp = t_model(imgs)[1]  # raw (bs,na,ny,nx,no) predictions per layer
+                    t_out = tp + [ComputeLoss.attention(f) for f in t_feats]
+                if cache:
+                    cache.put(paths, t_out)
+            tp, tatt = t_out[:nl], t_out[nl:]
+
+            # Student
+            with torch.cuda.amp.autocast(cuda):
+                pred = model(imgs)
+                loss, loss_items = compute_loss(pred, targets.to(device))
+                kd, kd_items = compute_loss.distill(pred, tp, s_feats, tatt, T=temperature)
+            scaler.scale(loss + kd).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10.0)
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            ema.update(model)
+
+            mloss = (mloss * i + torch.cat((loss_items, kd_items))) / (i + 1)  # update mean losses
+            pbar.set_description(('%11s' + '%11.4g' * 7) % (f'{epoch}/{epochs - 1}', *mloss, targets.shape[0]))
+        scheduler.step()
+        if cache:
+            cache.flush()
+
+        # Validate and save
+        ema.update_attr(model, include=['yaml', 'nc', 'hyp', 'names', 'stride'])
+        map50, map = evaluate(ema.ema, val_loader, device)
+        fi = 0.1 * map50 + 0.9 * map  # fitness
+        LOGGER.info(f'{prefix} epoch {epoch} mAP50 {map50:.3g}, mAP50-95 {map:.3g}')
+        ckpt = {
+            'epoch': epoch,
+            'best_fitness': max(best_fitness, fi),
+            'model': deepcopy(ema.ema).half(),
+            'ema': None,
+            'teacher': str(teacher),
+            'date': datetime.now().isoformat()}
+        torch.save(ckpt, last)
+        if fi >= best_fitness:
+            best_fitness = fi
+            torch.save(ckpt, best)
+
+    LOGGER.info(f'\n{epochs} epochs completed in {(time.time() - t0) / 3600:.3f} hours.\n'
+                f"Results saved to {colorstr('bold', save_dir)}")
+    return best
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teacher', type=str, default=ROOT / 'yolov5l.pt', help='frozen teacher model path')
+    parser.add_argument('--cfg', type=str, default=ROOT / 'models/yolov5n.yaml', help='student model.yaml path')
+    parser.add_argument('--weights', type=str, default='', help='initial student weights path')
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
+    parser.add_argument('--hyp', type=str, default=ROOT / 'data/hyps/hyp.scratch-low.yaml', help='hyperparameters path')
+    parser.add_argument('--epochs', type=int, default=100, help='total training epochs')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='train, val image size (pixels)')
+    parser.add_argument('--temperature', type=float, default=2.0, help='soft-label temperature')
+    parser.add_argument('--kd-soft', type=float, default=1.0, help='soft-label loss gain')
+    parser.add_argument('--kd-box', type=float, default=1.0, help='box imitation loss gain')
+    parser.add_argument('--kd-feat', type=float, default=1.0, help='feature imitation loss gain')
+    parser.add_argument('--cache-teacher', action='store_true', help='cache teacher outputs on disk, no augmentation')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--project', default=ROOT / 'runs/distill', help='save to project/name')
+    parser.add_argument('--name', default='exp', help='save to project/name')
+    parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
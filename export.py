@@ -23,6 +23,7 @@ Requirements:
 
 Usage:
     $ python export.py --weights yolov5s.pt --include torchscript onnx openvino engine coreml tflite ...
+    $ python export.py --weights yolov5s.pt --include onnx --int8 --calib data/dataset_test --int8-val data.yaml
 
 Inference:
     $ python detect.py --weights yolov5s.pt                 # PyTorch
@@ -46,9 +47,11 @@ TensorFlow.js:
 
 import argparse
 import contextlib
+import glob
 import json
 import os
 import platform
+import random
 import re
 import subprocess
 import sys
@@ -56,6 +59,8 @@ import time
 import warnings
 from pathlib import Path
 
+import cv2
+import numpy as np
 import pandas as pd
 import torch
 from torch.utils.mobile_optimizer import optimize_for_mobile
@@ -69,7 +74,8 @@ if platform.system() != 'Windows':
 
 from models.experimental import attempt_load
 from models.yolo import ClassificationModel, Detect, DetectionModel, SegmentationModel
-from utils.dataloaders import LoadImages
+from utils.augmentations import LetterBoxBatch
+from utils.dataloaders import IMG_FORMATS, LoadImages
 from utils.general import (LOGGER, Profile, check_dataset, check_img_size, check_requirements, check_version,
                            check_yaml, colorstr, file_size, get_default_args, print_args, url2file, yaml_save)
 from utils.torch_utils import select_device, smart_inference_mode
@@ -205,7 +211,204 @@ def export_onnx(model, im, file, opset, dynamic, simplify, prefix=colorstr('ONNX
 
 
 @try_export
-def export_openvino(file, metadata, half, int8, data, prefix=colorstr('OpenVINO:')):
+def export_onnx_nms(f, nc, nm=0, iou_thres=0.45, topk_per_class=300, topk_all=300, prefix=colorstr('ONNX NMS:')):
+    # Append box decoding, per-class score thresholds, NonMaxSuppression and top-K to an exported ONNX model, in place.
+    # Inputs images and conf_thres (nc,), outputs detections (n,7+nm) [image, xyxy, conf, cls, masks] sorted by conf
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    LOGGER.info(f'\n{prefix} starting with onnx {onnx.__version__}...')
+    model = onnx.load(f)
+    graph = model.graph
+    y = 'output0'  # (b, anchors, 5+nc+nm) xywh, obj, cls, masks
+
+    def const(name, v, dtype=np.int64):
+        graph.initializer.append(numpy_helper.from_array(np.array(v, dtype=dtype), f'nms/{name}'))
+        return f'nms/{name}'
+
+    def node(op, inputs, name, **kwargs):
+        graph.node.append(helper.make_node(op, inputs, [f'nms/{name}'], name=f'nms/{name}', **kwargs))
+        return f'nms/{name}'
+
+    def cols(x, a, b, axis, name):
+        return node('Slice', [x, const(f'{name}_a', [a]), const(f'{name}_b', [b]), const(f'{name}_axis', [axis])], name)
+
+    # Best class conf = obj * cls, per-class thresholds, as non_max_suppression() (conf > thres implies obj > thres)
+    scores = node('Mul', [cols(y, 5, 5 + nc, 2, 'cls'), cols(y, 4, 5, 2, 'obj')], 'scores')  # (b, anchors, nc)
+    best = node('ArgMax', [scores], 'best', axis=2, keepdims=0)  # best class only
+    best = node('OneHot', [best, const('nc', [nc]), const('onehot', [0.0, 1.0], np.float32)], 'best_onehot')
+    scores = node('Mul', [scores, best], 'scores_best')
+    keep = node('Greater', [scores, 'conf_thres'], 'keep')
+    scores = node('Where', [keep, scores, const('zero', 0.0, np.float32)], 'scores_thres')
+    scores = node('Transpose', [scores], 'sc', perm=[0, 2, 1])  # (b, nc, anchors)
+
+    # NMS per image and class, up to topk_per_class boxes each
+    i = node('NonMaxSuppression', [
+        cols(y, 0, 4, 2, 'xywh'), scores,
+        const('max_per_class', [topk_per_class]),
+        const('iou', [iou_thres], np.float32),
+        const('score', [0.0], np.float32)], 'selected', center_point_box=1)  # (k, 3) image, class, anchor
+    conf = node('GatherND', [scores, i], 'conf')
+    image = node('Gather', [i, const('c0', 0)], 'image', axis=1)
+    cls = node('Gather', [i, const('c1', 1)], 'class', axis=1)
+    rows = node('GatherND', [y, node('Gather', [i, const('c02', [0, 2])], 'image_anchor', axis=1)], 'rows_nms')
+    xy, wh = cols(rows, 0, 2, 1, 'xy'), node('Div', [cols(rows, 2, 4, 1, 'wh'), const('two', 2.0, np.float32)], 'wh2')
+    column = const('column', [-1, 1])
+    x = [
+        node('Cast', [node('Reshape', [image, column], 'image_col')], 'image_f', to=TensorProto.FLOAT),
+        node('Sub', [xy, wh], 'xy1'),
+        node('Add', [xy, wh], 'xy2'),
+        node('Reshape', [conf, column], 'conf_col'),
+        node('Cast', [node('Reshape', [cls, column], 'class_col')], 'class_f', to=TensorProto.FLOAT)]
+    if nm:
+        x.append(cols(rows, 5 + nc, 5 + nc + nm, 1, 'masks'))
+    x = node('Concat', x, 'dets', axis=1)
+
+    # Sort by confidence with TopK, then keep the first topk_all detections of each image by a running per-image count
+    graph.node.append(helper.make_node('TopK', [conf, node('Shape', [conf], 'k')], ['nms/topk_conf', 'nms/order'],
+                                       name='nms/topk'))
+    image = node('Gather', [image, 'nms/order'], 'image_sorted', axis=0)
+    b = cols(node('Shape', [y], 'y_shape'), 0, 1, 0, 'batch')
+    count = node('OneHot', [image, b, const('count_values', [0, 1])], 'image_onehot')  # (k, b)
+    count = node('CumSum', [count, const('c0_axis', 0)], 'image_count')
+    count = node('GatherElements', [count, node('Reshape', [image, column], 'image_sorted_col')], 'rank', axis=1)
+    keep = node('Less', [node('Reshape', [count, const('row', [-1])], 'rank_row'), const('topk_all', topk_all + 1)],
+                'topk_keep')
+    order = node('Compress', ['nms/order', keep], 'order_keep', axis=0)
+    graph.node.append(helper.make_node('Gather', [x, order], ['detections'], name='nms/detections', axis=0))
+
+    # Inputs and outputs
+    graph.input.append(helper.make_tensor_value_info('conf_thres', TensorProto.FLOAT, [nc]))
+    outputs = [helper.make_tensor_value_info('detections', TensorProto.FLOAT, ['detections', 7 + nm])]
+    outputs += [x for x in graph.output if x.name != y]  # keep segmentation protos
+    del graph.output[:]
+    graph.output.extend(outputs)
+    meta = model.metadata_props.add()
+    meta.key, meta.value = 'nms', 'True'
+    onnx.checker.check_model(model)
+    onnx.save(model, f)
+    return f, model
+
+
+def calibration_images(source, n=300, imgsz=(640, 640), stride=32, seed=0):
+    # Yield up to n letterboxed (1,3,h,w) float32 numpy images sampled from image folders or a dataset.yaml train split
+    if str(source).endswith(('.yaml', '.yml')):
+        source = check_dataset(check_yaml(source))['train']
+    files = []
+    for p in source if isinstance(source, (list, tuple)) else [source]:
+        p = Path(p)
+        if p.suffix == '.txt':  # list of image paths
+            files += [str(p.parent / x.strip()) for x in p.read_text().splitlines() if x.strip()]
+        else:  # directory, searched recursively
+            files += glob.glob(str(p / '**' / '*.*'), recursive=True)
+    files = sorted(x for x in files if x.split('.')[-1].lower() in IMG_FORMATS)
+    assert files, f'No calibration images found in {source}'
+    preprocess = LetterBoxBatch(imgsz, stride, buffers=1)
+    for f in random.Random(seed).sample(files, min(n, len(files))):
+        im = cv2.imread(f)  # BGR
+        if im is not None:
+            yield preprocess([im])[0].numpy().copy()
+
+
+@try_export
+def export_onnx_int8(file, data, imgsz, stride, head, n=300, prefix=colorstr('ONNX INT8:')):
+    # YOLOv5 ONNX Runtime static INT8 (QDQ) post-training quantization, calibrated on images from `data`
+    check_requirements('onnxruntime')
+    import onnx
+    import onnxruntime
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    LOGGER.info(f'\n{prefix} starting export with onnxruntime {onnxruntime.__version__}...')
+    f_onnx = file.with_suffix('.onnx')
+    f_pre = file.with_name(f'{file.stem}-int8-pre.onnx')
+    f = file.with_name(f'{file.stem}-int8.onnx')
+    quant_pre_process(str(f_onnx), str(f_pre), skip_symbolic_shape=True)  # shape inference and graph cleanup
+
+    class Reader(CalibrationDataReader):
+
+        def __init__(self):
+            self.images = calibration_images(data, n, imgsz, stride)
+
+        def get_next(self):
+            return next(({'images': x} for x in self.images), None)
+
+    # Keep Detect() box decoding (grid, anchor and stride arithmetic) in FP32, only its convolutions are quantized
+    exclude = [x.name for x in onnx.load(f_pre).graph.node if x.name.startswith(head) and x.op_type != 'Conv']
+    quantize_static(str(f_pre),
+                    str(f),
+                    Reader(),
+                    quant_format=QuantFormat.QDQ,
+                    per_channel=True,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8,
+                    calibrate_method=CalibrationMethod.MinMax,
+                    nodes_to_exclude=exclude)
+    f_pre.unlink()
+
+    # Metadata
+    model_onnx, model_fp32 = onnx.load(f), onnx.load(f_onnx)
+    del model_onnx.metadata_props[:]
+    model_onnx.metadata_props.extend(model_fp32.metadata_props)  # stride, names
+    onnx.save(model_onnx, f)
+    return f, model_onnx
+
+
+@smart_inference_mode()
+def int8_report(fp32, int8, data, imgsz=(640, 640), n=200, prefix=colorstr('INT8:')):
+    # Per-class mAP@0.5 of INT8 vs FP32 models on a dataset.yaml val split or image folder, against its labels if any,
+    # else against the FP32 model's conf>0.25 detections (agreement)
+    from models.common import DetectMultiBackend
+    from utils.dataloaders import create_dataloader
+    from utils.general import non_max_suppression, xywh2xyxy
+    from utils.metrics import ap_per_class, process_batch
+
+    models = [DetectMultiBackend(w, device=torch.device('cpu')) for w in (fp32, int8)]
+    names, stride = models[0].names, models[0].stride
+    path = check_dataset(check_yaml(data))['val'] if str(data).endswith(('.yaml', '.yml')) else data
+    dataset = create_dataloader(path, imgsz[0], 1, stride, pad=0.5, rect=False, workers=0)[1]
+    labelled = any(len(x) for x in dataset.labels)
+    iouv = torch.linspace(0.5, 0.95, 10)
+    stats, dt = [[], []], [Profile(), Profile()]
+    for k in random.Random(0).sample(range(len(dataset)), min(n, len(dataset))):
+        im, targets = dataset[k][:2]
+        im = im[None].float() / 255
+        h, w = im.shape[2:]
+        preds = []
+        for model, t in zip(models, dt):
+            with t:
+                preds.append(non_max_suppression(model(im), 0.001, 0.6, max_det=300)[0])
+        if labelled:
+            labels = torch.cat((targets[:, 1:2], xywh2xyxy(targets[:, 2:] * torch.tensor((w, h, w, h)))), 1)
+        else:  # FP32 detections as reference
+            ref = preds[0][preds[0][:, 4] > 0.25]
+            labels = torch.cat((ref[:, 5:6], ref[:, :4]), 1)
+        for pred, st in zip(preds, stats):
+            correct = process_batch(pred, labels, iouv) if len(labels) else torch.zeros(len(pred), 10, dtype=torch.bool)
+            st.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))
+
+    ap50 = []
+    for st in stats:
+        tp, conf, pcls, tcls = (torch.cat(x, 0).numpy() for x in zip(*st))
+        nt = np.bincount(tcls.astype(int), minlength=len(names))
+        *_, ap, ap_class = ap_per_class(tp, conf, pcls, tcls, names=names)
+        ap50.append(dict(zip(ap_class.tolist(), ap[:, 0].tolist())))
+    ref = 'labels' if labelled else 'FP32 detections'
+    LOGGER.info(f'\n{prefix} per-class mAP@0.5 against {ref} on {min(n, len(dataset))} images from {path}')
+    LOGGER.info(('%22s' + '%11s' * 4) % ('Class', 'Instances', 'FP32', 'INT8', 'delta'))
+    a, b = (np.mean(list(x.values())) if x else 0.0 for x in ap50)
+    LOGGER.info(('%22s' + '%11i' + '%11.3g' * 3) % ('all', nt.sum(), a, b, b - a))
+    for c in sorted(set(ap50[0]) | set(ap50[1])):
+        a, b = ap50[0].get(c, 0.0), ap50[1].get(c, 0.0)
+        LOGGER.info(('%22s' + '%11i' + '%11.3g' * 3) % (names[c], nt[c], a, b, b - a))
+    t = [x.t * 1E3 / max(min(n, len(dataset)), 1) for x in dt]
+    LOGGER.info(f'{prefix} {t[0]:.1f}ms FP32, {t[1]:.1f}ms INT8 inference + NMS per image ({t[0] / t[1]:.2f}x)')
+    return ap50
+
+
+@try_export
+def export_openvino(file, metadata, half, int8, data, imgsz=(640, 640), n=300, prefix=colorstr('OpenVINO:')):
     # YOLOv5 OpenVINO export
     check_requirements('openvino-dev>=2023.0')  # requires openvino-dev: https://pypi.org/project/openvino-dev/
     import openvino.runtime as ov  # noqa
@@ -218,50 +421,15 @@ def export_openvino(file, metadata, half, int8, data, prefix=colorstr('OpenVINO:
     if int8:
         check_requirements('nncf>=2.4.0')  # requires at least version 2.4.0 to use the post-training quantization
         import nncf
-        import numpy as np
         from openvino.runtime import Core
 
-        from utils.dataloaders import create_dataloader
         core = Core()
         onnx_model = core.read_model(f_onnx)  # export
-
-        def prepare_input_tensor(image: np.ndarray):
-            input_tensor = image.astype(np.float32)  # uint8 to fp16/32
-            input_tensor /= 255.0  # 0 - 255 to 0.0 - 1.0
-
-            if input_tensor.ndim == 3:
-                input_tensor = np.expand_dims(input_tensor, 0)
-            return input_tensor
-
-        def gen_dataloader(yaml_path, task='train', imgsz=640, workers=4):
-            data_yaml = check_yaml(yaml_path)
-            data = check_dataset(data_yaml)
-            dataloader = create_dataloader(data[task],
-                                           imgsz=imgsz,
-                                           batch_size=1,
-                                           stride=32,
-                                           pad=0.5,
-                                           single_cls=False,
-                                           rect=False,
-                                           workers=workers)[0]
-            return dataloader
-
-        # noqa: F811
-
-        def transform_fn(data_item):
-            """
-            Quantization transform function. Extracts and preprocess input data from dataloader item for quantization.
-            Parameters:
-               data_item: Tuple with data item produced by DataLoader during iteration
-            Returns:
-                input_tensor: Input data for quantization
-            """
-            img = data_item[0].numpy()
-            input_tensor = prepare_input_tensor(img)
-            return input_tensor
-
-        ds = gen_dataloader(data)
-        quantization_dataset = nncf.Dataset(ds, transform_fn)
+        images = list(calibration_images(data, n, imgsz, int(metadata['stride'])))
+        if 'conf_thres' in {k for x in onnx_model.inputs for k in x.get_names()}:  # --nms model, feed both inputs
+            conf_thres = np.full(len(metadata['names']), 0.001, dtype=np.float32)
+            images = [{'images': im, 'conf_thres': conf_thres} for im in images]
+        quantization_dataset = nncf.Dataset(images)
         ov_model = nncf.quantize(onnx_model, quantization_dataset, preset=nncf.QuantizationPreset.MIXED)
     else:
         ov_model = mo.convert_model(f_onnx, model_name=file.stem, framework='onnx', compress_to_fp16=half)  # export
@@ -707,17 +875,21 @@ def run(
         inplace=False,  # set YOLOv5 Detect() inplace=True
         keras=False,  # use Keras
         optimize=False,  # TorchScript: optimize for mobile
-        int8=False,  # CoreML/TF INT8 quantization
+        int8=False,  # CoreML/TF/OpenVINO/ONNX INT8 quantization
+        calib=None,  # OpenVINO/ONNX INT8: calibration image folder or dataset.yaml, defaults to data
+        calib_n=300,  # OpenVINO/ONNX INT8: number of calibration images
+        int8_val=None,  # OpenVINO/ONNX INT8: dataset.yaml or image folder for the per-class FP32 vs INT8 report
         dynamic=False,  # ONNX/TF/TensorRT: dynamic axes
         simplify=False,  # ONNX: simplify model
         opset=12,  # ONNX: opset version
         verbose=False,  # TensorRT: verbose log
         workspace=4,  # TensorRT: workspace size (GB)
-        nms=False,  # TF: add NMS to model
+        nms=False,  # TF/ONNX/OpenVINO: add NMS to model
         agnostic_nms=False,  # TF: add agnostic NMS to model
-        topk_per_class=100,  # TF.js NMS: topk per class to keep
-        topk_all=100,  # TF.js NMS: topk for all classes to keep
-        iou_thres=0.45,  # TF.js NMS: IoU threshold
+        topk_per_class=None,  # TF.js/ONNX NMS: topk per class to keep, default 100 TF.js, max_det ONNX
+        topk_all=None,  # TF.js/ONNX NMS: topk for all classes to keep, default 100 TF.js, max_det ONNX
+        max_det=300,  # ONNX/OpenVINO NMS: maximum detections per image, per class and in total
+        iou_thres=0.45,  # TF.js/ONNX NMS: IoU threshold
         conf_thres=0.25,  # TF.js NMS: confidence threshold
 ):
     t = time.time()
@@ -770,8 +942,18 @@ def run(
         f[1], _ = export_engine(model, im, file, half, dynamic, simplify, workspace, verbose)
     if onnx or xml:  # OpenVINO requires ONNX
         f[2], _ = export_onnx(model, im, file, opset, dynamic, simplify)
+    if onnx and int8 and f[2]:  # ONNX Runtime INT8 (QDQ)
+        head = f'/model.{len(model.model) - 1}/'  # Detect() node name prefix
+        f.append(export_onnx_int8(file, calib or data, imgsz, gs, head, calib_n)[0])
+    if (onnx or xml) and nms and f[2]:  # in-graph NMS, before OpenVINO conversion
+        assert not isinstance(model, ClassificationModel), 'ClassificationModel has no NMS'
+        m = model.model[-1]  # Detect()
+        for x in f[2], f[-1] if len(f) > len(fmts) else None:
+            if x:
+                export_onnx_nms(x, m.nc, getattr(m, 'nm', 0), iou_thres, topk_per_class or max_det,
+                                topk_all or max_det)
     if xml:  # OpenVINO
-        f[3], _ = export_openvino(file, metadata, half, int8, data)
+        f[3], _ = export_openvino(file, metadata, half, int8, calib or data, imgsz, calib_n)
     if coreml:  # CoreML
         f[4], ct_model = export_coreml(model, im, file, int8, half, nms)
         if nms:
@@ -785,8 +967,8 @@ def run(
                                            dynamic,
                                            tf_nms=nms or agnostic_nms or tfjs,
                                            agnostic_nms=agnostic_nms or tfjs,
-                                           topk_per_class=topk_per_class,
-                                           topk_all=topk_all,
+                                           topk_per_class=topk_per_class or 100,
+                                           topk_all=topk_all or 100,
                                            iou_thres=iou_thres,
                                            conf_thres=conf_thres,
                                            keras=keras)
@@ -802,6 +984,11 @@ def run(
     if paddle:  # PaddlePaddle
         f[10], _ = export_paddle(model, im, file, metadata)
 
+    if int8 and int8_val and f[2]:  # per-class accuracy delta vs FP32 ONNX
+        for x in f[3], f[-1] if len(f) > len(fmts) else None:
+            if x:
+                int8_report(f[2], x, int8_val, imgsz)
+
     # Finish
     f = [str(x) for x in f if x]  # filter out '' and None
     if any(f):
@@ -831,17 +1018,21 @@ def parse_opt(known=False):
     parser.add_argument('--inplace', action='store_true', help='set YOLOv5 Detect() inplace=True')
     parser.add_argument('--keras', action='store_true', help='TF: use Keras')
     parser.add_argument('--optimize', action='store_true', help='TorchScript: optimize for mobile')
-    parser.add_argument('--int8', action='store_true', help='CoreML/TF/OpenVINO INT8 quantization')
+    parser.add_argument('--int8', action='store_true', help='CoreML/TF/OpenVINO/ONNX INT8 quantization')
+    parser.add_argument('--calib', type=str, default=None, help='OpenVINO/ONNX INT8: calibration images or data.yaml')
+    parser.add_argument('--calib-n', type=int, default=300, help='OpenVINO/ONNX INT8: number of calibration images')
+    parser.add_argument('--int8-val', type=str, default=None, help='OpenVINO/ONNX INT8: FP32 vs INT8 report dataset')
     parser.add_argument('--dynamic', action='store_true', help='ONNX/TF/TensorRT: dynamic axes')
     parser.add_argument('--simplify', action='store_true', help='ONNX: simplify model')
     parser.add_argument('--opset', type=int, default=17, help='ONNX: opset version')
     parser.add_argument('--verbose', action='store_true', help='TensorRT: verbose log')
     parser.add_argument('--workspace', type=int, default=4, help='TensorRT: workspace size (GB)')
-    parser.add_argument('--nms', action='store_true', help='TF: add NMS to model')
+    parser.add_argument('--nms', action='store_true', help='TF/ONNX/OpenVINO: add NMS to model')
     parser.add_argument('--agnostic-nms', action='store_true', help='TF: add agnostic NMS to model')
-    parser.add_argument('--topk-per-class', type=int, default=100, help='TF.js NMS: topk per class to keep')
-    parser.add_argument('--topk-all', type=int, default=100, help='TF.js NMS: topk for all classes to keep')
-    parser.add_argument('--iou-thres', type=float, default=0.45, help='TF.js NMS: IoU threshold')
+    parser.add_argument('--topk-per-class', type=int, help='TF.js/ONNX NMS: topk per class, default 100/max-det')
+    parser.add_argument('--topk-all', type=int, help='TF.js/ONNX NMS: topk all classes, default 100/max-det')
+    parser.add_argument('--max-det', type=int, default=300, help='ONNX/OpenVINO NMS: maximum detections per image')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='TF.js/ONNX NMS: IoU threshold')
     parser.add_argument('--conf-thres', type=float, default=0.25, help='TF.js NMS: confidence threshold')
     parser.add_argument(
         '--include',
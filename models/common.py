@@ -8,9 +8,11 @@ import contextlib
 import json
 import math
 import platform
+import queue
+import threading
 import warnings
 import zipfile
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, deque, namedtuple
 from copy import copy
 from pathlib import Path
 from urllib.parse import urlparse
@@ -38,10 +40,11 @@ except (ImportError, AssertionError):
 from ultralytics.utils.plotting import Annotator, colors, save_one_box
 
 from utils import TryExcept
-from utils.dataloaders import exif_transpose, letterbox
-from utils.general import (LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version, colorstr,
-                           increment_path, is_jupyter, make_divisible, non_max_suppression, scale_boxes, xywh2xyxy,
-                           xyxy2xywh, yaml_load)
+from utils.augmentations import LetterBoxBatch
+from utils.dataloaders import exif_transpose
+from utils.general import (LOGGER, ORT_OPT, ORT_THREADS, ROOT, NMSOutput, Profile, check_requirements,
+                           check_suffix, check_version, colorstr, increment_path, is_jupyter, make_divisible,
+                           non_max_suppression, scale_boxes, xywh2xyxy, xyxy2xywh, yaml_load)
 from utils.torch_utils import copy_attr, smart_inference_mode
 
 
@@ -326,7 +329,15 @@ class Concat(nn.Module):
 
 class DetectMultiBackend(nn.Module):
     # YOLOv5 MultiBackend class for python inference on various backends
-    def __init__(self, weights='yolov5s.pt', device=torch.device('cpu'), dnn=False, data=None, fp16=False, fuse=True):
+    def __init__(self,
+                 weights='yolov5s.pt',
+                 device=torch.device('cpu'),
+                 dnn=False,
+                 data=None,
+                 fp16=False,
+                 fuse=True,
+                 ort_threads=ORT_THREADS,
+                 ort_opt=ORT_OPT):
         # Usage:
         #   PyTorch:              weights = *.pt
         #   TorchScript:                    *.torchscript
@@ -349,6 +360,8 @@ class DetectMultiBackend(nn.Module):
         nhwc = coreml or saved_model or pb or tflite or edgetpu  # BHWC formats (vs torch BCWH)
         stride = 32  # default stride
         cuda = torch.cuda.is_available() and device.type != 'cpu'  # use CUDA
+        end2end = False  # in-graph NMS, i.e. export.py --include onnx openvino --nms
+        conf_thres = 0.001  # in-graph NMS score threshold, scalar or per-class list
         if not (pt or triton):
             w = attempt_download(w)  # download if not local
 
@@ -378,8 +391,22 @@ class DetectMultiBackend(nn.Module):
             check_requirements(('onnx', 'onnxruntime-gpu' if cuda else 'onnxruntime'))
             import onnxruntime
             providers = ['CUDAExecutionProvider', 'CPUExecutionProvider'] if cuda else ['CPUExecutionProvider']
-            session = onnxruntime.InferenceSession(w, providers=providers)
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = ort_threads  # 0 for ONNX Runtime default
+            options.inter_op_num_threads = 1  # YOLOv5 graphs are sequential
+            options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+            options.graph_optimization_level = {
+                'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+                'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+                'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+                'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL}[ort_opt]
+            session = onnxruntime.InferenceSession(w, sess_options=options, providers=providers)
             output_names = [x.name for x in session.get_outputs()]
+            io_local = threading.local()  # per-thread IO binding and output buffers
+            io_device = device if 'CUDAExecutionProvider' in session.get_providers() else torch.device('cpu')
+            io_count = 0  # reused output buffer sets, outputs stay valid for io_count - 1 further calls, 0 for owned
+            io_types = {torch.float32: np.float32, torch.float16: np.float16}
+            end2end = 'detections' in output_names
             meta = session.get_modelmeta().custom_metadata_map  # metadata
             if 'stride' in meta:
                 stride, names = int(meta['stride']), eval(meta['names'])
@@ -397,6 +424,7 @@ class DetectMultiBackend(nn.Module):
             if batch_dim.is_static:
                 batch_size = batch_dim.get_length()
             ov_compiled_model = core.compile_model(ov_model, device_name='AUTO')  # AUTO selects best available device
+            end2end = 'conf_thres' in {n for x in ov_model.inputs for n in x.get_names()}
             stride, names = self._load_metadata(Path(w).with_suffix('.yaml'))  # load metadata
         elif engine:  # TensorRT
             LOGGER.info(f'Loading {w} for TensorRT inference...')
@@ -531,11 +559,14 @@ class DetectMultiBackend(nn.Module):
             im = im.cpu().numpy()  # torch to numpy
             self.net.setInput(im)
             y = self.net.forward()
+        elif self.onnx and self.end2end:  # ONNX Runtime with in-graph NMS, variable output shape
+            y = self.session.run(self.output_names, {'images': im.cpu().numpy(), 'conf_thres': self._conf_thres()})
         elif self.onnx:  # ONNX Runtime
-            im = im.cpu().numpy()  # torch to numpy
-            y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
+            y = self._ort_run(im)
         elif self.xml:  # OpenVINO
             im = im.cpu().numpy()  # FP32
+            if self.end2end:  # in-graph NMS
+                im = {'images': im, 'conf_thres': self._conf_thres()}
             y = list(self.ov_compiled_model(im).values())
         elif self.engine:  # TensorRT
             if self.dynamic and im.shape != self.bindings['images'].shape:
@@ -592,11 +623,47 @@ class DetectMultiBackend(nn.Module):
             y = [x if isinstance(x, np.ndarray) else x.numpy() for x in y]
             y[0][..., :4] *= [w, h, w, h]  # xywh normalized to pixels
 
+        if self.end2end:  # (n,7+nm) [image, xyxy, conf, cls, masks] to per-image detections
+            y = list(y) if isinstance(y, (list, tuple)) else [y]
+            x = self.from_numpy(y[0])
+            y[0] = NMSOutput(x[x[:, 0] == i, 1:] for i in range(b))
         if isinstance(y, (list, tuple)):
             return self.from_numpy(y[0]) if len(y) == 1 else [self.from_numpy(x) for x in y]
         else:
             return self.from_numpy(y)
 
+    def _conf_thres(self):
+        # In-graph NMS per-class score thresholds (nc,)
+        return np.broadcast_to(np.asarray(self.conf_thres, dtype=np.float32), (len(self.names), )).copy()
+
+    def _ort_run(self, im):
+        # ONNX Runtime inference with IO binding, input bound in place and outputs written into torch tensors
+        local = self.io_local
+        if not hasattr(local, 'io'):
+            local.io, local.buffers = self.session.io_binding(), deque()  # this thread's binding and output buffers
+        im = im.to(self.io_device).contiguous()
+        buffers = local.buffers
+        if not buffers or buffers[-1][0] != im.shape:  # learn output shapes for a new input shape
+            y = [torch.from_numpy(x).to(self.io_device)
+                 for x in self.session.run(self.output_names, {self.session.get_inputs()[0].name: im.cpu().numpy()})]
+            buffers.clear()
+            buffers.append((im.shape, [torch.empty_like(x) for x in y]))  # never the tensors returned here
+            return [x.to(self.device) for x in y]
+        if not self.io_count:  # owned outputs, valid until the caller drops them
+            y = [torch.empty_like(x) for x in buffers[-1][1]]
+        elif len(buffers) < self.io_count:
+            buffers.append((im.shape, [torch.empty_like(x) for x in buffers[-1][1]]))
+            y = buffers[-1][1]
+        else:
+            buffers.rotate(-1)
+            y = buffers[-1][1]
+        d, i = self.io_device.type, self.io_device.index or 0
+        local.io.bind_input(self.session.get_inputs()[0].name, d, i, self.io_types[im.dtype], im.shape, im.data_ptr())
+        for name, x in zip(self.output_names, y):
+            local.io.bind_output(name, d, i, self.io_types[x.dtype], x.shape, x.data_ptr())
+        self.session.run_with_iobinding(local.io)
+        return [x.to(self.device) for x in y]
+
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
@@ -654,10 +721,19 @@ class AutoShape(nn.Module):
             m = self.model.model.model[-1] if self.dmb else self.model.model[-1]  # Detect()
             m.inplace = False  # Detect.inplace=False for safe multithread inference
             m.export = True  # do not output loss values
+        self.preprocess = threading.local()  # per-thread LetterBoxBatch with reused batch buffers
+
+    def __getstate__(self):
+        return {**self.__dict__, 'preprocess': None}  # threading.local() does not pickle or deepcopy
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.preprocess = threading.local()
 
     def _apply(self, fn):
         # Apply to(), cpu(), cuda(), half() to model tensors that are not parameters or registered buffers
         self = super()._apply(fn)
+        self.preprocess = threading.local()  # rebuild for the new dtype and device
         if self.pt:
             m = self.model.model.model[-1] if self.dmb else self.model.model[-1]  # Detect()
             m.stride = fn(m.stride)
@@ -707,9 +783,11 @@ class AutoShape(nn.Module):
                 shape1.append([int(y * g) for y in s])
                 ims[i] = im if im.data.contiguous else np.ascontiguousarray(im)  # update
             shape1 = [make_divisible(x, self.stride) for x in np.array(shape1).max(0)]  # inf shape
-            x = [letterbox(im, shape1, auto=False)[0] for im in ims]  # pad
-            x = np.ascontiguousarray(np.array(x).transpose((0, 3, 1, 2)))  # stack and BHWC to BCHW
-            x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
+            preprocess = getattr(self.preprocess, 'lb', None)
+            if preprocess is None:
+                preprocess = self.preprocess.lb = LetterBoxBatch(
+                    size, bgr=False, dtype=p.dtype, pin_memory=p.device.type != 'cpu', buffers=1)
+            x = preprocess(ims, shape1)[0].to(p.device, non_blocking=True)  # pad, BHWC to BCHW, to fp16/32
 
         with amp.autocast(autocast):
             # Inference
@@ -731,6 +809,120 @@ class AutoShape(nn.Module):
             return Detections(ims, y, files, dt, self.names, x.shape)
 
 
+class DetectPipeline:
+    """ YOLOv5 pipelined inference, i.e. for im0, det in DetectPipeline(DetectMultiBackend('yolov5s.onnx'))(frames)
+    Pre-processing, inference and NMS run in three threads joined by bounded queues, so frame N+1 is letterboxed while
+    frame N is in the model and frame N-1 is in NMS. Pays off for backends that release the GIL during inference, i.e.
+    ONNX Runtime, OpenVINO, TensorRT and PyTorch. Per-stage times accumulate in the self.dt Profile objects.
+    """
+    conf = 0.25  # NMS confidence threshold
+    iou = 0.45  # NMS IoU threshold
+    agnostic = False  # NMS class-agnostic
+    multi_label = False  # NMS multiple labels per box
+    classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
+    max_det = 1000  # maximum number of detections per image
+
+    def __init__(self, model, imgsz=640, batch_size=1, depth=2, threaded=True):
+        self.model = model  # DetectMultiBackend() instance
+        self.batch_size = batch_size
+        self.depth = depth  # batches queued between stages
+        self.threaded = threaded  # False to run the stages serially in the calling thread
+        dtype = torch.half if model.fp16 else torch.float
+        pin = model.device.type != 'cpu'
+        # queued batches + one in inference + one being written
+        self.preprocess = LetterBoxBatch(imgsz, model.stride, dtype=dtype, pin_memory=pin, buffers=depth + 2)
+        if hasattr(model, 'io_count'):  # queued outputs must outlive later IO bound ONNX Runtime calls
+            model.io_count = max(model.io_count, depth + 2)
+        self.dt = (Profile(), Profile(), Profile())
+
+    def pre(self, ims):
+        # Letterbox a list of BGR HWC images into a BCHW batch on the model device
+        with self.dt[0]:
+            x = self.preprocess(ims)[0].to(self.model.device, non_blocking=True)
+        return ims, x
+
+    @smart_inference_mode()
+    def infer(self, ims, x):
+        with self.dt[1]:
+            self.model.conf_thres = self.conf  # in-graph NMS models
+            y = self.model(x)
+        return ims, x.shape[2:], y
+
+    def post(self, ims, shape, y):
+        # NMS and rescale boxes from inference shape to original image shapes
+        with self.dt[2]:
+            det = non_max_suppression(y,
+                                      self.conf,
+                                      self.iou,
+                                      self.classes,
+                                      self.agnostic,
+                                      self.multi_label,
+                                      max_det=self.max_det)
+            for im, d in zip(ims, det):
+                scale_boxes(shape, d[:, :4], im.shape)
+        return ims, det
+
+    def batches(self, source):
+        # Group an iterable of images into lists of batch_size
+        ims = []
+        for im in source:
+            ims.append(im)
+            if len(ims) == self.batch_size:
+                yield ims,
+                ims = []
+        if ims:
+            yield ims,
+
+    @staticmethod
+    def _put(q, item, stop):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    @staticmethod
+    def _get(q, stop):
+        # Iterate queue items until end of stream (None), re-raising upstream exceptions
+        while not stop.is_set():
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _stage(self, fn, source, q, stop):
+        try:
+            for item in source:
+                self._put(q, fn(*item), stop)
+            self._put(q, None, stop)  # end of stream
+        except Exception as e:
+            self._put(q, e, stop)  # forward to the consumer
+
+    def __call__(self, source):
+        # Yield (im0, det) for each BGR HWC image in source, in order, with det (n,6) [xyxy, conf, cls] in im0 pixels
+        if not self.threaded:
+            for batch in self.batches(source):
+                yield from zip(*self.post(*self.infer(*self.pre(*batch))))
+            return
+
+        stop = threading.Event()
+        q = [queue.Queue(self.depth) for _ in range(3)]
+        sources = self.batches(source), self._get(q[0], stop), self._get(q[1], stop)
+        for i, (fn, src) in enumerate(zip((self.pre, self.infer, self.post), sources)):
+            threading.Thread(target=self._stage, args=(fn, src, q[i], stop), daemon=True).start()
+        try:
+            for ims, det in self._get(q[2], stop):
+                yield from zip(ims, det)
+        finally:
+            stop.set()  # release stage threads if the consumer stops early
+
+
 class Detections:
     # YOLOv5 detections class for inference results
     def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None):
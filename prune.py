@@ -0,0 +1,179 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Structured channel pruning of a trained YOLOv5 detection model, with a short fine-tune and a FLOPs/latency/mAP report
+per pruning ratio. Pruned checkpoints are physically smaller models that export with export.py
+
+Usage:
+    $ python prune.py --weights best.pt --data data.yaml --ratios 0.2 0.4 0.6 --epochs 3 --imgsz 640
+    $ python export.py --weights runs/prune/exp/best-pruned0.4.pt --include onnx
+"""
+
+import argparse
+import os
+import sys
+import time
+from copy import deepcopy
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import torch
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from models.experimental import attempt_load
+from models.yolo import DetectionModel, SegmentationModel
+from utils.dataloaders import create_dataloader
+from utils.general import LOGGER, check_dataset, check_img_size, check_yaml, colorstr, increment_path, print_args
+from utils.loss import ComputeLoss
+from utils.metrics import evaluate
+from utils.torch_utils import model_info, prune_channels, select_device, smart_optimizer
+
+
+def finetune(model, dataloader, epochs=3, lr0=0.001, device=torch.device('cpu'), prefix=colorstr('Prune:')):
+    # Briefly train a pruned model to recover accuracy, in place
+    hyp = model.hyp
+    optimizer = smart_optimizer(model, 'SGD', lr0, hyp['momentum'], hyp['weight_decay'])
+    compute_loss = ComputeLoss(model)
+    amp = device.type != 'cpu'
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
+    model.train()
+    for epoch in range(epochs):
+        mloss = torch.zeros(3, device=device)
+        for i, (imgs, targets, _, _) in enumerate(dataloader):
+            imgs = imgs.to(device, non_blocking=True).float() / 255
+            with torch.cuda.amp.autocast(amp):
+                loss, loss_items = compute_loss(model(imgs), targets.to(device))
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=10.0)
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad()
+            mloss = (mloss * i + loss_items) / (i + 1)
+        LOGGER.info(f'{prefix} epoch {epoch + 1}/{epochs} box, obj, cls loss ' + ('%.4g ' * 3) % tuple(mloss))
+    return model.eval()
+
+
+@torch.no_grad()
+def latency(model, imgsz=640, n=20):
+    # Return median CPU batch-1 inference time in ms of the fused model
+    model = deepcopy(model).float().cpu().fuse().eval()
+    im = torch.zeros(1, 3, imgsz, imgsz)
+    for _ in range(2):  # warmup
+        model(im)
+    t = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        model(im)
+        t.append(time.perf_counter() - t0)
+    return float(np.median(t)) * 1E3
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # trained detection model path
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml',  # fine-tune hyperparameters path
+        ratios=(0.2, 0.4, 0.6),  # fractions of prunable channels to remove
+        epochs=3,  # fine-tune epochs per ratio
+        lr0=0.001,  # fine-tune learning rate
+        imgsz=640,  # train, val image size (pixels)
+        batch_size=16,  # fine-tune and val batch size
+        divisor=8,  # keep a multiple of divisor channels per group
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        workers=8,  # max dataloader workers
+        project=ROOT / 'runs/prune',  # save to project/name
+        name='exp',  # save to project/name
+        exist_ok=False,  # existing project/name ok, do not increment
+):
+    prefix = colorstr('Prune:')
+    device = select_device(device, batch_size=batch_size)
+    save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)
+    save_dir.mkdir(parents=True, exist_ok=True)
+
+    # Model, unfused so BatchNorm gammas are available
+    model = attempt_load(weights, device=device, fuse=False)
+    assert isinstance(model, DetectionModel) and not isinstance(model, SegmentationModel), \
+        f'{prefix} {weights} is not a DetectionModel'
+    for p in model.parameters():
+        p.requires_grad = True
+    gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+    imgsz = check_img_size(imgsz, gs)
+
+    # Hyperparameters, scaled as in training
+    with open(check_yaml(hyp), errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    nl, nc = model.model[-1].nl, model.model[-1].nc
+    hyp['box'] *= 3 / nl  # scale to layers
+    hyp['cls'] *= nc / 80 * 3 / nl  # scale to classes and layers
+    hyp['obj'] *= (imgsz / 640) ** 2 * 3 / nl  # scale to image size and layers
+    hyp['label_smoothing'] = 0.0
+    model.nc, model.hyp = nc, hyp
+
+    # Dataloaders
+    data_dict = check_dataset(data)
+    train_loader = create_dataloader(data_dict['train'], imgsz, batch_size, gs, hyp=hyp, augment=True,
+                                     workers=workers, shuffle=True, prefix=colorstr('train: '))[0]
+    val_loader = create_dataloader(data_dict['val'], imgsz, batch_size, gs, pad=0.5, rect=True, workers=workers,
+                                   prefix=colorstr('val: '))[0]
+
+    # Prune, fine-tune, evaluate
+    results = {0.0: (*model_info(model, imgsz=imgsz), latency(model, imgsz), *evaluate(model, val_loader, device))}
+    for ratio in ratios:
+        LOGGER.info(f'\n{prefix} pruning {ratio:.0%} of channels from {weights}')
+        pruned = prune_channels(deepcopy(model), ratio, divisor=divisor)
+        if epochs:
+            finetune(pruned, train_loader, epochs, lr0, device)
+        n_p, flops = model_info(pruned, imgsz=imgsz)
+        results[ratio] = (n_p, flops, latency(pruned, imgsz), *evaluate(pruned, val_loader, device))
+        f = save_dir / f'{Path(weights).stem}-pruned{ratio:g}.pt'
+        ckpt = {
+            'model': deepcopy(pruned).half(),
+            'ema': None,
+            'prune_ratio': ratio,
+            'date': datetime.now().isoformat()}
+        torch.save(ckpt, f)
+        LOGGER.info(f'{prefix} saved {f}')
+
+    # Report
+    LOGGER.info(f'\n{prefix} {weights} on {data}, {epochs} fine-tune epochs per ratio')
+    LOGGER.info(('%10s' + '%12s' * 5) % ('ratio', 'params', 'GFLOPs', 'CPU ms', 'mAP50', 'mAP50-95'))
+    for ratio, (n_p, flops, t, map50, map) in results.items():
+        LOGGER.info(('%10.2f' + '%12i' + '%12.2f' * 2 + '%12.3g' * 2) % (ratio, n_p, flops, t, map50, map))
+    LOGGER.info(f'Results saved to {colorstr("bold", save_dir)}')
+    return results
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='trained detection model path')
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
+    parser.add_argument('--hyp', type=str, default=ROOT / 'data/hyps/hyp.scratch-low.yaml', help='hyperparameters path')
+    parser.add_argument('--ratios', nargs='+', type=float, default=[0.2, 0.4, 0.6], help='pruning ratios')
+    parser.add_argument('--epochs', type=int, default=3, help='fine-tune epochs per ratio')
+    parser.add_argument('--lr0', type=float, default=0.001, help='fine-tune learning rate')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='train, val image size (pixels)')
+    parser.add_argument('--batch-size', type=int, default=16, help='batch size')
+    parser.add_argument('--divisor', type=int, default=8, help='keep a multiple of divisor channels per group')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--workers', type=int, default=8, help='max dataloader workers')
+    parser.add_argument('--project', default=ROOT / 'runs/prune', help='save to project/name')
+    parser.add_argument('--name', default='exp', help='save to project/name')
+    parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
@@ -0,0 +1,209 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Pseudo-label unlabeled image archives with a trained YOLOv5 teacher, any DetectMultiBackend format, writing YOLO-format
+label files with confidences. Runs are resumable and incremental: a manifest records every labelled image by path, size,
+mtime and content hash, so reruns skip labelled images and duplicates of them and only run the model on new data
+
+Usage:
+    $ python pseudolabel.py --weights best.onnx --source data/dataset_test --batch-size 32 --processes 4
+    $ python pseudolabel.py --weights best.pt --source archive/ --labels archive_labels/ --conf-thres 0.4
+
+Label files hold one 'class x_center y_center width height confidence' row per detection, normalized 0-1
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from utils.dataloaders import image_files, img2label_paths
+from utils.general import LOGGER, colorstr, print_args, xyxy2xywhn
+
+PIPELINE = None  # per-process DetectPipeline
+
+
+def file_hash(f, block=1 << 20):
+    # Return the SHA-1 hex digest of a file's content
+    h = hashlib.sha1()
+    with open(f, 'rb') as fp:
+        while chunk := fp.read(block):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def label_path(f, source, labels):
+    # Return the label file of image f, under labels mirroring the source tree if given, else by the images/labels rule
+    if not labels:
+        return Path(img2label_paths([f])[0])
+    root = Path(source) if Path(source).is_dir() else Path(f).parent
+    return (Path(labels) / Path(f).relative_to(root)).with_suffix('.txt')
+
+
+def _init(weights, device, imgsz, batch_size, threads, nms):
+    # Pool process initializer: load the model into a per-process pipeline
+    from models.common import DetectMultiBackend, DetectPipeline
+    from utils.torch_utils import select_device
+
+    global PIPELINE
+    if threads:
+        torch.set_num_threads(threads)
+    model = DetectMultiBackend(weights, device=select_device(device), ort_threads=threads)
+    PIPELINE = DetectPipeline(model, imgsz, batch_size)
+    PIPELINE.__dict__.update(nms)
+
+
+def _label(files):
+    # Return [(file, (n,6) cls, xywhn, conf array or None if unreadable)] for a chunk of image files
+    ok = []
+
+    def read():
+        for f in files:
+            im = cv2.imread(f)  # BGR
+            if im is not None:
+                ok.append(f)
+                yield im
+
+    out = {f: None for f in files}
+    for (im, det), f in zip(PIPELINE(read()), ok):  # ok fills ahead of the pipeline output
+        det = det.cpu().numpy()
+        h, w = im.shape[:2]
+        out[f] = np.concatenate((det[:, 5:6], xyxy2xywhn(det[:, :4], w, h, clip=True), det[:, 4:5]), 1)
+    return list(out.items())
+
+
+def label(todo, by_hash, mf, args, n=128, processes=1, prefix=colorstr('Pseudo-label:')):
+    # Label (file, hash, stat, label file) todo images in chunks of n across model processes initialized with
+    # _init(*args), recording each image in by_hash and the manifest file mf
+    meta = {x[0]: x[1:] for x in todo}
+    chunks = [[x[0] for x in todo[i:i + n]] for i in range(0, len(todo), n)]
+    if processes > 1:
+        pool = multiprocessing.get_context('spawn').Pool(processes, initializer=_init, initargs=args)
+        results = pool.imap(_label, chunks)
+    else:
+        pool = None
+        _init(*args)
+        results = map(_label, chunks)
+    done = bad = 0
+    t0 = time.time()
+    try:
+        for result in results:
+            for f, y in result:
+                h, st, lb = meta[f]
+                if y is None:
+                    bad += 1
+                    LOGGER.warning(f'{prefix} WARNING ⚠️ unreadable image {f}')
+                    continue
+                lb.parent.mkdir(parents=True, exist_ok=True)
+                with open(lb, 'w') as fl:
+                    fl.writelines(('%g ' * 6).rstrip() % (int(x[0]), *x[1:]) + '\n' for x in y)
+                e = by_hash[h] = {'file': f, 'size': st.st_size, 'mtime': st.st_mtime, 'hash': h, 'label': str(lb)}
+                mf.write(json.dumps(e) + '\n')
+                done += 1
+            mf.flush()  # checkpoint after every chunk
+            LOGGER.info(f'{prefix} {done + bad}/{len(todo)} images, {done / (time.time() - t0):.1f} img/s')
+    finally:
+        if pool:
+            pool.terminate()
+    LOGGER.info(f'{prefix} labelled {done} images, {bad} unreadable')
+
+
+def run(
+        weights=ROOT / 'yolov5s.pt',  # model path, any DetectMultiBackend format
+        source=ROOT / 'data/dataset_test',  # image directory, glob or *.txt list of images
+        labels='',  # label directory mirroring source, default images/ to labels/ next to each image
+        manifest='',  # resume manifest path, default source/pseudolabel.jsonl
+        imgsz=640,  # inference size (pixels)
+        conf_thres=0.25,  # confidence threshold
+        iou_thres=0.45,  # NMS IoU threshold
+        max_det=1000,  # maximum detections per image
+        batch_size=32,  # inference batch size
+        processes=1,  # model processes
+        chunk=4,  # batches per task sent to a process
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+):
+    prefix = colorstr('Pseudo-label:')
+    files = image_files(source)
+    manifest = Path(manifest or (Path(source) if Path(source).is_dir() else Path(source).parent) / 'pseudolabel.jsonl')
+
+    # Resume: skip images unchanged since labelled, reuse labels of identical content under another name
+    by_file, by_hash = {}, {}
+    if manifest.exists():
+        for line in manifest.read_text().splitlines():
+            with contextlib.suppress(ValueError, KeyError):  # skip a line torn by an interrupted run
+                e = json.loads(line)
+                by_file[e['file']] = by_hash[e['hash']] = e
+    todo, dups, pending, skipped = [], [], set(), 0
+    for f in files:
+        st, lb = os.stat(f), label_path(f, source, labels)
+        e = by_file.get(f)
+        if e and e['size'] == st.st_size and e['mtime'] == st.st_mtime and Path(e['label']).exists():
+            skipped += 1
+            continue
+        h = file_hash(f)
+        if h in pending or (h in by_hash and Path(by_hash[h]['label']).exists()):  # duplicate content
+            dups.append((f, h, st, lb))
+        else:
+            pending.add(h)
+            todo.append((f, h, st, lb))
+    LOGGER.info(f'{prefix} {len(files)} images in {source}, {skipped} already labelled, {len(dups)} duplicates, '
+                f'{len(todo)} to label with {weights}')
+    with open(manifest, 'a') as mf:
+        if todo:
+            nms = dict(conf=conf_thres, iou=iou_thres, max_det=max_det)
+            threads = max((os.cpu_count() or 1) // processes, 1) if processes > 1 else 0
+            args = (str(weights), device, imgsz, batch_size, threads, nms)
+            label(todo, by_hash, mf, args, batch_size * chunk, processes, prefix)
+        for f, h, st, lb in dups:  # copy labels of identical content
+            e = by_hash.get(h)
+            if e:
+                lb.parent.mkdir(parents=True, exist_ok=True)
+                if Path(e['label']).resolve() != lb.resolve():
+                    shutil.copyfile(e['label'], lb)
+                e = dict(e, file=f, size=st.st_size, mtime=st.st_mtime, label=str(lb))
+                mf.write(json.dumps(e) + '\n')
+    LOGGER.info(f'{prefix} manifest {colorstr("bold", manifest)}')
+    return manifest
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='model path')
+    parser.add_argument('--source', type=str, default=ROOT / 'data/dataset_test', help='image dir, glob or *.txt list')
+    parser.add_argument('--labels', type=str, default='', help='label dir mirroring source, default images/ to labels/')
+    parser.add_argument('--manifest', type=str, default='', help='resume manifest, default source/pseudolabel.jsonl')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
+    parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
+    parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--batch-size', type=int, default=32, help='inference batch size')
+    parser.add_argument('--processes', type=int, default=1, help='model processes')
+    parser.add_argument('--chunk', type=int, default=4, help='batches per task sent to a process')
+    parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    opt = parser.parse_args()
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == '__main__':
+    opt = parse_opt()
+    main(opt)
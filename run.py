@@ -1,3 +1,5 @@
+import time
+T0 = time.perf_counter() # process start for the startup timeline
 import os
 import sys
 import signal
@@ -5,16 +7,26 @@ WORKING_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(WORKING_DIR, "../"))
 import cv2
 import json
-import time
 import datetime
 import threading
+from contextlib import nullcontext
 from config import settings
 from flask_cors import CORS
-from ultralytics import YOLO
 from datetime import datetime
 from flask import Flask, jsonify, Response, request
 from utils.function import (detect_v8, health_check_nano, get_information_from_server , 
-                            update_frame_dimension, checking_internet, checking_internet_auto, checking_camera, VideoStream)
+                            update_frame_dimension, checking_internet, checking_internet_auto, checking_camera, VideoStream,
+                            ModelLoader, StartupTimeline, DetectionCache, load_verifier)
+
+timeline = StartupTimeline(T0)
+timeline.add('imports')
+
+
+'''Fast start: load the model (ultralytics, torch) in background while waiting for the sim card, network and camera'''
+weight_path = os.path.join(settings.MODEL, 'bestv8.pt')
+model_loader = None
+if settings.FAST_START:
+    model_loader = ModelLoader(weight_path, settings.MODEL_CACHE, settings.MODEL_CACHE_FORMAT, timeline=timeline).start()
 
 ''' cuda device, i.e. 0 or 0,1,2,3 or cpu'''
 device = '' 
@@ -32,9 +44,10 @@ os.system(cmd_auto_reboot)
 
 '''Wait computer detect sim card'''
 print("[INFO] Wait for the sim card to be activated ...")
-for i in range(30):
-    print(f'Time: {i+1}s')
-    time.sleep(1)
+with timeline('sim wait'):
+    for i in range(30):
+        print(f'Time: {i+1}s')
+        time.sleep(1)
 
 
 '''Open network on sim 4G '''
@@ -50,7 +63,8 @@ except Exception as e:
 
 '''Check internet available or not'''
 print("[INFO] Checking internet ...")
-checking_internet()
+with timeline('internet check'):
+    checking_internet()
 
 
 with open(os.path.join(os.getcwd(), 'info.json'), "r") as outfile:
@@ -65,7 +79,8 @@ with open(os.path.join(os.getcwd(), 'info.json'), "r") as outfile:
 
 
 '''Get information from server and update into json file'''
-get_information_from_server(IPCAM, IPEDGECOM)
+with timeline('server info'):
+    get_information_from_server(IPCAM, IPEDGECOM)
 
 
 with open(os.path.join(os.getcwd(), 'info.json'), "r") as outfile:
@@ -80,7 +95,8 @@ print(f'[INFO] URL Stream: {URL}')
 
 '''Load frame from camera to get H and W'''
 print(f'[INFO] Checking connect to camera ...')
-_, frame = checking_camera(URL)
+with timeline('camera probe'):
+    _, frame = checking_camera(URL)
 height = frame.shape[0]
 width = frame.shape[1]
 update_frame_dimension(height, width, IPCAM) # Write H and W to json file
@@ -88,7 +104,15 @@ update_frame_dimension(height, width, IPCAM) # Write H and W to json file
 
 '''Load camera'''
 print(f'[INFO] Loading camera ...')
-cap = VideoStream(URL).start()
+with timeline('camera open'):
+    cap = VideoStream(URL).start()
+
+
+'''Optional cache of detections of near-identical frames'''
+detection_cache = None
+if settings.DETECT_CACHE:
+    detection_cache = DetectionCache(settings.DETECT_CACHE_SIZE, settings.DETECT_CACHE_TTL, settings.DETECT_CACHE_TOLERANCE,
+                                     max_hits=settings.DETECT_CACHE_MAX_HITS)
 
 
 '''Load file json about object'''
@@ -111,10 +135,21 @@ def index():
 def detect(ip_camera):
     conf_thres = settings.CONF_THRES # confidence threshold
     iou_thres = settings.IOU_THRES # NMS IOU threshold
-    weight_path = os.path.join(settings.MODEL, 'bestv8.pt')
 
     """Detect object on input image"""
-    model = YOLO(weight_path, "detect")
+    if model_loader is not None:
+        with timeline('wait for model'):
+            model = model_loader.get()
+    else:
+        with timeline('load model'):
+            from ultralytics import YOLO
+            model = YOLO(weight_path, "detect")
+    verifier = None
+    if settings.VERIFIER_WEIGHTS:
+        with timeline('load verifier'):
+            verifier = load_verifier(settings.VERIFIER_WEIGHTS, settings.VERIFIER_CLASSES, settings.VERIFIER_CONF,
+                                     settings.VERIFIER_ACCEPT, settings.VERIFIER_MAX_CROPS, settings.VERIFIER_IMGSZ)
+    first = True
     
     while True:
         with open(os.path.join(os.getcwd(), 'info.json'), "r") as outfile:
@@ -123,7 +158,12 @@ def detect(ip_camera):
             IDENTIFICATIONTIME = info_json['identification_time']    
         _, frame_detect = cap.read()
         print(f"[INFO] Detect object at " + datetime.now().strftime("%m-%d-%Y %I:%M:%S%p") +".")
-        detect_v8(frame_detect, ip_camera, PTS, conf_thres, iou_thres, model, json_object, USE_TELE, CAMERA_NAME)
+        with timeline('first detection') if first else nullcontext():
+            detect_v8(frame_detect, ip_camera, PTS, conf_thres, iou_thres, model, json_object, USE_TELE, CAMERA_NAME,
+                      detection_cache, verifier)
+        if first:
+            timeline.report()
+            first = False
         time.sleep(IDENTIFICATIONTIME)
 
 
@@ -196,6 +236,13 @@ def update_info():
         return jsonify(status_code = 400, content={"success":"false", "error": str(error)})
 
 
+@app.route(f'/api/{API_NAME}/cache_stats', methods = ['GET'])
+def cache_stats():
+    if detection_cache is None:
+        return jsonify(status_code = 404, content={'message': '[INFO] Detection cache disabled.'})
+    return jsonify(status_code = 200, content=detection_cache.stats())
+
+
 @app.route(f'/api/{API_NAME}/reboot', methods = ['GET'])
 def reboot():
     try:
@@ -46,10 +46,10 @@ from ultralytics.utils.plotting import Annotator, colors, save_one_box
 
 from models.common import DetectMultiBackend
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
-from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_boxes, scale_segments,
-                           strip_optimizer)
-from utils.segment.general import masks2segments, process_mask, process_mask_native
+from utils.general import (LOGGER, ORT_OPT, ORT_THREADS, Profile, check_file, check_img_size, check_imshow,
+                           check_requirements, colorstr, cv2, increment_path, non_max_suppression, print_args,
+                           scale_boxes, scale_segments, strip_optimizer)
+from utils.segment.general import masks2segments, process_mask, process_mask_roi
 from utils.torch_utils import select_device, smart_inference_mode
 
 
@@ -83,6 +83,8 @@ def run(
     dnn=False,  # use OpenCV DNN for ONNX inference
     vid_stride=1,  # video frame-rate stride
     retina_masks=False,
+    ort_threads=ORT_THREADS,  # ONNX Runtime intra-op threads, 0 for all physical cores
+    ort_opt=ORT_OPT,  # ONNX Runtime graph optimization level
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -99,7 +101,14 @@ def run(
 
     # Load model
     device = select_device(device)
-    model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
+    model = DetectMultiBackend(weights,
+                               device=device,
+                               dnn=dnn,
+                               data=data,
+                               fp16=half,
+                               ort_threads=ort_threads,
+                               ort_opt=ort_opt)
+    model.conf_thres = conf_thres  # in-graph NMS models
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
 
@@ -107,7 +116,8 @@ def run(
     bs = 1  # batch_size
     if webcam:
         view_img = check_imshow(warn=True)
-        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadStreams(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride,
+                              skip_stale=pt)  # fixed-batch exports need every stream in each batch
         bs = len(dataset)
     elif screenshot:
         dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
@@ -141,11 +151,11 @@ def run(
         # Process predictions
         for i, det in enumerate(pred):  # per image
             seen += 1
-            if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
-                s += f'{i}: '
+            if webcam:  # batch_size >= 1, streams with new frames only
+                p, im0, frame, k = path[i], im0s[i].copy(), dataset.count, dataset.index[i]  # k stream index
+                s += f'{k}: '
             else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+                p, im0, frame, k = path, im0s.copy(), getattr(dataset, 'frame', 0), i
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
@@ -155,9 +165,9 @@ def run(
             annotator = Annotator(im0, line_width=line_thickness, example=str(names))
             if len(det):
                 if retina_masks:
-                    # scale bbox first the crop masks
+                    # scale bbox first, then decode masks inside each im0 box only
                     det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()  # rescale boxes to im0 size
-                    masks = process_mask_native(proto[i], det[:, 6:], det[:, :4], im0.shape[:2])  # HWC
+                    masks = process_mask_roi(proto[i], det[:, 6:], det[:, :4], im.shape[2:], im0.shape)  # RoiMasks
                 else:
                     masks = process_mask(proto[i], det[:, 6:], det[:, :4], im.shape[2:], upsample=True)  # HWC
                     det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()  # rescale boxes to im0 size
@@ -166,7 +176,7 @@ def run(
                 if save_txt:
                     segments = [
                         scale_segments(im0.shape if retina_masks else im.shape[2:], x, im0.shape, normalize=True)
-                        for x in reversed(masks2segments(masks))]
+                        for x in reversed(masks.segments() if retina_masks else masks2segments(masks))]
 
                 # Print results
                 for c in det[:, 5].unique():
@@ -174,11 +184,10 @@ def run(
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
                 # Mask plotting
-                annotator.masks(
-                    masks,
-                    colors=[colors(x, True) for x in det[:, 5]],
-                    im_gpu=torch.as_tensor(im0, dtype=torch.float16).to(device).permute(2, 0, 1).flip(0).contiguous() /
-                    255 if retina_masks else im[i])
+                if retina_masks:  # blend ROIs into im0, no full-image masks
+                    masks.plot(annotator.im, colors=[colors(x, True) for x in det[:, 5]])
+                else:
+                    annotator.masks(masks, colors=[colors(x, True) for x in det[:, 5]], im_gpu=im[i])
 
                 # Write results
                 for j, (*xyxy, conf, cls) in enumerate(reversed(det[:, :6])):
@@ -212,10 +221,10 @@ def run(
                 if dataset.mode == 'image':
                     cv2.imwrite(save_path, im0)
                 else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
+                    if vid_path[k] != save_path:  # new video
+                        vid_path[k] = save_path
+                        if isinstance(vid_writer[k], cv2.VideoWriter):
+                            vid_writer[k].release()  # release previous video writer
                         if vid_cap:  # video
                             fps = vid_cap.get(cv2.CAP_PROP_FPS)
                             w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -223,8 +232,8 @@ def run(
                         else:  # stream
                             fps, w, h = 30, im0.shape[1], im0.shape[0]
                         save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+                        vid_writer[k] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    vid_writer[k].write(im0)
 
         # Print time (inference-only)
         LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
@@ -268,7 +277,10 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
-    parser.add_argument('--retina-masks', action='store_true', help='whether to plot masks in native resolution')
+    parser.add_argument('--retina-masks', action='store_true', help='decode masks in native resolution inside boxes')
+    parser.add_argument('--ort-threads', type=int, default=ORT_THREADS, help='ONNX Runtime intra-op threads, 0 for all')
+    parser.add_argument('--ort-opt', default=ORT_OPT, choices=['disable', 'basic', 'extended', 'all'],
+                        help='ONNX Runtime graph optimization level')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -22,9 +22,12 @@ Usage - formats:
 
 import argparse
 import json
+import multiprocessing
 import os
 import subprocess
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
@@ -47,11 +50,13 @@ from utils.general import (LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, Profile, check_
                            check_requirements, check_yaml, coco80_to_coco91_class, colorstr, increment_path,
                            non_max_suppression, print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
 from utils.metrics import ConfusionMatrix, box_iou
+from utils.modelpool import core_sets, cpu_nodes
 from utils.plots import output_to_target, plot_val_study
 from utils.segment.dataloaders import create_dataloader
 from utils.segment.general import mask_iou, process_mask, process_mask_native, scale_image
-from utils.segment.metrics import Metrics, ap_per_class_box_and_mask
+from utils.segment.metrics import BoxMaskAccumulator, Metrics, ap_per_class_box_and_mask
 from utils.segment.plots import plot_images_and_masks
+from utils.segment.rle import gt_masks_rle, process_mask_rle, rle_iou
 from utils.torch_utils import de_parallel, select_device, smart_inference_mode
 
 
@@ -89,16 +94,39 @@ def save_one_json(predn, jdict, path, class_map, pred_masks):
             'segmentation': rles[i]})
 
 
+def run_shard(kwargs):
+    # Validate one shard in a worker process with its own model copy, thread count and optional core pinning
+    threads, cores = kwargs.pop('threads'), kwargs.pop('cores')
+    torch.set_num_threads(threads)
+    if cores and hasattr(os, 'sched_setaffinity'):  # Linux-only
+        os.sched_setaffinity(0, cores)
+    return run(**kwargs)
+
+
+def run_shards(kwargs, processes, threads=0):
+    # Run run_shard() on `processes` batch-aligned shards, returning per-shard results in shard order
+    ncpu = sum(len(x) for x in cpu_nodes())  # usable cores, respects the affinity mask
+    threads = threads or max(ncpu // processes, 1)  # intra-op threads per process
+    cores = core_sets(processes, threads) or [None] * processes  # disjoint allowed core sets, unpinned if they don't fit
+    jobs = [{**kwargs, 'shard': (k, processes), 'processes': 1, 'threads': threads, 'cores': cores[k]}
+            for k in range(processes)]
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn')) as pool:  # non-daemonic
+        return list(pool.map(run_shard, jobs))  # workers may spawn their own dataloader workers
+
+
 def process_batch(detections, labels, iouv, pred_masks=None, gt_masks=None, overlap=False, masks=False):
     """
     Return correct prediction matrix
     Arguments:
         detections (array[N, 6]), x1, y1, x2, y2, conf, class
         labels (array[M, 5]), class, x1, y1, x2, y2
+        pred_masks, gt_masks (tensor[N, h, w], tensor[M, h, w]) or (list[N], list[M]) of RLE masks
     Returns:
         correct (array[N, 10]), for 10 IoU levels
     """
-    if masks:
+    if masks and isinstance(pred_masks, list):  # RLE
+        iou = rle_iou(gt_masks, pred_masks)
+    elif masks:
         if overlap:
             nl = len(labels)
             index = torch.arange(nl, device=gt_masks.device).view(nl, 1, 1) + 1
@@ -157,11 +185,18 @@ def run(
         overlap=False,
         mask_downsample_ratio=1,
         compute_loss=None,
+        streaming=False,  # accumulate metrics in bounded-memory confidence histograms
+        rle=False,  # compare run-length encoded masks, memory independent of image area
+        processes=1,  # validate in N sharded CPU worker processes
+        threads=0,  # torch threads per worker process, 0 for cpu_count // processes
+        shard=None,  # (index, count) shard to validate, set by run_shards()
         callbacks=Callbacks(),
 ):
+    kwargs = {k: v for k, v in locals().items() if k not in ('model', 'dataloader', 'compute_loss', 'callbacks')}
     if save_json:
         check_requirements('pycocotools>=2.0.6')
         process = process_mask_native  # more accurate
+        rle = False  # COCO-JSON masks are dense native resolution
     else:
         process = process_mask  # faster
 
@@ -176,7 +211,7 @@ def run(
         device = select_device(device, batch_size=batch_size)
 
         # Directories
-        save_dir = increment_path(Path(project) / name, exist_ok=exist_ok)  # increment run
+        save_dir = increment_path(Path(project) / name, exist_ok=exist_ok or shard is not None)  # increment run
         (save_dir / 'labels' if save_txt else save_dir).mkdir(parents=True, exist_ok=True)  # make dir
 
         # Load model
@@ -210,20 +245,28 @@ def run(
             ncm = model.model.nc
             assert ncm == nc, f'{weights} ({ncm} classes) trained on different --data than what you passed ({nc} ' \
                               f'classes). Pass correct combination of --weights and --data that are trained together.'
-        model.warmup(imgsz=(1 if pt else batch_size, 3, imgsz, imgsz))  # warmup
         pad, rect = (0.0, False) if task == 'speed' else (0.5, pt)  # square inference for benchmarks
         task = task if task in ('train', 'val', 'test') else 'val'  # path to train/val/test images
-        dataloader = create_dataloader(data[task],
-                                       imgsz,
-                                       batch_size,
-                                       stride,
-                                       single_cls,
-                                       pad=pad,
-                                       rect=rect,
-                                       workers=workers,
-                                       prefix=colorstr(f'{task}: '),
-                                       overlap_mask=overlap,
-                                       mask_downsample_ratio=mask_downsample_ratio)[0]
+        if processes > 1:  # sharded validation, workers load their own model and dataloader
+            LOGGER.info(f'Validating in {processes} sharded processes...')
+            kwargs.update(project=save_dir.parent, name=save_dir.name, plots=False, batch_size=batch_size)
+            t0 = time.time()
+            shards = run_shards(kwargs, processes, threads)
+            wall = time.time() - t0
+        else:
+            model.warmup(imgsz=(1 if pt else batch_size, 3, imgsz, imgsz))  # warmup
+            dataloader = create_dataloader(data[task],
+                                           imgsz,
+                                           batch_size,
+                                           stride,
+                                           single_cls,
+                                           pad=pad,
+                                           rect=rect,
+                                           workers=workers,
+                                           prefix=colorstr(f'{task}: '),
+                                           overlap_mask=overlap,
+                                           mask_downsample_ratio=mask_downsample_ratio,
+                                           shard=shard)[0]
 
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
@@ -236,9 +279,10 @@ def run(
     dt = Profile(), Profile(), Profile()
     metrics = Metrics()
     loss = torch.zeros(4, device=device)
-    jdict, stats = [], []
+    jdict, stats, im_files = [], [], None
+    accumulator = BoxMaskAccumulator(nc, niou) if streaming else None
     # callbacks.run('on_val_start')
-    pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
+    pbar = tqdm(dataloader or [], desc=s, bar_format=TQDM_BAR_FORMAT, disable=shard is not None)  # progress bar
     for batch_i, (im, targets, paths, shapes, masks) in enumerate(pbar):
         # callbacks.run('on_val_batch_start')
         with dt[0]:
@@ -284,15 +328,23 @@ def run(
 
             if npr == 0:
                 if nl:
-                    stats.append((correct_masks, correct_bboxes, *torch.zeros((2, 0), device=device), labels[:, 0]))
-                    if plots:
+                    stat = (correct_masks, correct_bboxes, *torch.zeros((2, 0), device=device), labels[:, 0])
+                    if streaming:
+                        accumulator.update(*stat)
+                    else:
+                        stats.append(stat)
+                    if plots or shard:  # shards always count, merged for the plot
                         confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
                 continue
 
             # Masks
             midx = [si] if overlap else targets[:, 0] == si
             gt_masks = masks[midx]
-            pred_masks = process(proto, pred[:, 6:], pred[:, :4], shape=im[si].shape[1:])
+            if rle:  # identical to process_mask() and process_batch() dense masks
+                pred_masks = process_mask_rle(proto, pred[:, 6:], pred[:, :4], shape=im[si].shape[1:])
+                gt_masks = gt_masks_rle(gt_masks, nl, proto.shape[1:], overlap=overlap)
+            else:
+                pred_masks = process(proto, pred[:, 6:], pred[:, :4], shape=im[si].shape[1:])
 
             # Predictions
             if single_cls:
@@ -307,18 +359,23 @@ def run(
                 labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
                 correct_bboxes = process_batch(predn, labelsn, iouv)
                 correct_masks = process_batch(predn, labelsn, iouv, pred_masks, gt_masks, overlap=overlap, masks=True)
-                if plots:
+                if plots or shard:
                     confusion_matrix.process_batch(predn, labelsn)
-            stats.append((correct_masks, correct_bboxes, pred[:, 4], pred[:, 5], labels[:, 0]))  # (conf, pcls, tcls)
+            stat = (correct_masks, correct_bboxes, pred[:, 4], pred[:, 5], labels[:, 0])  # (conf, pcls, tcls)
+            if streaming:
+                accumulator.update(*stat)
+            else:
+                stats.append(stat)
 
-            pred_masks = torch.as_tensor(pred_masks, dtype=torch.uint8)
             if plots and batch_i < 3:
-                plot_masks.append(pred_masks[:15])  # filter top 15 to plot
+                top = np.stack([x.decode() for x in pred_masks[:15]]) if rle else pred_masks[:15]
+                plot_masks.append(torch.as_tensor(top, dtype=torch.uint8))  # filter top 15 to plot
 
             # Save/log
             if save_txt:
                 save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / f'{path.stem}.txt')
             if save_json:
+                pred_masks = torch.as_tensor(pred_masks, dtype=torch.uint8)
                 pred_masks = scale_image(im[si].shape[1:],
                                          pred_masks.permute(1, 2, 0).contiguous().cpu().numpy(), shape, shapes[si][1])
                 save_one_json(predn, jdict, path, class_map, pred_masks)  # append to COCO-JSON dictionary
@@ -334,12 +391,35 @@ def run(
 
         # callbacks.run('on_val_batch_end')
 
+    if shard:  # return raw shard results to run_shards() for merging
+        stats = accumulator if streaming else [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]
+        im_files = dataloader.dataset.im_files if save_json and shard[0] == 0 else None
+        return stats, seen, confusion_matrix.matrix, jdict, tuple(x.t for x in dt), im_files
+    if processes > 1 and not training:  # merge shard results in shard order, identical to single-process
+        for shard_stats, shard_seen, matrix, shard_jdict, shard_t, files in shards:
+            if streaming:
+                accumulator += shard_stats
+            elif len(shard_stats):
+                stats.append(tuple(torch.from_numpy(x) for x in shard_stats))
+            seen += shard_seen
+            confusion_matrix.matrix += matrix
+            jdict.extend(shard_jdict)
+            for x, t in zip(dt, shard_t):
+                x.t += t
+            im_files = files or im_files if save_json else None
+        LOGGER.info(f'{seen} images in {wall:.1f}s ({seen / wall:.1f} images/s) on {processes} processes')
+
     # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        results = ap_per_class_box_and_mask(*stats, plot=plots, save_dir=save_dir, names=names)
-        metrics.update(results)
-    nt = np.bincount(stats[4].astype(int), minlength=nc)  # number of targets per class
+    if streaming:
+        if accumulator.masks.tp.any():
+            metrics.update(accumulator.compute(plot=plots, save_dir=save_dir, names=names))
+        nt = accumulator.nt  # number of targets per class
+    else:
+        stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
+        if len(stats) and stats[0].any():
+            results = ap_per_class_box_and_mask(*stats, plot=plots, save_dir=save_dir, names=names)
+            metrics.update(results)
+        nt = np.bincount(stats[4].astype(int), minlength=nc)  # number of targets per class
 
     # Print results
     pf = '%22s' + '%11i' * 2 + '%11.3g' * 8  # print format
@@ -348,7 +428,7 @@ def run(
         LOGGER.warning(f'WARNING ⚠️ no labels found in {task} set, can not compute metrics without labels')
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1 and (streaming or len(stats)):
         for i, c in enumerate(metrics.ap_class_index):
             LOGGER.info(pf % (names[c], seen, nt[c], *metrics.class_result(i)))
 
@@ -383,7 +463,8 @@ def run(
             results = []
             for eval in COCOeval(anno, pred, 'bbox'), COCOeval(anno, pred, 'segm'):
                 if is_coco:
-                    eval.params.imgIds = [int(Path(x).stem) for x in dataloader.dataset.im_files]  # img ID to evaluate
+                    im_files = im_files or dataloader.dataset.im_files
+                    eval.params.imgIds = [int(Path(x).stem) for x in im_files]  # img ID to evaluate
                 eval.evaluate()
                 eval.accumulate()
                 eval.summarize()
@@ -398,7 +479,7 @@ def run(
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
     final_metric = mp_bbox, mr_bbox, map50_bbox, map_bbox, mp_mask, mr_mask, map50_mask, map_mask
-    return (*final_metric, *(loss.cpu() / len(dataloader)).tolist()), metrics.get_maps(nc), t
+    return (*final_metric, *(loss.cpu() / max(len(dataloader or []), 1)).tolist()), metrics.get_maps(nc), t
 
 
 def parse_opt():
@@ -425,6 +506,10 @@ def parse_opt():
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
+    parser.add_argument('--streaming', action='store_true', help='bounded-memory streaming mAP accumulation')
+    parser.add_argument('--rle', action='store_true', help='compare run-length encoded masks (not with --save-json)')
+    parser.add_argument('--processes', type=int, default=1, help='validate in N sharded CPU worker processes')
+    parser.add_argument('--threads', type=int, default=0, help='torch threads per worker process (0 for auto)')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     # opt.save_json |= opt.data.endswith('coco.yaml')
@@ -5,6 +5,7 @@ Image augmentation functions
 
 import math
 import random
+from collections import deque
 
 import cv2
 import numpy as np
@@ -108,9 +109,8 @@ def replicate(im, labels):
     return im, labels
 
 
-def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    # Resize and pad image while meeting stride-multiple constraints
-    shape = im.shape[:2]  # current shape [height, width]
+def letterbox_params(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Return letterbox resized (w, h), (w, h) ratios, (dw, dh) padding and (top, bottom, left, right) borders
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -132,11 +132,18 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
 
     dw /= 2  # divide padding into 2 sides
     dh /= 2
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return new_unpad, ratio, (dw, dh), (top, bottom, left, right)
+
 
+def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Resize and pad image while meeting stride-multiple constraints
+    shape = im.shape[:2]  # current shape [height, width]
+    new_unpad, ratio, (dw, dh), (top, bottom, left, right) = letterbox_params(shape, new_shape, auto, scaleFill,
+                                                                              scaleup, stride)
     if shape[::-1] != new_unpad:  # resize
         im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
-    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
-    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
     im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return im, ratio, (dw, dh)
 
@@ -395,3 +402,79 @@ class ToTensor:
         im = im.half() if self.half else im.float()  # uint8 to fp16/32
         im /= 255.0  # 0-255 to 0.0-1.0
         return im
+
+
+class LetterBoxBatch:
+    """ YOLOv5 fused inference preprocessing, i.e. im, ratios, pads = LetterBoxBatch(640, dtype=torch.half)(ims)
+    Letterbox resize, pad, BGR to RGB, HWC to CHW, dtype conversion and 0-255 to 0.0-1.0 are written directly into a
+    reusable (optionally pinned) BCHW batch tensor, with one reusable resize buffer per shape as the only intermediate.
+    Batch buffers are recycled round-robin, so a returned batch stays valid for `buffers - 1` further calls.
+    """
+
+    def __init__(self,
+                 size=640,
+                 stride=32,
+                 auto=False,
+                 scaleup=True,
+                 dtype=torch.float32,
+                 bgr=True,
+                 pin_memory=False,
+                 buffers=2,
+                 color=(114, 114, 114)):
+        self.size = size
+        self.stride = stride
+        self.auto = auto  # minimum stride-multiple rectangle, if all images in the batch share it
+        self.scaleup = scaleup
+        self.dtype = dtype  # output dtype, torch.float32, torch.float16 or torch.uint8 (not normalized)
+        self.bgr = bgr  # input images in BGR order (OpenCV), else RGB
+        self.pin_memory = pin_memory and torch.cuda.is_available()  # page-locked for async host to device copies
+        self.buffers = buffers
+        self.pool = {}  # (b, 3, h, w) batch buffers
+        self.scratch = {}  # (h, w, c, dtype) resize buffers
+        color = torch.tensor(color[::-1] if bgr else color, dtype=torch.float32)  # RGB
+        self.color = (color / 255 if dtype.is_floating_point else color).to(dtype)[:, None, None]
+
+    def buffer(self, shape):
+        # Return the least recently used batch buffer of shape (b, 3, h, w), allocating up to self.buffers
+        pool = self.pool.setdefault(shape, deque())
+        if len(pool) < self.buffers:
+            pool.append(torch.empty(shape, dtype=self.dtype, pin_memory=self.pin_memory))
+        else:
+            pool.rotate(-1)
+        return pool[-1]
+
+    def resize(self, im, wh):
+        # Resize HWC image to (w, h) into a reusable buffer, OpenCV resize does not support float16
+        im = im.astype(np.float32) if im.dtype == np.float16 else np.ascontiguousarray(im)  # i.e. im[..., ::-1] views
+        if im.shape[1::-1] == wh:
+            return im
+        key = (wh[1], wh[0], im.shape[2], im.dtype.str)
+        if key not in self.scratch:
+            self.scratch[key] = np.empty(key[:3], dtype=im.dtype)
+        return cv2.resize(im, wh, dst=self.scratch[key], interpolation=cv2.INTER_LINEAR)
+
+    def __call__(self, ims, size=None):
+        ims = ims if isinstance(ims, (list, tuple)) else [ims]
+        size = size or self.size
+        auto, scaleup, stride = self.auto, self.scaleup, self.stride
+        params = [letterbox_params(im.shape[:2], size, auto, scaleup=scaleup, stride=stride) for im in ims]
+        shapes = {(wh[1] + b[0] + b[1], wh[0] + b[2] + b[3]) for wh, _, _, b in params}
+        if len(shapes) > 1:  # auto rectangles differ, fall back to a common full-size shape
+            params = [letterbox_params(im.shape[:2], size, False, scaleup=scaleup) for im in ims]
+            shapes = {(wh[1] + b[0] + b[1], wh[0] + b[2] + b[3]) for wh, _, _, b in params}
+        h, w = shapes.pop()
+        out = self.buffer((len(ims), 3, h, w))
+        for x, im, ((uw, uh), _, _, (top, bottom, left, right)) in zip(out, ims, params):
+            x[:, :top] = self.color  # borders
+            x[:, h - bottom:] = self.color
+            x[:, top:h - bottom, :left] = self.color
+            x[:, top:h - bottom, w - right:] = self.color
+            im = torch.from_numpy(self.resize(im, (uw, uh)))  # HWC, shares memory
+            region = x[:, top:top + uh, left:left + uw]
+            for c in range(3):
+                ch = im[..., 2 - c] if self.bgr else im[..., c]  # BGR to RGB
+                if self.dtype.is_floating_point:
+                    torch.div(ch, 255, out=region[c])  # 0-255 to 0.0-1.0 and cast in a single pass
+                else:
+                    region[c].copy_(ch)
+        return out, [p[1] for p in params], [p[2] for p in params]
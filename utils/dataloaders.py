@@ -9,13 +9,14 @@ import hashlib
 import json
 import math
 import os
+import queue
 import random
 import shutil
 import time
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Event, Thread
 from urllib.parse import urlparse
 
 import numpy as np
@@ -187,6 +188,31 @@ class _RepeatSampler:
             yield from iter(self.sampler)
 
 
+class ShardSampler(torch.utils.data.Sampler):
+    """ Sampler over one contiguous block of whole batches, for sharded multi-process validation
+
+    Shards are aligned to batch boundaries so every image lands in the same batch (and rectangular batch shape) as
+    in single-process validation, and concatenating shard outputs in shard order reproduces the unsharded order.
+
+    Args:
+        dataset (Dataset)
+        batch_size (int)
+        rank (int): shard index
+        world_size (int): number of shards
+    """
+
+    def __init__(self, dataset, batch_size, rank=0, world_size=1):
+        nb = math.ceil(len(dataset) / batch_size)  # number of batches
+        i, j = (nb * k // world_size * batch_size for k in (rank, rank + 1))  # shard bounds, in whole batches
+        self.indices = range(min(i, len(dataset)), min(j, len(dataset)))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
 class LoadScreenshots:
     # YOLOv5 screenshot dataloader, i.e. `python detect.py --source "screen 0 100 100 512 256"`
     def __init__(self, source, img_size=640, stride=32, auto=True, transforms=None):
@@ -236,9 +262,95 @@ class LoadScreenshots:
         return str(self.screen), im, im0, None, s  # screen, img, original img, im0s, s
 
 
+class VideoReader:
+    """ YOLOv5 video decoder, i.e. for frame, im0, im in VideoReader('vid.mp4', vid_stride=5, start=3600.0)
+    Decodes in a background thread into a bounded prefetch queue so decoding overlaps inference, skips the
+    vid_stride - 1 frames between decoded frames with grab() without decoding them, and seeks to start/end seconds.
+    transforms(im0), i.e. letterbox, runs in the decode thread too. threaded=False decodes in the iterating thread
+    instead. get() returns the static cv2.VideoCapture properties read at open, so the reader stands in for the capture
+    object.
+    """
+
+    def __init__(self, path, vid_stride=1, start=0.0, end=None, transforms=None, depth=8, threaded=True):
+        self.path = str(path)
+        self.cap = cv2.VideoCapture(self.path)
+        assert self.cap.isOpened(), f'Failed to open {path}'
+        self.props = {
+            k: self.cap.get(k)
+            for k in (cv2.CAP_PROP_FPS, cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FRAME_COUNT,
+                      cv2.CAP_PROP_ORIENTATION_META)}
+        fps = self.props[cv2.CAP_PROP_FPS]
+        self.fps = max((fps if math.isfinite(fps) else 0) % 100, 0) or 30  # 30 FPS fallback
+        if start:
+            self.cap.set(cv2.CAP_PROP_POS_MSEC, start * 1E3)  # seek
+        self.first = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))  # frame index after seek
+        self.last = int(end * self.fps) if end else math.inf  # exclusive
+        self.frames = math.ceil(max(min(self.props[cv2.CAP_PROP_FRAME_COUNT], self.last) - self.first, 0) / vid_stride)
+        self.vid_stride = vid_stride
+        self.transforms = transforms
+        self.running = True
+        self.queue = queue.Queue(depth) if threaded else None
+        if threaded:
+            self.thread = Thread(target=self._prefetch, daemon=True)
+            self.thread.start()
+
+    def get(self, prop):
+        return self.props.get(prop, 0.0)
+
+    def read(self):
+        # Yield (frame index, im0, transforms(im0) or None) for every vid_stride-th frame, decoding in this thread
+        n = self.first
+        try:
+            while self.running and n < self.last and self.cap.grab():  # grab() demuxes without decoding
+                if (n - self.first) % self.vid_stride == 0:
+                    success, im0 = self.cap.retrieve()  # decode
+                    if success:
+                        yield n, im0, self.transforms(im0) if self.transforms else None
+                n += 1
+        finally:
+            self.cap.release()
+
+    def _put(self, x):
+        # Put x on the queue unless closed while waiting for the consumer
+        while self.running:
+            try:
+                self.queue.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _prefetch(self):
+        try:
+            for x in self.read():
+                if not self._put(x):
+                    return
+        except Exception as e:
+            self._put(e)  # raise in the consumer
+        self._put(None)
+
+    def __iter__(self):
+        return self if self.queue else self.read()
+
+    def __next__(self):
+        x = self.queue.get() if self.running else None
+        if x is None:
+            self.running = False
+            raise StopIteration
+        if isinstance(x, Exception):
+            self.running = False
+            raise x
+        return x
+
+    def close(self):
+        self.running = False
+        if self.queue:
+            self.thread.join(timeout=5)
+
+
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1, start=0.0, prefetch=8):
         files = []
         for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
             p = str(Path(p).resolve())
@@ -250,7 +362,6 @@ class LoadImages:
                 files.append(p)  # files
             else:
                 raise FileNotFoundError(f'{p} does not exist')
-        print(files)
         images = [x for x in files if x.split('.')[-1].lower() in IMG_FORMATS]
         videos = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
         ni, nv = len(images), len(videos)
@@ -263,7 +374,9 @@ class LoadImages:
         self.mode = 'image'
         self.auto = auto
         self.transforms = transforms  # optional
-        self.vid_stride = vid_stride  # video frame-rate stride        
+        self.vid_stride = vid_stride  # video frame-rate stride
+        self.start = start  # video start seconds
+        self.prefetch = prefetch  # decoded video frames queued ahead
         if any(videos):
             self._new_video(videos[0])  # new video
         else:
@@ -280,26 +393,44 @@ class LoadImages:
             raise StopIteration
         path = self.files[self.count]
 
+        if self.video_flag[self.count]:
+            # Read video, decoded and letterboxed ahead in the VideoReader thread
+            self.mode = 'video'
+            x = next(self.cap, None)
+            while x is None:  # end of video
+                self.count += 1
+                if self.count == self.nf:  # last video
+                    raise StopIteration
+                path = self.files[self.count]
+                self._new_video(path)
+                x = next(self.cap, None)
+            _, img0, img = x
+            self.frame += 1
+            s = f'video {self.count + 1}/{self.nf} ({self.frame}/{self.frames}) {path}: '
+            return path, img, img0, self.cap, s
+
         # Read image
         self.count += 1
         img0 = cv2.imread(path)  # BGR
         assert img0 is not None, f'Image Not Found {path}'
         s = f'image {self.count}/{self.nf} {path}: '
+        return path, self._preprocess(img0), img0, self.cap, s
 
+    def _preprocess(self, img0):
+        # Return the model input for a BGR HWC image
         if self.transforms:
-            img = self.transforms(img0)  # transforms
-        else:
-            img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
-            img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
-            img = np.ascontiguousarray(img)  # contiguous                
-
-        return path, img, img0, self.cap, s
+            return self.transforms(img0)  # transforms
+        img = letterbox(img0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
+        img = img.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
+        return np.ascontiguousarray(img)  # contiguous
 
     def _new_video(self, path):
-        # Create a new video capture object
+        # Create a new background video reader
+        if getattr(self, 'cap', None):
+            self.cap.close()
         self.frame = 0
-        self.cap = cv2.VideoCapture(path)
-        self.frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT) / self.vid_stride)
+        self.cap = VideoReader(path, self.vid_stride, self.start, transforms=self._preprocess, depth=self.prefetch)
+        self.frames = self.cap.frames
         self.orientation = int(self.cap.get(cv2.CAP_PROP_ORIENTATION_META))  # rotation degrees
         # self.cap.set(cv2.CAP_PROP_ORIENTATION_AUTO, 0)  # disable https://github.com/ultralytics/yolov5/issues/8493
 
@@ -317,18 +448,146 @@ class LoadImages:
         return self.nf  # number of files
 
 
+class LoadVideos:
+    """ YOLOv5 bulk video scanner, i.e. for path, im, im0, reader, s in LoadVideos('recordings/', workers=8)
+    Decodes and letterboxes `workers` video files concurrently in threads (OpenCV releases the GIL while decoding) into
+    one bounded queue. Frames arrive in order within each file but interleaved across files, so use LoadImages to write
+    result videos. vid_stride, start and end apply to every file, see VideoReader.
+    """
+
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 start=0.0,
+                 end=None,
+                 workers=4,
+                 depth=32):
+        files = []
+        for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
+            p = str(Path(p).resolve())
+            if '*' in p:
+                files.extend(sorted(glob.glob(p, recursive=True)))  # glob
+            elif os.path.isdir(p):
+                files.extend(sorted(glob.glob(os.path.join(p, '**', '*.*'), recursive=True)))  # dir
+            elif os.path.isfile(p):
+                files.append(p)  # files
+            else:
+                raise FileNotFoundError(f'{p} does not exist')
+        self.files = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
+        self.nf = len(self.files)
+        assert self.nf > 0, f'No videos found in {path}. Supported formats are: {VID_FORMATS}'
+        self.mode = 'video'
+        self.img_size, self.stride, self.auto, self.transforms = img_size, stride, auto, transforms
+        self.kwargs = dict(vid_stride=vid_stride, start=start, end=end, threaded=False)
+        self.workers = min(workers, self.nf)
+        self.depth = depth
+        self.threads = []
+
+    def _preprocess(self, im0):
+        if self.transforms:
+            return self.transforms(im0)  # transforms
+        im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
+        return np.ascontiguousarray(im.transpose((2, 0, 1))[::-1])  # HWC to CHW, BGR to RGB, contiguous
+
+    def _put(self, x):
+        # Put x on the queue unless closed while waiting for the consumer
+        while self.running:
+            try:
+                self.queue.put(x, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _work(self):
+        # Decode files from the shared todo list until empty
+        while self.running:
+            try:
+                path = self.todo.pop()  # atomic
+            except IndexError:
+                break
+            try:
+                reader = VideoReader(path, transforms=self._preprocess, **self.kwargs)
+                for frame, im0, im in reader:
+                    if not self._put((reader, frame, im0, im)):
+                        return
+                self._put((reader, -1, None, None))  # file done
+            except Exception as e:
+                LOGGER.warning(f'WARNING ⚠️ {path}: {e}')
+        self._put(None)  # worker done
+
+    def __iter__(self):
+        self.close()
+        self.count, self.done, self.running = 0, 0, True
+        self.todo = self.files[::-1]
+        self.queue = queue.Queue(self.depth)
+        self.threads = [Thread(target=self._work, daemon=True) for _ in range(self.workers)]
+        for t in self.threads:
+            t.start()
+        self.alive = len(self.threads)
+        return self
+
+    def __next__(self):
+        while self.alive:
+            x = self.queue.get()
+            if x is None:
+                self.alive -= 1
+            elif x[1] < 0:
+                self.done += 1
+            else:
+                reader, self.frame, im0, im = x
+                self.count += 1
+                s = f'video {self.done + 1}/{self.nf} ({self.frame + 1}/{reader.first + reader.frames}) {reader.path}: '
+                return reader.path, im, im0, reader, s
+        raise StopIteration
+
+    def close(self):
+        self.running = False
+        for t in self.threads:
+            t.join(timeout=5)
+        self.threads = []
+
+    def __len__(self):
+        return self.nf  # number of files
+
+
 class LoadStreams:
-    # YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
-    def __init__(self, sources='file.streams', img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    """ YOLOv5 streamloader, i.e. `python detect.py --source 'rtsp://example.com/media.mp4'  # RTSP, RTMP, HTTP streams`
+    Each stream is read in its own daemon thread that numbers frames with a sequence counter. Iteration waits for new
+    frames and, with skip_stale=True, batches only streams with a frame not yet returned, listing their stream indices
+    in self.index; unchanged frames are not re-inferred. The batch size then varies, so skip_stale needs a model with a
+    dynamic batch, i.e. PyTorch, not a fixed-batch export. A lost live stream keeps its last frame and reconnects in its
+    thread with exponential backoff up to max_delay seconds while the other streams run on, see health().
+    """
+
+    def __init__(self,
+                 sources='file.streams',
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 skip_stale=False,
+                 max_delay=30.0):
         torch.backends.cudnn.benchmark = True  # faster for fixed-size inference
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
         self.vid_stride = vid_stride  # video frame-rate stride
+        self.skip_stale = skip_stale  # batch only streams with new frames
+        self.max_delay = max_delay  # max reconnect delay (s)
         sources = Path(sources).read_text().rsplit() if os.path.isfile(sources) else [sources]
         n = len(sources)
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
         self.imgs, self.fps, self.frames, self.threads = [None] * n, [0] * n, [0] * n, [None] * n
+        self.seq, self.seen, self.ims = [0] * n, [0] * n, [None] * n  # frames read, returned, preprocessed frames
+        self.t, self.rate, self.up, self.reconnects = [time.time()] * n, [0.0] * n, [True] * n, [0] * n  # health
+        self.cond = Condition()  # notified on every new frame
+        self.stop = Event()
         for i, s in enumerate(sources):  # index, source
             # Start thread to read frames from video stream
             st = f'{i + 1}/{n}: {s}... '
@@ -348,8 +607,11 @@ class LoadStreams:
             fps = cap.get(cv2.CAP_PROP_FPS)  # warning: may return 0 or nan
             self.frames[i] = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0) or float('inf')  # infinite stream fallback
             self.fps[i] = max((fps if math.isfinite(fps) else 0) % 100, 0) or 30  # 30 FPS fallback
+            self.rate[i] = self.fps[i]
 
-            _, self.imgs[i] = cap.read()  # guarantee first frame
+            success, self.imgs[i] = cap.read()  # guarantee first frame
+            assert success, f'{st}Failed to read {s}'
+            self.seq[i] = 1
             self.threads[i] = Thread(target=self.update, args=([i, cap, s]), daemon=True)
             LOGGER.info(f'{st} Success ({self.frames[i]} frames {w}x{h} at {self.fps[i]:.2f} FPS)')
             self.threads[i].start()
@@ -364,20 +626,63 @@ class LoadStreams:
             LOGGER.warning('WARNING ⚠️ Stream shapes differ. For optimal performance supply similarly-shaped streams.')
 
     def update(self, i, cap, stream):
-        # Read stream `i` frames in daemon thread
-        n, f = 0, self.frames[i]  # frame number, frame array
-        while cap.isOpened() and n < f:
-            n += 1
-            cap.grab()  # .read() = .grab() followed by .retrieve()
-            if n % self.vid_stride == 0:
+        # Read stream `i` frames in daemon thread, reconnecting a lost live stream with exponential backoff
+        n, f, delay = 0, self.frames[i], 1.0  # frame number, frame count, reconnect delay (s)
+        while not self.stop.is_set() and n < f:
+            if cap.grab():  # .read() = .grab() followed by .retrieve(), blocks until the next frame
+                n += 1
+                if n % self.vid_stride:
+                    continue
                 success, im = cap.retrieve()
                 if success:
-                    self.imgs[i] = im
-                else:
-                    LOGGER.warning('WARNING ⚠️ Video stream unresponsive, please check your IP camera connection.')
-                    self.imgs[i] = np.zeros_like(self.imgs[i])
-                    cap.open(stream)  # re-open stream if signal was lost
-            time.sleep(0.0)  # wait time
+                    self._new_frame(i, im)
+                    delay = 1.0
+                    continue
+            if math.isfinite(f):  # end of video file
+                break
+            LOGGER.warning(f'WARNING ⚠️ Stream {i} {self.sources[i]} unresponsive, please check your IP camera '
+                           f'connection. Reconnecting...')
+            cap.release()
+            self.up[i] = False
+            while not self.stop.wait(delay):  # backoff, exit if closed
+                delay = min(delay * 2, self.max_delay)
+                self.reconnects[i] += 1
+                cap = cv2.VideoCapture(stream)
+                if cap.isOpened():
+                    self.up[i] = True
+                    LOGGER.info(f'Stream {i} {self.sources[i]} reconnected')
+                    break
+                LOGGER.warning(f'WARNING ⚠️ Stream {i} reconnect failed, retrying in {delay:g}s')
+        cap.release()
+
+    def _new_frame(self, i, im):
+        # Publish a new frame of stream i and update its measured frame rate
+        t = time.time()
+        with self.cond:
+            dt = t - self.t[i]
+            if dt > 0:
+                self.rate[i] = 0.9 * self.rate[i] + 0.1 / dt  # EMA
+            self.imgs[i], self.t[i] = im, t
+            self.seq[i] += 1
+            self.cond.notify_all()
+
+    def health(self):
+        # Return per-stream health: connected, measured FPS, last frame age (s), reconnects and frames read
+        t = time.time()
+        streams = zip(self.sources, self.up, self.rate, self.t, self.reconnects, self.seq)
+        return [{
+            'source': s,
+            'up': up,
+            'fps': rate,
+            'age': t - t0,
+            'reconnects': r,
+            'frames': n} for s, up, rate, t0, r, n in streams]
+
+    def _preprocess(self, im0):
+        if self.transforms:
+            return self.transforms(im0)  # transforms
+        im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # resize
+        return im[..., ::-1].transpose((2, 0, 1))  # BGR to RGB, HWC to CHW
 
     def __iter__(self):
         self.count = -1
@@ -385,19 +690,30 @@ class LoadStreams:
 
     def __next__(self):
         self.count += 1
-        if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
-            cv2.destroyAllWindows()
-            raise StopIteration
-
-        im0 = self.imgs.copy()
-        if self.transforms:
-            im = np.stack([self.transforms(x) for x in im0])  # transforms
-        else:
-            im = np.stack([letterbox(x, self.img_size, stride=self.stride, auto=self.auto)[0] for x in im0])  # resize
-            im = im[..., ::-1].transpose((0, 3, 1, 2))  # BGR to RGB, BHWC to BCHW
-            im = np.ascontiguousarray(im)  # contiguous
-
-        return self.sources, im, im0, None, ''
+        while True:
+            if not all(x.is_alive() for x in self.threads) or cv2.waitKey(1) == ord('q'):  # q to quit
+                self.close()
+                cv2.destroyAllWindows()
+                raise StopIteration
+            with self.cond:  # wait for a new frame instead of re-inferring unchanged ones
+                new = [i for i, (a, b) in enumerate(zip(self.seq, self.seen)) if a > b]
+                if new:
+                    index = new if self.skip_stale else list(range(len(self.sources)))
+                    im0, seq = [self.imgs[i] for i in index], [self.seq[i] for i in index]
+                    break
+                self.cond.wait(0.1)
+
+        for i, x, n in zip(index, im0, seq):
+            if n > self.seen[i]:  # preprocess new frames only
+                self.ims[i], self.seen[i] = self._preprocess(x), n
+        self.index = index  # stream index of each batch image
+        im = np.ascontiguousarray(np.stack([self.ims[i] for i in index]))  # contiguous
+        return [self.sources[i] for i in index], im, im0, None, ''
+
+    def close(self):
+        self.stop.set()
+        for t in self.threads:
+            t.join(timeout=1)
 
     def __len__(self):
         return len(self.sources)  # 1E12 frames = 32 streams at 30 FPS for 30 years
@@ -409,6 +725,18 @@ def img2label_paths(img_paths):
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+def image_files(source):
+    # Return sorted image files under a directory, a glob or a *.txt list of image paths
+    p = Path(source)
+    if p.is_dir():
+        files = (str(x) for x in p.rglob('*.*'))
+    elif p.suffix == '.txt':
+        files = p.read_text().splitlines()
+    else:
+        files = glob.glob(str(source), recursive=True)
+    return sorted(x for x in files if x.rpartition('.')[-1].lower() in IMG_FORMATS)
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
     cache_version = 0.6  # dataset labels *.cache version
@@ -1139,6 +1467,93 @@ class HUBDatasetStats():
 
 
 # Classification dataloaders -------------------------------------------------------------------------------------------
+class ClassificationCache:
+    """ YOLOv5 decoded classification image store, i.e. im = ClassificationCache('imagenet/train.cache224', 224)[i]
+    Images are decoded once, downscaled to a shortest side of imgsz and appended to shard_bytes shard files that
+    dataloader workers read through read-only memory maps, sharing the page cache without copies. An index.npy of
+    (shard, offset, h, w, size, mtime) rows aligned with files.txt gives O(1) random access. build() reuses every
+    unchanged image and decodes only new or modified ones into new shards, shards are never rewritten.
+    """
+    version = 1  # store format version
+
+    def __init__(self, path, imgsz=224, shard_bytes=1 << 30):
+        self.path = Path(path)
+        self.imgsz = imgsz
+        self.shard_bytes = shard_bytes  # max bytes per shard file
+        self.index = np.zeros((0, 6), dtype=np.int64)  # shard, offset, h, w, file size, file mtime (ns)
+        self.shards = {}  # shard: np.memmap, opened lazily per process
+
+    def load(self, im_file):
+        # Return BGR image im_file downscaled to a shortest side of imgsz
+        im = cv2.imread(im_file)  # BGR
+        assert im is not None, f'Image Not Found {im_file}'
+        h, w = im.shape[:2]
+        r = self.imgsz / min(h, w)
+        if r < 1:  # downscale only
+            im = cv2.resize(im, (max(round(w * r), 1), max(round(h * r), 1)), interpolation=cv2.INTER_AREA)
+        return im
+
+    def build(self, files, prefix=''):
+        # Index files in order, decoding only those missing from the store or changed since stored
+        old = {}
+        f_index, f_files = self.path / 'index.npy', self.path / 'files.txt'
+        if (self.path / f'v{self.version}-{self.imgsz}').exists() and f_index.exists() and f_files.exists():
+            with contextlib.suppress(Exception):
+                old = dict(zip(f_files.read_text().splitlines(), np.load(f_index)))
+        self.path.mkdir(parents=True, exist_ok=True)
+        (self.path / f'v{self.version}-{self.imgsz}').touch()  # format marker
+        stats = [os.stat(f) for f in files]
+        index = np.zeros((len(files), 6), dtype=np.int64)
+        todo = []
+        for i, (f, st) in enumerate(zip(files, stats)):
+            x = old.get(f)
+            if x is not None and x[4] == st.st_size and x[5] == st.st_mtime_ns:
+                index[i] = x
+            else:
+                todo.append(i)
+        if todo:
+            shard = max((int(f.stem[5:]) for f in self.path.glob('shard*.bin')), default=-1) + 1
+            fp, offset = open(self.path / f'shard{shard:05d}.bin', 'wb'), 0
+            try:
+                pbar = tqdm(ThreadPool(NUM_THREADS).imap(self.load, (files[i] for i in todo)),
+                            total=len(todo),
+                            desc=f'{prefix}Caching {len(todo)} new images to {self.path}',
+                            bar_format=TQDM_BAR_FORMAT)
+                for i, im in zip(todo, pbar):
+                    if offset and offset + im.nbytes > self.shard_bytes:  # next shard
+                        fp.close()
+                        shard, offset = shard + 1, 0
+                        fp = open(self.path / f'shard{shard:05d}.bin', 'wb')
+                    fp.write(np.ascontiguousarray(im).data)
+                    index[i] = shard, offset, *im.shape[:2], stats[i].st_size, stats[i].st_mtime_ns
+                    offset += im.nbytes
+                pbar.close()
+            finally:
+                fp.close()
+        if todo or list(old) != list(files):  # new, changed, removed or reordered images
+            np.save(self.path / 'index.tmp.npy', index)  # write shards first, a killed build keeps the old index
+            (self.path / 'files.tmp').write_text('\n'.join(files))
+            os.replace(self.path / 'files.tmp', f_files)
+            os.replace(self.path / 'index.tmp.npy', f_index)
+        self.index = index
+        LOGGER.info(f'{prefix}{self.path}: {len(files) - len(todo)} cached, {len(todo)} new images, '
+                    f'{index[:, 2:4].prod(1).sum() * 3 / 1E9:.1f}GB')
+        return self
+
+    def __getitem__(self, i):
+        # Return image i as a read-only BGR HWC view into its shard
+        s, o, h, w = (int(x) for x in self.index[i, :4])
+        if s not in self.shards:
+            self.shards[s] = np.memmap(self.path / f'shard{s:05d}.bin', dtype=np.uint8, mode='r')
+        return self.shards[s][o:o + h * w * 3].reshape(h, w, 3)
+
+    def __getstate__(self):
+        return {**self.__dict__, 'shards': {}}  # workers map shards themselves instead of receiving pickled copies
+
+    def __len__(self):
+        return len(self.index)
+
+
 class ClassificationDataset(torchvision.datasets.ImageFolder):
     """
     YOLOv5 Classification Dataset.
@@ -1146,6 +1561,7 @@ class ClassificationDataset(torchvision.datasets.ImageFolder):
         root:  Dataset path
         transform:  torchvision transforms, used by default
         album_transform: Albumentations transforms, used if installed
+        cache: 'ram', 'disk' for one .npy per image, or 'mmap' for a shared ClassificationCache next to root
     """
 
     def __init__(self, root, augment, imgsz, cache=False):
@@ -1154,11 +1570,18 @@ class ClassificationDataset(torchvision.datasets.ImageFolder):
         self.album_transforms = classify_albumentations(augment, imgsz) if augment else None
         self.cache_ram = cache is True or cache == 'ram'
         self.cache_disk = cache == 'disk'
+        self.cache_mmap = cache == 'mmap'
         self.samples = [list(x) + [Path(x[0]).with_suffix('.npy'), None] for x in self.samples]  # file, index, npy, im
+        if self.cache_mmap:  # i.e. imagenet/train.cache224/
+            root = Path(root)
+            self.store = ClassificationCache(root.parent / f'{root.name}.cache{imgsz}', imgsz)
+            self.store.build([x[0] for x in self.samples])
 
     def __getitem__(self, i):
         f, j, fn, im = self.samples[i]  # filename, index, filename.with_suffix('.npy'), image
-        if self.cache_ram and im is None:
+        if self.cache_mmap:
+            im = self.store[i]
+        elif self.cache_ram and im is None:
             im = self.samples[i][3] = cv2.imread(f)
         elif self.cache_disk:
             if not fn.exists():  # load npy
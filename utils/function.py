@@ -5,15 +5,17 @@ sys.path.append(os.path.join(WORKING_DIR, "../"))
 import cv2
 import json
 import time
+import hashlib
 import requests
 import traceback
+import numpy as np
 from config import settings
-from threading import Thread
+from contextlib import contextmanager
+from threading import Thread, Event, Lock, current_thread
+from collections import OrderedDict
 from datetime import datetime
-from shapely.geometry import Polygon
-from detect import get_detected_object_v8
 from urllib.request import urlopen as url
-from utils.plots import draw_object_bboxes, draw_warning_area, convert_name_id
+# shapely, detect (torch) and utils.plots (matplotlib) are imported where used, ModelLoader preloads them in background
 
 class WebcamVideoStream:
     def __init__(self, src=0, name="WebcamVideoStream"):
@@ -91,6 +93,230 @@ class VideoStream:
         self.stream.release()
 
 
+'''Per-phase startup timeline, i.e. with timeline('sim wait'): ..., reported from run.py start and power-on'''
+class StartupTimeline:
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0  # run.py start
+        self.phases = []  # (name, start, end, thread)
+        self.lock = Lock()
+        try:
+            with open('/proc/uptime') as f:
+                self.boot = float(f.read().split()[0]) - (time.perf_counter() - self.t0)  # power-on to t0
+        except (OSError, ValueError):
+            self.boot = None
+
+    @contextmanager
+    def __call__(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, t)
+
+    def add(self, name, t=None):
+        # record phase name from perf_counter() time t (default t0) to now
+        t = self.t0 if t is None else t
+        with self.lock:
+            self.phases.append((name, t - self.t0, time.perf_counter() - self.t0, current_thread().name))
+
+    def report(self):
+        print('[INFO] Startup timeline (seconds from run.py start):')
+        with self.lock:
+            phases = sorted(self.phases, key=lambda x: x[1])
+        for name, a, b, thread in phases:
+            print(f'[INFO] {a:8.2f} -> {b:8.2f} {b - a:8.2f}s  {name} [{thread}]')
+        if self.boot is not None and phases:
+            print(f'[INFO] Done {self.boot + max(x[2] for x in phases):.1f}s after power-on.')
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+'''Load the YOLOv8 model in a background thread, from a fused serialized snapshot keyed by the weight hash if cached'''
+class ModelLoader:
+    def __init__(self, weight_path, cache_dir, cache_format='torchscript', imgsz=640, timeline=None):
+        self.weight_path = weight_path
+        self.cache_format = cache_format  # 'torchscript' or 'onnx', '' to disable the snapshot
+        self.imgsz = imgsz
+        self.timeline = timeline or StartupTimeline()
+        suffix = {'torchscript': 'torchscript', 'onnx': 'onnx'}.get(cache_format)
+        stem = os.path.splitext(os.path.basename(weight_path))[0]
+        self.snapshot = os.path.join(cache_dir, f'{stem}-{{}}.{suffix}') if suffix else None  # formatted with hash
+        self.model = None
+        self.error = None
+        self.ready = Event()
+        self.thread = Thread(target=self.run, name='ModelLoader', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def get(self, timeout=None):
+        # wait for and return the loaded model
+        self.ready.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.model
+
+    def run(self):
+        tl = self.timeline
+        snapshot = None
+        try:
+            with tl('import ultralytics'):
+                from ultralytics import YOLO
+            with tl('import detection helpers'):
+                import detect, utils.plots, shapely.geometry  # noqa, used by detect_v8()
+            if self.snapshot:
+                with tl('hash weights'):
+                    snapshot = self.snapshot.format(file_hash(self.weight_path)[:16])
+            if snapshot and os.path.exists(snapshot):
+                try:
+                    with tl('load cached snapshot'):
+                        self.model = YOLO(snapshot, 'detect')
+                        self.warmup()
+                except Exception:
+                    print(f'[INFO] Cached model {snapshot} is broken, removing it.')
+                    traceback.print_exc()
+                    os.remove(snapshot)
+                    self.model = None
+            if self.model is None:
+                with tl('load weights'):
+                    self.model = YOLO(self.weight_path, 'detect')
+                    self.warmup()
+            print('[INFO] Model ready at ' + datetime.now().strftime("%m-%d-%Y %I:%M:%S%p") + '.')
+        except Exception as e:
+            self.error = e
+        finally:
+            self.ready.set()
+        if snapshot and self.error is None and not os.path.exists(snapshot):
+            try:
+                with tl('export snapshot for next start'):
+                    self.export(snapshot)
+            except Exception:
+                print('[INFO] Export model snapshot fail.')
+                traceback.print_exc()
+
+    def warmup(self):
+        # first inference fuses the model and allocates buffers
+        self.model.predict(np.zeros((self.imgsz, self.imgsz, 3), dtype=np.uint8), imgsz=self.imgsz, verbose=False)
+
+    def export(self, snapshot):
+        from ultralytics import YOLO
+        f = YOLO(self.weight_path, 'detect').export(format=self.cache_format, imgsz=self.imgsz)
+        cache_dir = os.path.dirname(snapshot)
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = os.path.basename(self.snapshot.split('{}')[0])
+        for old in os.listdir(cache_dir):  # snapshots of previous weights
+            if old.startswith(prefix):
+                os.remove(os.path.join(cache_dir, old))
+        os.replace(f, snapshot)
+        print(f'[INFO] Saved model snapshot {snapshot} for next start.')
+
+
+'''Reuse detections of near-identical frames, keyed by a perceptual hash of the downscaled warning area and the model'''
+class DetectionCache:
+    def __init__(self, size=32, ttl=5, tolerance=4, hash_size=16, alarm=('Fire', 'Smoke'), max_hits=4):
+        self.size = size  # max cached frames, least recently used evicted first
+        self.ttl = ttl  # seconds a cached result stays valid
+        self.tolerance = tolerance  # max differing hash bits of a hit, of hash_size * hash_size
+        self.hash_size = hash_size
+        self.alarm = alarm  # labels that bypass the cache while detected
+        self.max_hits = max_hits  # consecutive hits before a forced inference, bounds the delay of a new alarm
+        self.streak = 0  # consecutive hits
+        self.entries = OrderedDict()  # (model version, hash): (time, result, inference seconds)
+        self.versions = {}  # id(model): version
+        self.active = False  # an alarm label was detected in the last inference
+        self.hits = self.misses = self.bypasses = 0
+        self.saved = 0.0  # inference seconds saved by hits
+        self.lock = Lock()
+
+    def version(self, model):
+        # weight path and modification time, a downloaded model invalidates the cache
+        if id(model) not in self.versions:
+            path = str(getattr(model, 'ckpt_path', None) or getattr(model, 'model_name', None) or id(model))
+            mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+            self.versions[id(model)] = f'{path}:{mtime}'
+        return self.versions[id(model)]
+
+    def phash(self, image, pts):
+        # difference hash of the grayscale frame with everything outside the warning area pts blacked out
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        if len(pts) != 0:
+            if len(pts) == 2:  # rectangle corners, as in check_overlap()
+                (xmin, ymin), (xmax, ymax) = pts
+                pts = [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax]]
+            mask = np.zeros_like(gray)
+            cv2.fillPoly(mask, [np.array(pts, dtype=np.int32)], 255)
+            gray = cv2.bitwise_and(gray, mask)
+        small = cv2.resize(gray, (self.hash_size + 1, self.hash_size), interpolation=cv2.INTER_AREA)
+        bits = small[:, 1:] > small[:, :-1]  # brighter than the left neighbour
+        return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+    def lookup(self, key):
+        # return the entry within tolerance bits of key, evicting expired entries
+        version, h = key
+        now = time.time()
+        for k in [k for k, (t, _, _) in self.entries.items() if now - t > self.ttl]:
+            del self.entries[k]
+        best, dist = None, self.tolerance + 1
+        for k in self.entries:
+            if k[0] == version:
+                d = bin(k[1] ^ h).count('1')
+                if d < dist:
+                    best, dist = k, d
+        if best is None:
+            return None
+        self.entries.move_to_end(best)
+        return self.entries[best]
+
+    def __call__(self, image, pts, model, predict):
+        # return predict() result, or the result of a cached near-identical frame unless an alarm is active or the
+        # last max_hits frames were all cache hits
+        with self.lock:
+            key = (self.version(model), self.phash(image, pts))
+            forced = self.max_hits and self.streak >= self.max_hits
+            entry = None if self.active or forced else self.lookup(key)
+            if entry is not None:
+                self.hits += 1
+                self.streak += 1
+                self.saved += entry[2]
+                print(f'[INFO] Detection cache hit, {self.hits}/{self.hits + self.misses} frames.')
+                return [dict(x) for x in entry[1]]
+            self.streak = 0
+            if self.active:
+                self.bypasses += 1
+            else:
+                self.misses += 1
+        t = time.time()
+        result = predict()
+        dt = time.time() - t
+        with self.lock:
+            self.active = any(x['label'] in self.alarm for x in result)
+            if not self.active:  # never replay an alarm
+                self.entries[key] = (time.time(), [dict(x) for x in result], dt)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self.lock:
+            n = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypasses': self.bypasses,
+                'hit_rate': self.hits / n if n else 0.0,
+                'saved_seconds': round(self.saved, 3),
+                'entries': len(self.entries),
+                'alarm_active': self.active}
+
+
 def reset_attempts():
     return 50
 
@@ -242,12 +468,30 @@ def double_check_class(classified_t, classified_prev):
         
 classified_prev = []
 
-def detect_v8(image, ip_camera, pts, conf_thres, iou_thres, model, json_object, use_tele, camera_name):
+'''Load the second-stage classifier that verifies low confidence detections, i.e. fire and smoke'''
+def load_verifier(weights, classes=('Fire', 'Smoke'), conf=0.6, accept=0.5, max_crops=8, imgsz=224, device=''):
+    from models.common import DetectMultiBackend
+    from utils.torch_utils import select_device
+    from utils.verifier import Verifier
+    model = DetectMultiBackend(weights, device=select_device(device))
+    model.warmup(imgsz=(1 if model.pt else max_crops, 3, imgsz, imgsz))
+    print(f'[INFO] Verifier {weights} checks {", ".join(classes)} below {conf} confidence.')
+    return Verifier(model, classes, conf, accept, max_crops, imgsz)
+
+
+def detect_v8(image, ip_camera, pts, conf_thres, iou_thres, model, json_object, use_tele, camera_name, cache=None,
+              verifier=None):
     global classified_prev
+    from detect import get_detected_object_v8
+    from utils.plots import draw_object_bboxes, draw_warning_area
     try:
         input_image = f'{settings.IMAGE_FOLDER}/original.jpg' # original image path
         cv2.imwrite(input_image, image) # save original image
-        classified = get_detected_object_v8(image, conf_thres, iou_thres, model, json_object) # objects detection on image with yolov8            
+
+        def predict():
+            classified = get_detected_object_v8(image, conf_thres, iou_thres, model, json_object) # objects detection on image with yolov8
+            return verifier.filter(image, classified) if verifier is not None else classified # optional Verifier
+        classified = cache(image, pts, model, predict) if cache is not None else predict() # optional DetectionCache
         if len(classified) != 0:
             classified_overlap = check_overlap(classified, pts)  
             if len(classified_overlap) != 0:
@@ -437,6 +681,7 @@ def checking_camera(URL):
 
 '''Check if bbox of object touch to warning area'''
 def check_overlap(classified, PTS_Area):
+    from shapely.geometry import Polygon
     new_classified = []
     if len(PTS_Area) != 0:
         if len(PTS_Area) == 2:
@@ -467,6 +712,7 @@ def check_overlap(classified, PTS_Area):
 
 '''Convert to the correct message format to send to the server'''
 def get_message(classified, json_object):
+    from utils.plots import convert_name_id
     messages = []
     result = []
     # get infomation
@@ -5,6 +5,7 @@ Loss functions
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from utils.metrics import bbox_iou
 from utils.torch_utils import de_parallel
@@ -174,6 +175,39 @@ class ComputeLoss:
 
         return (lbox + lobj + lcls) * bs, torch.cat((lbox, lobj, lcls)).detach()
 
+    def distill(self, p, tp, feats=(), tatt=(), T=2.0):
+        # Knowledge distillation losses against a frozen teacher's raw predictions tp on the same anchors: soft-label
+        # objectness/class BCE at temperature T, teacher-objectness weighted box imitation, attention map imitation
+        lsoft = torch.zeros(1, device=self.device)  # soft-label loss
+        lbox = torch.zeros(1, device=self.device)  # box imitation loss
+        lfeat = torch.zeros(1, device=self.device)  # feature imitation loss
+
+        def kl(s, t):  # binary KL divergence of student from teacher logits at temperature T
+            t = t / T
+            return F.binary_cross_entropy_with_logits(s / T, t.sigmoid(), reduction='none') - \
+                F.binary_cross_entropy_with_logits(t, t.sigmoid(), reduction='none')
+
+        for i, (pi, ti) in enumerate(zip(p, tp)):
+            pi, ti = pi.float(), ti.to(self.device).float()
+            lsoft += kl(pi[..., 4], ti[..., 4]).mean() * self.balance[i]
+            w = ti[..., 4:5].sigmoid()  # teacher objectness, imitate boxes and classes where the teacher sees objects
+            if self.nc > 1:
+                lsoft += (kl(pi[..., 5:5 + self.nc], ti[..., 5:5 + self.nc]) * w).sum() / (w.sum() * self.nc + 1E-9)
+            lbox += ((pi[..., :4].sigmoid() - ti[..., :4].sigmoid()) ** 2 * w).sum() / (w.sum() * 4 + 1E-9)
+        for f, a in zip(feats, tatt):
+            lfeat += (self.attention(f) - a.to(self.device).float()).pow(2).sum(1).mean()
+        lsoft *= self.hyp.get('kd_soft', 1.0) * T * T
+        lbox *= self.hyp.get('kd_box', 1.0)
+        lfeat *= self.hyp.get('kd_feat', 1.0)
+        bs = p[0].shape[0]  # batch size
+
+        return (lsoft + lbox + lfeat) * bs, torch.cat((lsoft, lbox, lfeat)).detach()
+
+    @staticmethod
+    def attention(x):
+        # Spatial attention map of features x(bs,c,h,w) as L2-normalized (bs,h*w) channel-mean squared activations
+        return F.normalize(x.float().pow(2).mean(1).flatten(1))
+
     def build_targets(self, p, targets):
         # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
         na, nt = self.na, targets.shape[0]  # number of anchors, targets
@@ -3,7 +3,6 @@
 Model validation metrics
 """
 
-import math
 import warnings
 from pathlib import Path
 
@@ -12,6 +11,8 @@ import numpy as np
 import torch
 
 from utils import TryExcept, threaded
+from utils.ops import bbox_iou, box_iou  # noqa, re-exported
+from utils.ops import non_max_suppression, xywh2xyxy
 
 
 def fitness(x):
@@ -78,6 +79,11 @@ def ap_per_class(tp, conf, pred_cls, target_cls, plot=False, save_dir='.', names
             if plot and j == 0:
                 py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
 
+    return pr_summary(px, py, ap, p, r, unique_classes, nt, plot, save_dir, names, eps, prefix)
+
+
+def pr_summary(px, py, ap, p, r, unique_classes, nt, plot=False, save_dir='.', names=(), eps=1e-16, prefix=''):
+    # Reduce per-class P/R curves to max-F1 operating point results, optionally plotting curves
     # Compute F1 (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + eps)
     names = [v for k, v in names.items() if k in unique_classes]  # list: only classes that have data
@@ -123,6 +129,136 @@ def compute_ap(recall, precision):
     return ap, mpre, mrec
 
 
+def process_batch(detections, labels, iouv):
+    """
+    Return correct prediction matrix
+    Arguments:
+        detections (array[N, 6]), x1, y1, x2, y2, conf, class
+        labels (array[M, 5]), class, x1, y1, x2, y2
+    Returns:
+        correct (array[N, 10]), for 10 IoU levels
+    """
+    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
+    iou = box_iou(labels[:, 1:], detections[:, :4])
+    correct_class = labels[:, 0:1] == detections[:, 5]
+    for i in range(len(iouv)):
+        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
+        if x[0].shape[0]:
+            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
+            if x[0].shape[0] > 1:
+                matches = matches[matches[:, 2].argsort()[::-1]]
+                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+            correct[matches[:, 1].astype(int), i] = True
+    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+
+
+@torch.no_grad()
+def evaluate(model, dataloader, device=torch.device('cpu')):
+    # Return mAP@0.5 and mAP@0.5:0.95 of a detection model on a dataloader
+    model.eval()
+    iouv = torch.linspace(0.5, 0.95, 10, device=device)
+    stats = []
+    for imgs, targets, _, _ in dataloader:
+        imgs = imgs.to(device).float() / 255
+        targets = targets.to(device)
+        h, w = imgs.shape[2:]
+        preds = non_max_suppression(model(imgs)[0], 0.001, 0.6, max_det=300)
+        targets[:, 2:] = xywh2xyxy(targets[:, 2:] * torch.tensor((w, h, w, h), device=device))
+        for si, pred in enumerate(preds):
+            labels = targets[targets[:, 0] == si, 1:]
+            correct = process_batch(pred, labels, iouv) if len(labels) else torch.zeros(len(pred), 10, dtype=torch.bool)
+            stats.append((correct.cpu(), pred[:, 4].cpu(), pred[:, 5].cpu(), labels[:, 0].cpu()))
+    if not stats:  # empty dataloader
+        return 0.0, 0.0
+    tp, conf, pcls, tcls = (torch.cat(x, 0).numpy() for x in zip(*stats))
+    if not len(tp) or not len(tcls):
+        return 0.0, 0.0
+    *_, ap, _ = ap_per_class(tp, conf, pcls, tcls, names=model.names)
+    return float(ap[:, 0].mean()), float(ap.mean())
+
+
+class APAccumulator:
+    """ Streaming average precision accumulator with bounded memory.
+    Predictions are binned by confidence into per-class histograms of (predictions, TPs at each IoU threshold), so
+    memory is O(nc * bins * niou) regardless of dataset size. Accumulators from different processes can be merged
+    with `+=` before calling compute(), which returns the same tuple as ap_per_class().
+    Usage:
+        acc = APAccumulator(nc=80)
+        acc.update(tp, conf, pred_cls, target_cls)  # per image or per batch
+        tp, fp, p, r, f1, ap, ap_class = acc.compute()
+    """
+
+    def __init__(self, nc, niou=10, bins=1000):
+        self.nc = nc  # number of classes
+        self.bins = bins  # confidence bins
+        self.n = np.zeros((nc, bins), dtype=np.int64)  # predictions per class and confidence bin
+        self.tp = np.zeros((nc, bins, niou), dtype=np.int64)  # true positives per class, confidence bin and IoU
+        self.nt = np.zeros(nc, dtype=np.int64)  # targets per class
+
+    def update(self, tp, conf, pred_cls, target_cls):
+        """
+        Arguments:
+            tp:  True positives (nparray or tensor, nx1 or nx10).
+            conf:  Objectness value from 0-1 (nparray or tensor).
+            pred_cls:  Predicted object classes (nparray or tensor).
+            target_cls:  True object classes (nparray or tensor).
+        """
+        tp, conf, pred_cls, target_cls = (x.cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x)
+                                          for x in (tp, conf, pred_cls, target_cls))
+        if len(conf):
+            b = np.clip((conf * self.bins).astype(int), 0, self.bins - 1)  # confidence bin
+            c = pred_cls.astype(int)
+            np.add.at(self.n, (c, b), 1)
+            np.add.at(self.tp, (c, b), tp.reshape(len(conf), -1).astype(np.int64))
+        self.nt += np.bincount(target_cls.astype(int), minlength=self.nc)[:self.nc]
+
+    def __iadd__(self, other):
+        # Merge partial results, i.e. from a worker process validating another shard of the dataset
+        assert self.tp.shape == other.tp.shape, f'can not merge APAccumulator {other.tp.shape} into {self.tp.shape}'
+        self.n += other.n
+        self.tp += other.tp
+        self.nt += other.nt
+        return self
+
+    def compute(self, plot=False, save_dir='.', names=(), eps=1e-16, prefix=''):
+        # Return ap_per_class() results from the accumulated histograms
+        unique_classes = np.nonzero(self.nt)[0]
+        nt = self.nt[unique_classes]
+        nc, niou = unique_classes.shape[0], self.tp.shape[2]
+        lower = np.arange(self.bins)[::-1] / self.bins  # bin lower edges, descending confidence
+
+        # Create Precision-Recall curve and compute AP for each class
+        px, py = np.linspace(0, 1, 1000), []  # for plotting
+        ap, p, r = np.zeros((nc, niou)), np.zeros((nc, 1000)), np.zeros((nc, 1000))
+        for ci, c in enumerate(unique_classes):
+            n = self.n[c, ::-1]
+            i = n > 0
+            if not i.any():
+                continue
+
+            # Accumulate FPs and TPs
+            tpc = self.tp[c, ::-1][i].cumsum(0)
+            fpc = n[i].cumsum(0)[:, None] - tpc
+            conf = lower[i]
+
+            # Recall
+            recall = tpc / (nt[ci] + eps)  # recall curve
+            r[ci] = np.interp(-px, -conf, recall[:, 0], left=0)  # negative x, xp because xp decreases
+
+            # Precision
+            precision = tpc / (tpc + fpc)  # precision curve
+            p[ci] = np.interp(-px, -conf, precision[:, 0], left=1)  # p at pr_score
+
+            # AP from recall-precision curve
+            for j in range(niou):
+                ap[ci, j], mpre, mrec = compute_ap(recall[:, j], precision[:, j])
+                if plot and j == 0:
+                    py.append(np.interp(px, mrec, mpre))  # precision at mAP@0.5
+
+        return pr_summary(px, py, ap, p, r, unique_classes, nt, plot, save_dir, names, eps, prefix)
+
+
 class ConfusionMatrix:
     # Updated version of https://github.com/kaanakan/object_detection_confusion_matrix
     def __init__(self, nc, conf=0.25, iou_thres=0.45):
@@ -131,25 +267,18 @@ class ConfusionMatrix:
         self.conf = conf
         self.iou_thres = iou_thres
 
-    def process_batch(self, detections, labels):
+    def match(self, detections, labels):
         """
-        Return intersection-over-union (Jaccard index) of boxes.
-        Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
+        Match detections to labels for a single image.
         Arguments:
             detections (Array[N, 6]), x1, y1, x2, y2, conf, class
             labels (Array[M, 5]), class, x1, y1, x2, y2
         Returns:
-            None, updates confusion matrix accordingly
+            (rows, cols) (ndarray[K], ndarray[K]), confusion matrix indices (predicted, true) to increment
         """
-        if detections is None:
-            gt_classes = labels.int()
-            for gc in gt_classes:
-                self.matrix[self.nc, gc] += 1  # background FN
-            return
-
+        gt_classes = labels[:, 0].int().cpu().numpy()
         detections = detections[detections[:, 4] > self.conf]
-        gt_classes = labels[:, 0].int()
-        detection_classes = detections[:, 5].int()
+        detection_classes = detections[:, 5].int().cpu().numpy()
         iou = box_iou(labels[:, 1:], detections[:, :4])
 
         x = torch.where(iou > self.iou_thres)
@@ -163,19 +292,57 @@ class ConfusionMatrix:
         else:
             matches = np.zeros((0, 3))
 
-        n = matches.shape[0] > 0
-        m0, m1, _ = matches.transpose().astype(int)
-        for i, gc in enumerate(gt_classes):
-            j = m0 == i
-            if n and sum(j) == 1:
-                self.matrix[detection_classes[m1[j]], gc] += 1  # correct
-            else:
-                self.matrix[self.nc, gc] += 1  # true background
+        m0, m1 = matches[:, 0].astype(int), matches[:, 1].astype(int)  # matched label, detection indices
+        fn = np.ones(len(gt_classes), dtype=bool)  # labels without a match (true background)
+        fn[m0] = False
+        rows = [detection_classes[m1], np.full(fn.sum(), self.nc)]  # correct, true background
+        cols = [gt_classes[m0], gt_classes[fn]]
+        if len(matches):
+            fp = np.ones(len(detection_classes), dtype=bool)  # detections without a match (predicted background)
+            fp[m1] = False
+            rows.append(detection_classes[fp])
+            cols.append(np.full(fp.sum(), self.nc))
+        return np.concatenate(rows), np.concatenate(cols)
 
-        if n:
-            for i, dc in enumerate(detection_classes):
-                if not any(m1 == i):
-                    self.matrix[dc, self.nc] += 1  # predicted background
+    def process_batch(self, detections, labels):
+        """
+        Return intersection-over-union (Jaccard index) of boxes.
+        Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
+        Arguments:
+            detections (Array[N, 6]), x1, y1, x2, y2, conf, class
+            labels (Array[M, 5]), class, x1, y1, x2, y2
+        Returns:
+            None, updates confusion matrix accordingly
+        """
+        if detections is None:
+            gt_classes = labels.int().cpu().numpy()
+            np.add.at(self.matrix, (self.nc, gt_classes), 1)  # background FN
+            return
+        np.add.at(self.matrix, self.match(detections, labels), 1)
+
+    def process_batches(self, detections, labels):
+        """
+        Update the confusion matrix for a whole batch of images with a single scatter-add.
+        Arguments:
+            detections (List[Array[N, 6]]), per-image x1, y1, x2, y2, conf, class (None if no predictions)
+            labels (List[Array[M, 5]]), per-image class, x1, y1, x2, y2
+        Returns:
+            None, updates confusion matrix accordingly
+        """
+        rows, cols = [], []
+        for d, l in zip(detections, labels):
+            if d is None or not len(d):
+                gt_classes = l[:, 0].int().cpu().numpy()
+                rows.append(np.full(len(gt_classes), self.nc))
+                cols.append(gt_classes)
+            else:
+                r, c = self.match(d, l)
+                rows.append(r)
+                cols.append(c)
+        if rows:
+            n = self.nc + 1
+            idx = np.concatenate(rows).astype(int) * n + np.concatenate(cols).astype(int)  # flat matrix index
+            self.matrix += np.bincount(idx, minlength=n * n).reshape(n, n)
 
     def tp_fp(self):
         tp = self.matrix.diagonal()  # true positives
@@ -219,68 +386,6 @@ class ConfusionMatrix:
             print(' '.join(map(str, self.matrix[i])))
 
 
-def bbox_iou(box1, box2, xywh=True, GIoU=False, DIoU=False, CIoU=False, eps=1e-7):
-    # Returns Intersection over Union (IoU) of box1(1,4) to box2(n,4)
-
-    # Get the coordinates of bounding boxes
-    if xywh:  # transform from xywh to xyxy
-        (x1, y1, w1, h1), (x2, y2, w2, h2) = box1.chunk(4, -1), box2.chunk(4, -1)
-        w1_, h1_, w2_, h2_ = w1 / 2, h1 / 2, w2 / 2, h2 / 2
-        b1_x1, b1_x2, b1_y1, b1_y2 = x1 - w1_, x1 + w1_, y1 - h1_, y1 + h1_
-        b2_x1, b2_x2, b2_y1, b2_y2 = x2 - w2_, x2 + w2_, y2 - h2_, y2 + h2_
-    else:  # x1, y1, x2, y2 = box1
-        b1_x1, b1_y1, b1_x2, b1_y2 = box1.chunk(4, -1)
-        b2_x1, b2_y1, b2_x2, b2_y2 = box2.chunk(4, -1)
-        w1, h1 = b1_x2 - b1_x1, (b1_y2 - b1_y1).clamp(eps)
-        w2, h2 = b2_x2 - b2_x1, (b2_y2 - b2_y1).clamp(eps)
-
-    # Intersection area
-    inter = (b1_x2.minimum(b2_x2) - b1_x1.maximum(b2_x1)).clamp(0) * \
-            (b1_y2.minimum(b2_y2) - b1_y1.maximum(b2_y1)).clamp(0)
-
-    # Union Area
-    union = w1 * h1 + w2 * h2 - inter + eps
-
-    # IoU
-    iou = inter / union
-    if CIoU or DIoU or GIoU:
-        cw = b1_x2.maximum(b2_x2) - b1_x1.minimum(b2_x1)  # convex (smallest enclosing box) width
-        ch = b1_y2.maximum(b2_y2) - b1_y1.minimum(b2_y1)  # convex height
-        if CIoU or DIoU:  # Distance or Complete IoU https://arxiv.org/abs/1911.08287v1
-            c2 = cw ** 2 + ch ** 2 + eps  # convex diagonal squared
-            rho2 = ((b2_x1 + b2_x2 - b1_x1 - b1_x2) ** 2 + (b2_y1 + b2_y2 - b1_y1 - b1_y2) ** 2) / 4  # center dist ** 2
-            if CIoU:  # https://github.com/Zzh-tju/DIoU-SSD-pytorch/blob/master/utils/box/box_utils.py#L47
-                v = (4 / math.pi ** 2) * (torch.atan(w2 / h2) - torch.atan(w1 / h1)).pow(2)
-                with torch.no_grad():
-                    alpha = v / (v - iou + (1 + eps))
-                return iou - (rho2 / c2 + v * alpha)  # CIoU
-            return iou - rho2 / c2  # DIoU
-        c_area = cw * ch + eps  # convex area
-        return iou - (c_area - union) / c_area  # GIoU https://arxiv.org/pdf/1902.09630.pdf
-    return iou  # IoU
-
-
-def box_iou(box1, box2, eps=1e-7):
-    # https://github.com/pytorch/vision/blob/master/torchvision/ops/boxes.py
-    """
-    Return intersection-over-union (Jaccard index) of boxes.
-    Both sets of boxes are expected to be in (x1, y1, x2, y2) format.
-    Arguments:
-        box1 (Tensor[N, 4])
-        box2 (Tensor[M, 4])
-    Returns:
-        iou (Tensor[N, M]): the NxM matrix containing the pairwise
-            IoU values for every element in boxes1 and boxes2
-    """
-
-    # inter(N,M) = (rb(N,M,2) - lt(N,M,2)).clamp(0).prod(2)
-    (a1, a2), (b1, b2) = box1.unsqueeze(1).chunk(2, 2), box2.unsqueeze(0).chunk(2, 2)
-    inter = (torch.min(a2, b2) - torch.max(a1, b1)).clamp(0).prod(2)
-
-    # IoU = inter / (area1 + area2 - inter)
-    return inter / ((a2 - a1).prod(2) + (b2 - b1).prod(2) - inter + eps)
-
-
 def bbox_ioa(box1, box2, eps=1e-7):
     """ Returns the intersection over box2 area given box1, box2. Boxes are x1y1x2y2
     box1:       np.array of shape(4)
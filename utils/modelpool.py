@@ -0,0 +1,198 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Model pool utils, multi-instance CPU inference with per-instance core pinning
+"""
+
+import contextlib
+import multiprocessing
+import os
+import queue
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from utils.general import LOGGER, colorstr
+
+
+def cpu_nodes():
+    # Return usable logical cores grouped by NUMA node, i.e. [[0, 1, 2, 3], [4, 5, 6, 7]], a single node if unknown
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    nodes = []
+    for f in sorted(Path('/sys/devices/system/node').glob('node[0-9]*/cpulist')):  # Linux-only
+        ids = set()
+        for r in f.read_text().strip().split(','):
+            a, _, b = r.partition('-')
+            if a:
+                ids.update(range(int(a), int(b or a) + 1))
+        if ids & set(cores):
+            nodes.append([c for c in cores if c in ids])
+    return nodes or [cores]
+
+
+def core_sets(instances, threads):
+    # Return `instances` disjoint sets of `threads` cores, none straddling NUMA nodes, or None if they do not fit
+    sets = []
+    for node in cpu_nodes():
+        sets += [node[i:i + threads] for i in range(0, len(node) - threads + 1, threads)]
+    return sets[:instances] if len(sets) >= instances else None
+
+
+def _worker(k, weights, imgsz, threads, cores, inputs, outputs):
+    # Pool instance process: load the model, then letterbox, infer and NMS (i, im, nms) inputs until None
+    from models.common import DetectMultiBackend, DetectPipeline
+
+    try:
+        torch.set_num_threads(threads)
+        if cores and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        model = DetectMultiBackend(weights, device=torch.device('cpu'), ort_threads=threads)
+        pipeline = DetectPipeline(model, imgsz, threaded=False)
+        outputs.put((k, -1, None))  # ready
+    except Exception as e:
+        outputs.put((k, -1, e))
+        return
+    while (item := inputs.get()) is not None:
+        i, im, nms = item
+        try:
+            pipeline.__dict__.update(nms)  # conf, iou, classes, agnostic, multi_label, max_det
+            (_, det), = pipeline([im])
+            outputs.put((k, i, det.numpy()))
+        except Exception as e:
+            outputs.put((k, i, e))
+
+
+class ModelPool:
+    """ YOLOv5 multi-instance CPU inference, i.e. for im0, det in ModelPool('yolov5s.onnx', 4, 2).map(frames)
+    Runs `instances` independent model processes, each pinned to its own `threads` cores on one NUMA node, instead of
+    one model whose intra-op threads synchronize across all cores at every layer. Frames go to the least-loaded
+    instance and results come back in input order. instances=0 picks instances and threads with autopool(). NMS
+    settings are sent with every frame, so pool.conf = 0.5 applies from the next map() call.
+    """
+    conf = 0.25  # NMS confidence threshold
+    iou = 0.45  # NMS IoU threshold
+    agnostic = False  # NMS class-agnostic
+    multi_label = False  # NMS multiple labels per box
+    classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
+    max_det = 1000  # maximum number of detections per image
+
+    def __init__(self, weights='yolov5s.pt', instances=0, threads=0, imgsz=640, depth=2):
+        if not instances:
+            instances, threads = autopool(weights, imgsz)
+        ncores = sum(len(x) for x in cpu_nodes())
+        threads = threads or max(ncores // instances, 1)
+        cores = core_sets(instances, threads) or [None] * instances  # unpinned if oversubscribed
+        ctx = multiprocessing.get_context('spawn')
+        self.inputs = [ctx.Queue() for _ in range(instances)]
+        self.outputs = ctx.Queue()
+        self.workers = [
+            ctx.Process(target=_worker,
+                        args=(k, weights, imgsz, threads, cores[k], self.inputs[k], self.outputs),
+                        daemon=True) for k in range(instances)]
+        for p in self.workers:
+            p.start()
+        self.load = [0] * instances  # in-flight frames per instance
+        self.depth = depth  # maximum in-flight frames per instance
+        self.instances, self.threads, self.cores = instances, threads, cores
+        for _ in range(instances):  # wait for models to load
+            try:
+                k, _, e = self._get()
+            except RuntimeError:
+                self.close()
+                raise
+            if e is not None:
+                self.close()
+                raise e
+
+    def _get(self):
+        # Receive one (instance, index, result) message, raising instead of blocking forever if an instance died
+        while True:
+            try:
+                return self.outputs.get(timeout=1)
+            except queue.Empty:
+                for k, p in enumerate(self.workers):
+                    if not p.is_alive():
+                        raise RuntimeError(f'ModelPool instance {k} died with exit code {p.exitcode}')
+
+    def _collect(self, done):
+        # Receive one result from any instance into done {index: det}
+        k, i, det = self._get()
+        self.load[k] -= 1
+        if isinstance(det, Exception):
+            raise det
+        done[i] = torch.from_numpy(det)
+
+    def map(self, source):
+        # Yield (im0, det) for each BGR HWC image in source, in order, with det (n,6) [xyxy, conf, cls] in im0 pixels
+        ims, done, j = {}, {}, 0
+        nms = {k: getattr(self, k) for k in ('conf', 'iou', 'agnostic', 'multi_label', 'classes', 'max_det')}
+        try:
+            for i, im in enumerate(source):
+                while sum(self.load) >= self.depth * self.instances:  # backpressure
+                    self._collect(done)
+                k = self.load.index(min(self.load))  # least-loaded instance
+                self.inputs[k].put((i, im, nms))
+                self.load[k] += 1
+                ims[i] = im
+                while j in done:
+                    yield ims.pop(j), done.pop(j)
+                    j += 1
+            while ims:
+                while j not in done:
+                    self._collect(done)
+                yield ims.pop(j), done.pop(j)
+                j += 1
+        finally:
+            while sum(self.load) and all(p.is_alive() for p in self.workers):  # discard in-flight results
+                with contextlib.suppress(Exception):
+                    self._collect({})
+
+    def close(self):
+        for q, p in zip(self.inputs, self.workers):
+            if p.is_alive():
+                q.put(None)
+            else:  # nothing reads a dead instance's queue, do not block exit flushing it
+                q.cancel_join_thread()
+        for p in self.workers:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def autopool(weights='yolov5s.pt', imgsz=640, frames=32, shape=(720, 1280, 3)):
+    # Automatically pick ModelPool (instances, threads) with the best throughput from a short calibration run
+    # Usage:
+    #     from utils.modelpool import ModelPool, autopool
+    #     instances, threads = autopool('yolov5s.onnx')
+    #     pool = ModelPool('yolov5s.onnx', instances, threads)
+    prefix = colorstr('AutoPool: ')
+    ncores = sum(len(x) for x in cpu_nodes())
+    LOGGER.info(f'{prefix}Calibrating instances x threads for {weights} on {ncores} cores with {frames} frames')
+    ims = [np.random.randint(0, 255, shape, dtype=np.uint8) for _ in range(frames)]
+    candidates = [(k, ncores // k) for k in (1, 2, 4, 8, 16, 32, 64) if k <= ncores]
+    results = {}
+    for instances, threads in candidates:
+        try:
+            with ModelPool(weights, instances, threads, imgsz) as pool:
+                for _ in pool.map(ims[:2 * instances]):  # warmup every instance
+                    pass
+                t0 = time.perf_counter()
+                for _ in pool.map(ims):
+                    pass
+                t = results[(instances, threads)] = frames / (time.perf_counter() - t0)
+            LOGGER.info(f'{prefix}{instances:>3d} instances x {threads:>3d} threads{t:8.1f} img/s')
+        except Exception as e:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ {instances} instances x {threads} threads failed: {e}')
+    if not results:
+        LOGGER.warning(f'{prefix}WARNING ⚠️ calibration failed, using 1 instance x {ncores} threads')
+        return 1, ncores
+    best = max(results, key=results.get)
+    LOGGER.info(f'{prefix}Using {best[0]} instances x {best[1]} threads ({results[best]:.1f} img/s) ✅')
+    return best
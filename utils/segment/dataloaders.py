@@ -5,6 +5,7 @@ Dataloaders
 
 import os
 import random
+import threading
 
 import cv2
 import numpy as np
@@ -12,12 +13,13 @@ import torch
 from torch.utils.data import DataLoader, distributed
 
 from ..augmentations import augment_hsv, copy_paste, letterbox
-from ..dataloaders import InfiniteDataLoader, LoadImagesAndLabels, seed_worker
+from ..dataloaders import InfiniteDataLoader, LoadImagesAndLabels, ShardSampler, seed_worker
 from ..general import LOGGER, xyn2xy, xywhn2xyxy, xyxy2xywhn
 from ..torch_utils import torch_distributed_zero_first
 from .augmentations import mixup, random_perspective
 
 RANK = int(os.getenv('RANK', -1))
+_SCRATCH = threading.local()  # polygon rasterization buffers
 
 
 def create_dataloader(path,
@@ -38,7 +40,8 @@ def create_dataloader(path,
                       shuffle=False,
                       mask_downsample_ratio=1,
                       overlap_mask=False,
-                      seed=0):
+                      seed=0,
+                      shard=None):
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
@@ -63,7 +66,11 @@ def create_dataloader(path,
     nd = torch.cuda.device_count()  # number of CUDA devices
     nw = min([os.cpu_count() // max(nd, 1), batch_size if batch_size > 1 else 0, workers])  # number of workers
     sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
+    if shard:  # (index, count) batch-aligned shard for multi-process validation
+        sampler = ShardSampler(dataset, batch_size, *shard)
     loader = DataLoader if image_weights else InfiniteDataLoader  # only DataLoader allows for attribute updates
+    if shard and not len(sampler):
+        loader = DataLoader  # InfiniteDataLoader would spin forever on an empty shard
     generator = torch.Generator()
     generator.manual_seed(6148914691236517205 + seed + RANK)
     return loader(
@@ -292,6 +299,46 @@ def polygon2mask(img_size, polygons, color=1, downsample_ratio=1):
     return mask
 
 
+def _scratch(h, w):
+    # Return a zeroed (h, w) uint8 view of a per-thread rasterization buffer, reused across samples
+    buf = getattr(_SCRATCH, 'buf', None)
+    if buf is None or buf.size < h * w:
+        buf = _SCRATCH.buf = np.empty(h * w, dtype=np.uint8)
+    buf = buf[:h * w].reshape(h, w)
+    buf.fill(0)
+    return buf
+
+
+def polygon_rois(img_size, polygons, color=1, downsample_ratio=1):
+    """
+    Rasterize each polygon inside its bbox only, aligned to the downsample grid so that the result equals
+    polygon2mask() of the polygon over the full image.
+    Args:
+        img_size (tuple): The image size.
+        polygons (list[np.ndarray]): each polygon is [N, M], M is the number of points(Be divided by 2).
+
+    Returns:
+        list of (y slice, x slice, mask) in downsampled image pixels.
+    """
+    h, w = img_size[:2]
+    r = downsample_ratio
+    aligned = h % r == 0 and w % r == 0  # ROIs resize like the full image only on an exact downsample grid
+    rois = []
+    for polygon in polygons:
+        p = np.asarray(polygon).astype(np.int32).reshape(-1, 2)
+        if aligned and len(p):
+            x, y, bw, bh = cv2.boundingRect(p)
+            x1, y1 = min(max(x, 0), w - 1) // r * r, min(max(y, 0), h - 1) // r * r
+            x2, y2 = -(-min(max(x + bw, 1), w) // r) * r, -(-min(max(y + bh, 1), h) // r) * r  # round up to grid
+        else:
+            x1, y1, x2, y2 = 0, 0, w, h
+        mask = _scratch(y2 - y1, x2 - x1)
+        cv2.fillPoly(mask, [p - (x1, y1)], color=color)
+        mask = cv2.resize(mask, ((x2 - x1) // r, (y2 - y1) // r))  # new array, scratch is reused
+        rois.append((slice(y1 // r, y1 // r + mask.shape[0]), slice(x1 // r, x1 // r + mask.shape[1]), mask))
+    return rois
+
+
 def polygons2masks(img_size, polygons, color, downsample_ratio=1):
     """
     Args:
@@ -300,33 +347,20 @@ def polygons2masks(img_size, polygons, color, downsample_ratio=1):
             N is the number of polygons,
             M is the number of points(Be divided by 2).
     """
-    masks = []
-    for si in range(len(polygons)):
-        mask = polygon2mask(img_size, [polygons[si].reshape(-1)], color, downsample_ratio)
-        masks.append(mask)
-    return np.array(masks)
+    masks = np.zeros((len(polygons), img_size[0] // downsample_ratio, img_size[1] // downsample_ratio), dtype=np.uint8)
+    for mask, (ys, xs, m) in zip(masks, polygon_rois(img_size, polygons, color, downsample_ratio)):
+        mask[ys, xs] = m
+    return masks
 
 
 def polygons2masks_overlap(img_size, segments, downsample_ratio=1):
-    """Return a (640, 640) overlap mask."""
+    """Return a (640, 640) overlap mask, each pixel labelled with the smallest-area instance covering it."""
     masks = np.zeros((img_size[0] // downsample_ratio, img_size[1] // downsample_ratio),
                      dtype=np.int32 if len(segments) > 255 else np.uint8)
-    areas = []
-    ms = []
-    for si in range(len(segments)):
-        mask = polygon2mask(
-            img_size,
-            [segments[si].reshape(-1)],
-            downsample_ratio=downsample_ratio,
-            color=1,
-        )
-        ms.append(mask)
-        areas.append(mask.sum())
-    areas = np.asarray(areas)
+    rois = polygon_rois(img_size, segments, color=1, downsample_ratio=downsample_ratio)
+    areas = np.asarray([m.sum() for *_, m in rois])
     index = np.argsort(-areas)
-    ms = np.array(ms)[index]
-    for i in range(len(segments)):
-        mask = ms[i] * (i + 1)
-        masks = masks + mask
-        masks = np.clip(masks, a_min=0, a_max=i + 1)
+    for i, j in enumerate(index):  # largest first, smaller instances on top
+        ys, xs, m = rois[j]
+        masks[ys, xs][m.astype(bool)] = i + 1
     return masks, index
@@ -3,6 +3,8 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
+from utils.segment.rle import RLE
+
 
 def crop_mask(masks, boxes):
     """
@@ -90,6 +92,108 @@ def process_mask_native(protos, masks_in, bboxes, shape):
     return masks.gt_(0.5)
 
 
+def _interp_matrix(p, n):
+    """
+    Bilinear interpolation weights [k, n] sampling a length-n signal at k positions p, clamped to the signal ends as
+    F.interpolate(align_corners=False) does.
+    """
+    p = p.clamp(0, n - 1)
+    i = p.floor().long().clamp(max=max(n - 2, 0))
+    w = p - i
+    m = torch.zeros(len(p), n, device=p.device)
+    k = torch.arange(len(p), device=p.device)
+    m[k, i] = 1 - w
+    if n > 1:
+        m[k, i + 1] += w
+    return m
+
+
+class RoiMasks:
+    """
+    Instance masks decoded only inside their boxes by process_mask_roi(), so memory and time scale with the box areas
+    instead of n x image area. Iterates as (box, mask) pairs of (x1, y1, x2, y2) int image pixel boxes and boolean
+    [y2 - y1, x2 - x1] masks. full() materializes [n, h, w] image masks on demand.
+    """
+
+    def __init__(self, boxes, masks, shape):
+        self.boxes = boxes  # [n, 4] int64 xyxy, clipped to shape
+        self.masks = masks  # n boolean [y2 - y1, x2 - x1] ROI masks
+        self.shape = tuple(shape[:2])  # image h, w
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __iter__(self):
+        return zip(self.boxes.tolist(), self.masks)
+
+    def full(self):
+        # Return [n, h, w] boolean image masks
+        out = torch.zeros((len(self), *self.shape), dtype=torch.bool, device=self.boxes.device)
+        for i, ((x1, y1, x2, y2), m) in enumerate(self):
+            out[i, y1:y2, x1:x2] = m
+        return out
+
+    def area(self):
+        # Return [n] mask pixel areas
+        return torch.tensor([int(m.sum()) for m in self.masks], device=self.boxes.device)
+
+    def rle(self):
+        # Return n RLE masks, encoded from the ROIs without full image masks
+        return [RLE.from_roi(b, m, self.shape) for b, m in self]
+
+    def segments(self, strategy='largest'):
+        # Return masks2segments() image pixel segments, tracing contours in each ROI only
+        return [masks2segments(m[None], strategy)[0] + (x1, y1) for (x1, y1, _, _), m in self]
+
+    def plot(self, im, colors, alpha=0.5):
+        # Blend masks into BGR HWC uint8 numpy image im in place, touching ROI pixels only
+        for ((x1, y1, x2, y2), m), c in zip(self, colors):
+            roi = im[y1:y2, x1:x2]
+            m = m.cpu().numpy()
+            roi[m] = (roi[m] * (1 - alpha) + np.array(c) * alpha).astype(im.dtype)
+        return im
+
+
+def process_mask_roi(protos, masks_in, bboxes, im1_shape, im0_shape, ratio_pad=None):
+    """
+    Decode and upsample masks inside their boxes only, the ROI equivalent of process_mask_native().
+    protos: [mask_dim, mask_h, mask_w], for a model input of im1_shape (h, w)
+    masks_in: [n, mask_dim], n is number of masks after nms
+    bboxes: [n, 4] xyxy in im0_shape pixels, i.e. after scale_boxes()
+    im0_shape: original image shape, (h, w)
+
+    return: RoiMasks
+    """
+    c, mh, mw = protos.shape  # CHW
+    (ih, iw), (h0, w0) = im1_shape[:2], im0_shape[:2]
+    if ratio_pad is None:  # letterbox gain and padding from im0 to im1
+        gain = min(ih / h0, iw / w0)
+        pad = (iw - w0 * gain) / 2, (ih - h0 * gain) / 2
+    else:
+        gain, pad = ratio_pad[0][0], ratio_pad[1]
+    boxes = bboxes[:, :4].round().long()
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(0, w0)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(0, h0)
+    protos = protos.float()
+
+    masks = []
+    for (x1, y1, x2, y2), m in zip(boxes.tolist(), masks_in.float()):
+        if x2 <= x1 or y2 <= y1:
+            masks.append(torch.zeros((max(y2 - y1, 0), max(x2 - x1, 0)), dtype=torch.bool, device=protos.device))
+            continue
+        # im0 pixel centers to proto pixel index coordinates
+        px = ((torch.arange(x1, x2, device=protos.device) + 0.5) * gain + pad[0]) * mw / iw - 0.5
+        py = ((torch.arange(y1, y2, device=protos.device) + 0.5) * gain + pad[1]) * mh / ih - 0.5
+        # Proto window under the ROI, then separable bilinear upsample of its sigmoid
+        px0 = min(max(int(px[0].floor()), 0), mw - 2)
+        py0 = min(max(int(py[0].floor()), 0), mh - 2)
+        px1, py1 = min(int(px[-1].floor()) + 2, mw), min(int(py[-1].floor()) + 2, mh)
+        patch = (m @ protos[:, py0:py1, px0:px1].reshape(c, -1)).sigmoid().view(py1 - py0, px1 - px0)
+        wy, wx = _interp_matrix(py - py0, py1 - py0), _interp_matrix(px - px0, px1 - px0)
+        masks.append((wy @ patch @ wx.T) > 0.5)
+    return RoiMasks(boxes, masks, (h0, w0))
+
+
 def scale_image(im1_shape, masks, im0_shape, ratio_pad=None):
     """
     img1_shape: model input shape, [h, w]
@@ -5,7 +5,7 @@ Model validation metrics
 
 import numpy as np
 
-from ..metrics import ap_per_class
+from ..metrics import APAccumulator, ap_per_class
 
 
 def fitness(x):
@@ -47,6 +47,11 @@ def ap_per_class_box_and_mask(
                                  names=names,
                                  prefix='Mask')[2:]
 
+    return box_and_mask_results(results_boxes, results_masks)
+
+
+def box_and_mask_results(results_boxes, results_masks):
+    # Pack (p, r, f1, ap, ap_class) box and mask results into a Metrics.update() dictionary
     results = {
         'boxes': {
             'p': results_boxes[0],
@@ -63,6 +68,33 @@ def ap_per_class_box_and_mask(
     return results
 
 
+class BoxMaskAccumulator:
+    """Streaming, mergeable counterpart of `func: ap_per_class_box_and_mask` with bounded memory."""
+
+    def __init__(self, nc, niou=10, bins=1000) -> None:
+        self.boxes = APAccumulator(nc, niou, bins)
+        self.masks = APAccumulator(nc, niou, bins)
+
+    @property
+    def nt(self):
+        # number of targets per class
+        return self.boxes.nt
+
+    def update(self, tp_m, tp_b, conf, pred_cls, target_cls):
+        self.boxes.update(tp_b, conf, pred_cls, target_cls)
+        self.masks.update(tp_m, conf, pred_cls, target_cls)
+
+    def __iadd__(self, other):
+        self.boxes += other.boxes
+        self.masks += other.masks
+        return self
+
+    def compute(self, plot=False, save_dir='.', names=()):
+        results_boxes = self.boxes.compute(plot=plot, save_dir=save_dir, names=names, prefix='Box')[2:]
+        results_masks = self.masks.compute(plot=plot, save_dir=save_dir, names=names, prefix='Mask')[2:]
+        return box_and_mask_results(results_boxes, results_masks)
+
+
 class Metric:
 
     def __init__(self) -> None:
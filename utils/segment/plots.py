@@ -7,10 +7,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import torch
+from ultralytics.utils.plotting import Annotator, colors
 
 from .. import threaded
 from ..general import xywh2xyxy
-from ..plots import Annotator, colors
 
 
 @threaded
@@ -0,0 +1,162 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Run-length encoded instance masks, COCO-style, for segmentation metrics that do not scale with image area
+"""
+
+from functools import cached_property
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class RLE:
+    """
+    Binary mask as sorted, disjoint [start, end) runs of ones over the column-major (Fortran order) flattened image,
+    the layout of pycocotools uncompressed RLE, i.e. RLE.encode(mask) or RLE.from_roi(box, roi_mask, (h, w)).
+    Area and bbox are computed once and cached.
+    """
+
+    def __init__(self, starts, ends, size):
+        self.starts = np.asarray(starts, dtype=np.int64)  # run starts
+        self.ends = np.asarray(ends, dtype=np.int64)  # run ends, exclusive
+        self.size = tuple(size)  # image h, w
+
+    @classmethod
+    def from_roi(cls, box, mask, size):
+        # Encode an (y2 - y1, x2 - x1) ROI mask at (x1, y1, x2, y2) in an image of size (h, w) without building it
+        x1, y1 = int(box[0]), int(box[1])
+        h = size[0]
+        mask = mask.cpu().numpy() if isinstance(mask, torch.Tensor) else np.asarray(mask)
+        d = np.diff(np.pad(mask.T.astype(np.int8), ((0, 0), (1, 1))), axis=1)  # column-major run edges
+        (cs, rs), (ce, re) = np.nonzero(d == 1), np.nonzero(d == -1)  # (column, row) of run starts, ends
+        starts, ends = (x1 + cs) * h + y1 + rs, (x1 + ce) * h + y1 + re
+        join = starts[1:] == ends[:-1]  # runs continuing across a column bottom into the next column top
+        if join.any():
+            starts, ends = starts[np.r_[True, ~join]], ends[np.r_[~join, True]]
+        return cls(starts, ends, size)
+
+    @classmethod
+    def encode(cls, mask):
+        # Encode an (h, w) binary mask
+        return cls.from_roi((0, 0), mask, mask.shape[:2])
+
+    @classmethod
+    def from_counts(cls, counts, size):
+        # Decode pycocotools uncompressed counts, alternating runs of zeros and ones starting with zeros
+        edges = np.cumsum(counts)
+        return cls(edges[0:-1:2], edges[1::2], size)
+
+    @property
+    def counts(self):
+        # pycocotools uncompressed counts, alternating runs of zeros and ones starting with zeros
+        edges = np.stack((self.starts, self.ends), 1).ravel()
+        return np.diff(edges, prepend=0).tolist() + [self.size[0] * self.size[1] - (edges[-1] if len(edges) else 0)]
+
+    def to_coco(self):
+        # pycocotools uncompressed RLE dict, compress with pycocotools.mask.frPyObjects(rle, *rle['size'])
+        return {'size': list(self.size), 'counts': self.counts}
+
+    def decode(self):
+        # Return the (h, w) bool mask
+        h, w = self.size
+        m = np.zeros(h * w + 1, dtype=np.int8)
+        np.add.at(m, self.starts, 1)
+        np.add.at(m, self.ends, -1)
+        return m[:-1].cumsum().astype(bool).reshape(w, h).T
+
+    @cached_property
+    def area(self):
+        return int((self.ends - self.starts).sum())
+
+    @cached_property
+    def bbox(self):
+        # Return (x1, y1, x2, y2) pixel bbox, exclusive x2 y2, zeros if empty
+        if not len(self.starts):
+            return 0, 0, 0, 0
+        h = self.size[0]
+        cs, ce = self.starts // h, (self.ends - 1) // h  # first, last column of each run
+        if (cs != ce).any():  # a run wraps from a column bottom to the next column top
+            y1, y2 = 0, h
+        else:
+            y1, y2 = (self.starts % h).min(), ((self.ends - 1) % h).max() + 1
+        return int(cs[0]), int(y1), int(ce[-1]) + 1, int(y2)
+
+    def coverage(self, x):
+        # Return the number of mask pixels before each flat index in array x
+        k = np.searchsorted(self.starts, x, 'right')
+        cum = np.concatenate(([0], np.cumsum(self.ends - self.starts)))
+        ends = np.concatenate(([0], self.ends))
+        return cum[k] - np.clip(ends[k] - x, 0, None)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return f'RLE(size={self.size}, runs={len(self)}, area={self.area})'
+
+
+def rle_iou(rles1, rles2, eps=1e-7):
+    """
+    rles1: N RLE masks
+    rles2: M RLE masks, of the same size
+    Note: equals mask_iou() of the dense masks, each run pair is intersected once instead of every pixel
+
+    return: masks iou, [N, M]
+    """
+    n, m = len(rles1), len(rles2)
+    inter = np.zeros((n, m))
+    if n and m:
+        starts = np.concatenate([x.starts for x in rles2])
+        ends = np.concatenate([x.ends for x in rles2])
+        j = np.repeat(np.arange(m), [len(x) for x in rles2])  # rles2 index per run
+        for i, r in enumerate(rles1):
+            if len(r) and len(j):
+                inter[i] = np.bincount(j, r.coverage(ends) - r.coverage(starts), minlength=m)
+    intersection = torch.from_numpy(inter).float()
+    area1 = torch.tensor([x.area for x in rles1], dtype=torch.float32)
+    area2 = torch.tensor([x.area for x in rles2], dtype=torch.float32)
+    union = (area1[:, None] + area2[None]) - intersection  # (area1 + area2) - intersection
+    return intersection / (union + eps)
+
+
+def process_mask_rle(protos, masks_in, bboxes, shape):
+    """
+    RLE equivalent of process_mask(upsample=False), decoding each mask inside its box only.
+    protos: [mask_dim, mask_h, mask_w]
+    masks_in: [n, mask_dim], n is number of masks after nms
+    bboxes: [n, 4], n is number of masks after nms
+    shape: input_image_size, (h, w)
+
+    return: n RLE masks of size (mask_h, mask_w)
+    """
+    c, mh, mw = protos.shape  # CHW
+    ih, iw = shape
+    protos = protos.float()
+    b = bboxes[:, :4] * torch.tensor([mw / iw, mh / ih, mw / iw, mh / ih], device=bboxes.device)  # to proto pixels
+    b = b.ceil().long()  # crop_mask() keeps pixels x1 <= x < x2, y1 <= y < y2
+    b[:, [0, 2]] = b[:, [0, 2]].clamp(0, mw)
+    b[:, [1, 3]] = b[:, [1, 3]].clamp(0, mh)
+    rles = []
+    for (x1, y1, x2, y2), m in zip(b.tolist(), masks_in.float()):
+        x2, y2 = max(x1, x2), max(y1, y2)
+        roi = (m @ protos[:, y1:y2, x1:x2].reshape(c, -1)).sigmoid().view(y2 - y1, x2 - x1) > 0.5
+        rles.append(RLE.from_roi((x1, y1), roi, (mh, mw)))
+    return rles
+
+
+def gt_masks_rle(gt_masks, nl, shape, overlap=False):
+    """
+    Encode dataloader ground truth masks one instance at a time, as process_batch() compares them to predictions.
+    gt_masks: [nl, h, w] masks, or [1, h, w] instance index image if overlap
+    shape: prediction mask size (h, w), ground truth is resized to it if different
+
+    return: nl RLE masks of size shape
+    """
+    rles = []
+    for i in range(nl):
+        g = (gt_masks[0] == i + 1).float() if overlap else gt_masks[i]
+        if g.shape != tuple(shape):
+            g = F.interpolate(g[None, None], shape, mode='bilinear', align_corners=False)[0, 0].gt_(0.5)
+        rles.append(RLE.encode(g > 0))
+    return rles
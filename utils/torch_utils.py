@@ -245,6 +245,75 @@ def prune(model, amount=0.3):
     LOGGER.info(f'Model pruned to {sparsity(model):.3g} global sparsity')
 
 
+def prune_conv(m, keep_out=None, keep_in=None):
+    # Physically remove output and/or input channels of a Conv() (Conv2d + BatchNorm2d) module, in place
+    conv, bn = m.conv, m.bn
+    assert conv.groups == 1 or keep_in is None, 'grouped convolution inputs can not be pruned'
+    w = conv.weight.data
+    if keep_out is not None:
+        w = w[keep_out]
+        for k in 'weight', 'bias':
+            setattr(bn, k, nn.Parameter(getattr(bn, k).data[keep_out].clone()))
+        for k in 'running_mean', 'running_var':
+            setattr(bn, k, getattr(bn, k)[keep_out].clone())
+        bn.num_features = conv.out_channels = len(keep_out)
+    if keep_in is not None:
+        w = w[:, keep_in]
+        conv.in_channels = len(keep_in)
+    conv.weight = nn.Parameter(w.clone())
+
+
+def prunable_groups(model):
+    # Return channel groups that can be removed without changing any module's external shape, as (bns, outs, ins):
+    # BatchNorm2d layers ranking the channels, Conv() modules producing them and (Conv(), input offset) consuming them
+    from models.common import C3, SPPF, Bottleneck  # scoped to avoid circular import
+
+    groups = []
+    for m in model.modules():
+        if isinstance(m, Bottleneck):  # hidden channels
+            groups.append(([m.cv1.bn], [m.cv1], [(m.cv2, 0)]))
+        elif type(m) is C3 and all(isinstance(b, Bottleneck) for b in m.m):
+            c_ = m.cv1.conv.out_channels
+            groups.append(([m.cv2.bn], [m.cv2], [(m.cv3, c_)]))  # cv2 branch, second half of cv3 input
+            if all(b.add for b in m.m):  # cv1 and every bottleneck output are summed, prune them together
+                groups.append(([m.cv1.bn] + [b.cv2.bn for b in m.m], [m.cv1] + [b.cv2 for b in m.m],
+                               [(b.cv1, 0) for b in m.m] + [(m.cv3, 0)]))
+            elif not any(b.add for b in m.m):  # chain
+                convs = [m.cv1] + [b.cv2 for b in m.m]
+                consumers = [b.cv1 for b in m.m] + [m.cv3]
+                groups += [([a.bn], [a], [(b, 0)]) for a, b in zip(convs, consumers)]
+        elif isinstance(m, SPPF):  # hidden channels, concatenated 4x into cv2
+            c_ = m.cv1.conv.out_channels
+            groups.append(([m.cv1.bn], [m.cv1], [(m.cv2, i * c_) for i in range(4)]))
+    return groups
+
+
+def prune_channels(model, ratio=0.3, divisor=8, min_channels=8):
+    # Structured pruning: remove the `ratio` fraction of prunable channels with the smallest BatchNorm |gamma|,
+    # keeping a divisor-multiple of at least min_channels per group. Returns the physically smaller model, in place
+    assert not any(hasattr(m, 'bn') and not hasattr(m.bn, 'weight') for m in model.modules()), 'unfuse model first'
+    groups = prunable_groups(model)
+    scores = [torch.stack([bn.weight.data.abs() for bn in bns]).mean(0) for bns, _, _ in groups]
+    ranks = torch.cat(scores).float().argsort().argsort().split([len(s) for s in scores])  # global rank, ties split
+    n_drop = int(ratio * sum(len(s) for s in scores))
+    outs, ins = {}, {}  # Conv() to kept output indices, Conv() to input keep mask
+    for (_, producers, consumers), s, r in zip(groups, scores, ranks):
+        n = len(s)
+        k = math.ceil(max(int((r >= n_drop).sum()), min_channels) / divisor) * divisor  # channels to keep
+        keep = s.argsort(descending=True)[:min(k, n)].sort()[0]
+        for m in producers:
+            outs[m] = keep
+        drop = torch.ones(n, dtype=torch.bool)
+        drop[keep] = False
+        for m, offset in consumers:
+            mask = ins.setdefault(m, torch.ones(m.conv.in_channels, dtype=torch.bool))
+            mask[offset:offset + n][drop] = False
+    for m in set(outs) | set(ins):
+        keep_in = ins[m].nonzero().view(-1).to(m.conv.weight.device) if m in ins else None
+        prune_conv(m, outs[m].to(m.conv.weight.device) if m in outs else None, keep_in)
+    return model
+
+
 def fuse_conv_and_bn(conv, bn):
     # Fuse Conv2d() and BatchNorm2d() layers https://tehnokv.com/posts/fusing-batchnorm-and-conv/
     fusedconv = nn.Conv2d(conv.in_channels,
@@ -286,12 +355,14 @@ def model_info(model, verbose=False, imgsz=640):
         im = torch.empty((1, p.shape[1], stride, stride), device=p.device)  # input image in BCHW format
         flops = thop.profile(deepcopy(model), inputs=(im, ), verbose=False)[0] / 1E9 * 2  # stride GFLOPs
         imgsz = imgsz if isinstance(imgsz, list) else [imgsz, imgsz]  # expand if int/float
-        fs = f', {flops * imgsz[0] / stride * imgsz[1] / stride:.1f} GFLOPs'  # 640x640 GFLOPs
+        flops *= imgsz[0] / stride * imgsz[1] / stride  # 640x640 GFLOPs
+        fs = f', {flops:.1f} GFLOPs'
     except Exception:
-        fs = ''
+        flops, fs = 0.0, ''
 
     name = Path(model.yaml_file).stem.replace('yolov5', 'YOLOv5') if hasattr(model, 'yaml_file') else 'Model'
     LOGGER.info(f'{name} summary: {len(list(model.modules()))} layers, {n_p} parameters, {n_g} gradients{fs}')
+    return n_p, flops
 
 
 def scale_img(img, ratio=1.0, same_shape=False, gs=32):  # img(16,3,256,416)
@@ -0,0 +1,111 @@
+# YOLOv5 🚀 by Ultralytics, AGPL-3.0 license
+"""
+Second-stage classification of detection crops, i.e. to reject fire/smoke false alarms with a classify/ model
+"""
+
+import numpy as np
+import torch
+
+from utils.augmentations import IMAGENET_MEAN, IMAGENET_STD
+from utils.general import LOGGER, Profile, colorstr
+from utils.ops import clip_boxes, xywh2xyxy, xyxy2xywh
+
+
+def square_boxes(boxes, gain=1.3, pad=30):
+    # Return (n,4) xyxy boxes as padded squares around the box centers, as apply_classifier() cuts out
+    b = xyxy2xywh(boxes)
+    b[:, 2:] = b[:, 2:].max(1, keepdim=True)[0] * gain + pad  # rectangle to padded square
+    return xywh2xyxy(b)
+
+
+def crop_rois(im, boxes, size=224, bgr=True):
+    """
+    Resize all box crops of one image to size x size in one roi_align call, bilinear, outside-image areas zero
+    im: (h, w, 3) uint8 numpy image or (3, h, w) tensor
+    boxes: (n, 4) xyxy pixel boxes
+
+    return: (n, 3, size, size) float32 RGB crops 0.0-1.0 on the boxes device
+    """
+    from torchvision.ops import roi_align  # scoped, torchvision import is slow
+
+    boxes = torch.as_tensor(boxes, dtype=torch.float32)
+    if isinstance(im, np.ndarray):
+        im = torch.from_numpy(np.ascontiguousarray(im)).permute(2, 0, 1)  # HWC to CHW view
+    im = im.to(boxes.device)
+    if not len(boxes):
+        return torch.zeros((0, 3, size, size), device=boxes.device)
+
+    # Convert only the region covering all boxes to float
+    h, w = im.shape[1:]
+    x1, y1 = (boxes[:, :2].min(0)[0].floor().clamp(min=0)).long().tolist()
+    x2, y2 = (boxes[:, 2:].max(0)[0].ceil() + 1).long().tolist()
+    x2, y2 = min(max(x2, x1 + 1), w), min(max(y2, y1 + 1), h)
+    region = im[:, y1:y2, x1:x2].float()[None]
+    rois = torch.cat((torch.zeros_like(boxes[:, :1]), boxes - torch.tensor([x1, y1, x1, y1], device=boxes.device)), 1)
+    x = roi_align(region, rois, (size, size), spatial_scale=1.0, sampling_ratio=1, aligned=True)  # cv2.INTER_LINEAR
+    return (x.flip(1) if bgr else x) / 255  # BGR to RGB
+
+
+class Verifier:
+    """ YOLOv5 second-stage verifier, i.e. keep = Verifier(DetectMultiBackend('fire-cls.pt'), ['Fire'])(im0, b, c, p)
+    Detections of the verified classes with confidence below conf are cropped with crop_rois() and classified in one
+    batch; they are kept if the classifier gives their class at least accept probability. Only the max_crops lowest
+    confidence detections per frame are verified, the rest are kept, so added latency is bounded by one classifier
+    batch of max_crops. Classes match the classifier names case-insensitively. Stage times accumulate in self.dt.
+    """
+
+    def __init__(self, model, classes=None, conf=0.6, accept=0.5, max_crops=8, imgsz=224):
+        self.model = model  # DetectMultiBackend() classification model
+        self.names = {v.lower(): k for k, v in model.names.items()} if isinstance(model.names, dict) else \
+            {v.lower(): k for k, v in enumerate(model.names)}  # classifier name: index
+        self.classes = {c.lower() for c in classes} if classes else set(self.names)  # verified detector class names
+        unknown = self.classes - set(self.names)
+        if unknown:
+            LOGGER.warning(f"{colorstr('Verifier:')} WARNING ⚠️ classes {sorted(unknown)} not in classifier names")
+        self.conf = conf  # verify detections below this confidence
+        self.accept = accept  # min classifier probability of the detected class
+        self.max_crops = max_crops
+        self.imgsz = imgsz
+        self.mean = torch.tensor(IMAGENET_MEAN, device=model.device).view(1, 3, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD, device=model.device).view(1, 3, 1, 1)
+        self.dt = (Profile(), Profile())  # crop, classify
+        self.seen = self.verified = self.rejected = 0
+
+    def __call__(self, im0, boxes, labels, confs):
+        """
+        im0: (h, w, 3) BGR uint8 image
+        boxes: (n, 4) xyxy pixel boxes
+        labels: n detector class names
+        confs: n confidences
+
+        return: (n,) bool numpy keep mask
+        """
+        n = len(labels)
+        keep = np.ones(n, dtype=bool)
+        confs = np.asarray(confs, dtype=np.float32).reshape(-1)
+        i = [j for j in range(n) if labels[j].lower() in self.classes and labels[j].lower() in self.names and
+             confs[j] < self.conf]
+        i = sorted(i, key=lambda j: confs[j])[:self.max_crops]  # least confident first
+        self.seen += n
+        if not i:
+            return keep
+        with self.dt[0]:
+            b = square_boxes(torch.as_tensor(np.asarray(boxes, dtype=np.float32)[i]).to(self.model.device))
+            clip_boxes(b, im0.shape)  # as save_one_box(), no zero padding past the frame edge
+            x = (crop_rois(im0, b, self.imgsz) - self.mean) / self.std
+        with self.dt[1]:
+            p = self.model(x.half() if self.model.fp16 else x).float().softmax(1)  # one batch
+            c = torch.tensor([self.names[labels[j].lower()] for j in i], device=p.device)
+            ok = (p.gather(1, c[:, None])[:, 0] >= self.accept).cpu().numpy()
+        keep[i] = ok
+        self.verified += len(i)
+        self.rejected += int((~ok).sum())
+        return keep
+
+    def filter(self, im0, classified):
+        # Return detect_v8() detection dicts with 'xmin', 'ymin', 'xmax', 'ymax', 'score', 'label' keys that pass
+        if not classified:
+            return classified
+        boxes = [[d['xmin'], d['ymin'], d['xmax'], d['ymax']] for d in classified]
+        keep = self(im0, boxes, [d['label'] for d in classified], [float(d['score']) for d in classified])
+        return [d for d, k in zip(classified, keep) if k]